@@ -0,0 +1,346 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Benchmarks for the hot paths of yasha: variable file parsers, the SVD model, template rendering,
+command-line start up and Makefile dependency scanning.
+
+    python benchmarks/run.py                              # run every benchmark
+    python benchmarks/run.py -k svd                       # run the benchmarks whose name contains 'svd'
+    python benchmarks/run.py --save baseline.json         # save the results
+    python benchmarks/run.py --compare baseline.json      # fail if a benchmark got slower than the saved results
+"""
+
+import io
+import json
+import sys
+import timeit
+from contextlib import redirect_stdout
+from pathlib import Path
+from statistics import median
+from subprocess import PIPE, run
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict
+from xml.etree import ElementTree
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = ROOT / 'tests' / 'fixtures'
+sys.path.insert(0, str(ROOT))
+
+from yasha.cli import cli  # noqa: E402
+from yasha.cmsis import SVDFile  # noqa: E402
+from yasha.main import Yasha  # noqa: E402
+from yasha.precompiled import PrecompiledLoader  # noqa: E402
+from yasha.parsers import PARSERS, TOML_BACKENDS, import_toml_backend, make_xml_parser  # noqa: E402
+from yasha.util import dump_template  # noqa: E402
+
+# Number of records in the synthetic variable files, and number of copies of each nrf51 peripheral in the synthetic SVD file
+RECORDS = 5000
+SVD_SCALE = 20
+
+# name -> function which takes a scratch directory, prepares the benchmark and returns the callable to time
+BENCHMARKS: Dict[str, Callable[[Path], Callable[[], object]]] = dict()
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def records():
+    return [dict(name=f'item{i}', value=i, enabled=bool(i % 2), description=f'Item number {i}') for i in range(RECORDS)]
+
+
+def write_variable_file(directory: Path, ext: str) -> Path:
+    "Writes a synthetic variable file with about RECORDS entries, in the format of the `ext` parser"
+    file = directory / f'variables{ext}'
+    rows = records()
+    if ext == '.json':
+        file.write_text(json.dumps(dict(items=rows)))
+    elif ext in ('.yaml', '.yml'):
+        file.write_text('items:\n' + ''.join(
+            f'  - name: {r["name"]}\n    value: {r["value"]}\n    enabled: {str(r["enabled"]).lower()}\n    description: {r["description"]}\n'
+            for r in rows))
+    elif ext == '.toml':
+        file.write_text(''.join(
+            f'[[items]]\nname = "{r["name"]}"\nvalue = {r["value"]}\nenabled = {str(r["enabled"]).lower()}\ndescription = "{r["description"]}"\n'
+            for r in rows))
+    elif ext == '.xml':
+        file.write_text('<items>' + ''.join(
+            f'<item enabled="{r["enabled"]}"><name>{r["name"]}</name><value>{r["value"]}</value><description>{r["description"]}</description></item>'
+            for r in rows) + '</items>')
+    elif ext == '.ini':
+        file.write_text(''.join(
+            f'[{r["name"]}]\nvalue = {r["value"]}\nenabled = {r["enabled"]}\ndescription = {r["description"]}\n'
+            for r in rows))
+    elif ext == '.csv':
+        file.write_text('name,value,enabled,description\n' + ''.join(
+            f'{r["name"]},{r["value"]},{r["enabled"]},{r["description"]}\n' for r in rows))
+    elif ext == '.svd':
+        write_synthetic_svd(file)
+    else:
+        raise ValueError(f'No synthetic variable file for {ext}')
+    return file
+
+
+def write_synthetic_svd(file: Path, scale: int = SVD_SCALE):
+    "Writes a copy of nrf51.svd in which every peripheral is repeated `scale` times"
+    tree = ElementTree.parse(str(FIXTURES / 'nrf51.svd'))
+    peripherals = tree.getroot().find('peripherals')
+    originals = list(peripherals)
+    for i in range(1, scale):
+        for periph in originals:
+            copy = ElementTree.fromstring(ElementTree.tostring(periph))
+            copy.find('name').text += f'_{i}'
+            peripherals.append(copy)
+    tree.write(str(file))
+
+
+def make_parser_benchmark(ext: str):
+    def setup(directory: Path):
+        file = write_variable_file(directory, ext)
+        parser = PARSERS[ext]
+        def parse():
+            with file.open('rb') as f:
+                return parser(f)
+        return parse
+    return setup
+
+
+for _ext in PARSERS:
+    benchmark(f'parse{_ext.replace(".", "_")}')(make_parser_benchmark(_ext))
+
+
+def make_toml_backend_benchmark(backend: str):
+    def setup(directory: Path):
+        file = write_variable_file(directory, '.toml')
+        toml = import_toml_backend((backend,))
+        def parse():
+            with file.open('rb') as f:
+                return toml.load(f)
+        return parse
+    return setup
+
+
+for _backend in TOML_BACKENDS:
+    try:
+        import_toml_backend((_backend,))
+    except ImportError:
+        continue
+    benchmark(f'parse_toml_{_backend}')(make_toml_backend_benchmark(_backend))
+
+
+@benchmark('parse_xml_select')
+def parse_xml_select(directory: Path):
+    file = write_variable_file(directory, '.xml')
+    parser = make_xml_parser('items/item')
+    def parse():
+        with file.open('rb') as f:
+            return parser(f)
+    return parse
+
+
+@benchmark('svd_nrf51')
+def svd_nrf51(directory: Path):
+    def parse():
+        with (FIXTURES / 'nrf51.svd').open('rb') as f:
+            SVDFile(f).parse()
+    return parse
+
+
+@benchmark('svd_synthetic')
+def svd_synthetic(directory: Path):
+    file = directory / 'synthetic.svd'
+    write_synthetic_svd(file)
+    def parse():
+        with file.open('rb') as f:
+            SVDFile(f).parse()
+    return parse
+
+
+@benchmark('render_nrf51')
+def render_nrf51(directory: Path):
+    y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], yasha_extensions_files=[FIXTURES / 'nrf51.rs.py'])
+    template = y.env.from_string((FIXTURES / 'nrf51.rs.jinja').read_text())
+    return template.render
+
+
+@benchmark('render_nrf51_fragment_cache')
+def render_nrf51_fragment_cache(directory: Path):
+    "Renders nrf51.rs.jinja with each peripheral in a {% cache %} fragment, once the fragments are cached"
+    y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], yasha_extensions_files=[FIXTURES / 'nrf51.rs.py'])
+    source = (FIXTURES / 'nrf51.rs.jinja').read_text()
+    source = source.replace('{% for p in peripherals %}', '{% for p in peripherals %}{% cache "peripheral", p %}')
+    source = source[:source.rindex('{% endfor %}')] + '{% endcache %}{% endfor %}' + source[source.rindex('{% endfor %}') + 12:]
+    template = y.env.from_string(source)
+    template.render()
+    return template.render
+
+
+@benchmark('render_nrf51_memo')
+def render_nrf51_memo(directory: Path):
+    """Renders nrf51.rs.jinja with its register macro memoized. Its filters are cheaper than a memo lookup,
+    so marking them as pure would make it slower"""
+    y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], yasha_extensions_files=[FIXTURES / 'nrf51.rs.py'])
+    source = (FIXTURES / 'nrf51.rs.jinja').read_text().replace('{% macro register', '{% memo macro register')
+    template = y.env.from_string(source)
+    return template.render
+
+
+@benchmark('render_nrf51_parallel')
+def render_nrf51_parallel(directory: Path):
+    "Renders nrf51.rs.jinja with its peripherals loop in a {% parallel for %}, with one worker per CPU"
+    y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], yasha_extensions_files=[FIXTURES / 'nrf51.rs.py'])
+    source = (FIXTURES / 'nrf51.rs.jinja').read_text().replace('{% for p in peripherals %}', '{% parallel for p in peripherals %}')
+    template = y.env.from_string(source)
+    return template.render
+
+
+# A header with one line per register of nrf51.svd, most of which only depends on static variables
+REGISTERS_TEMPLATE = """\
+{% for p in peripherals %}
+{% for r in p.registers %}
+#define {{ device.name|upper }}_{{ p.name }}_{{ r.name }} {{ "%#010x"|format(p.baseAddress + r.addressOffset) }}
+{%- if config.comments %} /* {{ config.vendor|upper }} {{ device.name }} {{ device.version|default("unknown") }}, {{ config.license|lower }} */{% endif %}
+
+{% endfor %}
+{% endfor %}
+"""
+
+
+def make_specialized_benchmark(specialized: bool):
+    """Renders a header of the registers of nrf51.svd, precompiled by Yasha.compile_templates, or specialized 
+    for the device and the config by Yasha.specialize_templates"""
+    def setup(directory: Path):
+        template = directory / 'registers.h.jinja'
+        template.write_text(REGISTERS_TEMPLATE)
+        config = dict(comments=True, vendor='Nordic', license='MIT')
+        y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], inline_variables=dict(config=config))
+        if specialized:
+            y.specialize_templates([template], directory / 'precompiled')
+        else:
+            y.compile_templates([template], directory / 'precompiled')
+        return PrecompiledLoader(directory / 'precompiled').load_file(y.env, template).render
+    return setup
+
+
+benchmark('render_registers_precompiled')(make_specialized_benchmark(False))
+benchmark('render_registers_specialized')(make_specialized_benchmark(True))
+
+
+def make_shared_svd_benchmark(lazy: bool):
+    """Creates a Yasha instance with a large SVD variable file, and renders a template which doesn't use it,
+    like the templates of a directory which shares one SVD file"""
+    def setup(directory: Path):
+        file = directory / 'shared.svd'
+        write_synthetic_svd(file)
+        def render():
+            y = Yasha(variable_files=[file], inline_variables={'name': 'world'}, lazy_variables=lazy)
+            return y.render_template('Hello {{ name }}')
+        return render
+    return setup
+
+
+benchmark('render_shared_svd_eager')(make_shared_svd_benchmark(False))
+benchmark('render_shared_svd_lazy')(make_shared_svd_benchmark(True))
+
+
+def make_output_benchmark(buffer_size: int):
+    """Renders nrf51.rs.jinja (about 5000 lines, like nrf51.rs.expected) into a file, 
+    writing `buffer_size` chunks at once"""
+    def setup(directory: Path):
+        y = Yasha(variable_files=[FIXTURES / 'nrf51.svd'], yasha_extensions_files=[FIXTURES / 'nrf51.rs.py'])
+        template = y.env.from_string((FIXTURES / 'nrf51.rs.jinja').read_text())
+        output = directory / 'nrf51.rs'
+        def render():
+            with output.open('wb') as f:
+                dump_template(template, {}, f, buffer_size=buffer_size)
+        return render
+    return setup
+
+
+for _size in (0, 1, 5, 64, 1024):
+    benchmark(f'output_nrf51_buffer_{_size}')(make_output_benchmark(_size))
+
+
+@benchmark('cli_cold_start')
+def cli_cold_start(directory: Path):
+    cmd = [sys.executable, '-c', 'import sys; from yasha.cli import cli; cli(sys.argv[1:])', '--version']
+    def start():
+        run(cmd, cwd=str(ROOT), check=True, stdout=PIPE, stderr=PIPE)
+    return start
+
+
+@benchmark('cli_makefile_deps')
+def cli_makefile_deps(directory: Path):
+    template = FIXTURES / 'c_project' / 'src' / 'foo.c.jinja'
+    def scan():
+        with redirect_stdout(io.StringIO()):
+            cli(['-M', str(template)], standalone_mode=False)
+    return scan
+
+
+def measure(func: Callable[[], object], repeat: int) -> dict:
+    "Returns the best and median time per call of `func`, in seconds"
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return dict(best=min(times), median=median(times), number=number)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("-k", "keyword", help="Only run the benchmarks whose name contains KEYWORD.")
+@click.option("--repeat", "-r", default=5, show_default=True, help="Number of timing runs per benchmark.")
+@click.option("--save", type=click.Path(dir_okay=False), help="Save the results to FILENAME, for later comparison.")
+@click.option("--compare", type=click.Path(exists=True, dir_okay=False), help="Compare the results to the ones saved in FILENAME.")
+@click.option("--threshold", default=1.2, show_default=True, help="With --compare, fail if a benchmark is more than THRESHOLD times slower than the saved result.")
+def main(keyword, repeat, save, compare, threshold):
+    baseline = json.loads(Path(compare).read_text()) if compare else dict()
+    results = dict()
+    regressions = []
+    with TemporaryDirectory() as tmp:
+        for name, setup in BENCHMARKS.items():
+            if keyword and keyword not in name:
+                continue
+            directory = Path(tmp) / name
+            directory.mkdir()
+            result = results[name] = measure(setup(directory), repeat)
+            line = f"{name:<24} {result['best'] * 1000:>12.3f} ms  (median {result['median'] * 1000:.3f} ms)"
+            if name in baseline:
+                ratio = result['best'] / baseline[name]['best']
+                line += f"  {ratio:.2f}x baseline"
+                if ratio > threshold:
+                    regressions.append(name)
+                    line += "  REGRESSION"
+            click.echo(line)
+    if save:
+        Path(save).write_text(json.dumps(results, indent=2))
+    if regressions:
+        raise click.ClickException(f"{len(regressions)} benchmark(s) slower than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -18,6 +18,7 @@ setup(
     license="MIT",
     packages=find_packages(),
     include_package_data=True,
+    package_data={'yasha': ['cmake/*.cmake']},
     install_requires=[
         "Click",
         "Jinja2",
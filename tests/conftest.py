@@ -24,14 +24,36 @@ THE SOFTWARE.
 """
 
 from yasha.cli import cli
+from yasha.classes import CLASSES
+from yasha.filters import FILTERS
+from yasha.parsers import PARSERS
+from yasha.tests import TESTS
 
 from os import chdir, getcwd
 from pathlib import Path
 from textwrap import dedent
 
+import jinja2.defaults
 import pytest
 
 
+@pytest.fixture(autouse=True)
+def restore_cli_registries():
+    """The cli adds the tests, filters, parsers, classes and template syntax of extension files to the global registries,
+    which would otherwise leak into the next tests running in the same process"""
+    registries = [TESTS, FILTERS, PARSERS]
+    saved = [registry.copy() for registry in registries]
+    saved_classes = list(CLASSES)
+    saved_syntax = {name: getattr(jinja2.defaults, name) for name in dir(jinja2.defaults) if name.isupper()}
+    yield
+    for registry, copy in zip(registries, saved):
+        registry.clear()
+        registry.update(copy)
+    CLASSES[:] = saved_classes
+    for name, value in saved_syntax.items():
+        setattr(jinja2.defaults, name, value)
+
+
 @pytest.fixture
 def fixtures_dir() -> Path:
     return Path(f'{__file__}/../fixtures').resolve()
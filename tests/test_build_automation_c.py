@@ -26,10 +26,12 @@ THE SOFTWARE.
 from yasha.constants import ENCODING
 from tests.conftest import yasha_cli, wrap
 
+import json
+import sys
 from subprocess import run, PIPE
 from os import chdir
 from pathlib import Path
-from shutil import copytree
+from shutil import copytree, which
 
 import pytest
 
@@ -148,4 +150,99 @@ def test_makefile_dependency_flag_md(with_tmp_path):
         void foo() {
             char foo[] = "bar";
             printf("%s has %d chars ...\\n", foo, 3);
-        }""")
\ No newline at end of file
+        }""")
+
+
+def test_makefile_dependency_flag_m_many_templates(with_tmp_path, capfd):
+    Path('src').mkdir()
+    Path('src/foo.c.jinja').write_text('{% include "header.j2inc" %}')
+    Path('src/header.j2inc').write_text('#include "foo.h"')
+    Path('src/foo.h.jinja').write_text('void foo();')
+    Path('src/foo.h.json').write_text('{}')
+    Path('src/bar.c.jinja').write_text('<% include "header.j2inc" %>')
+    Path('src/bar.c.py').write_text('BLOCK_START_STRING = "<%"\nBLOCK_END_STRING = "%>"\n')
+
+    yasha_cli(['-M', 'src/foo.*.jinja', 'src/bar.c.jinja'])
+    out, _ = capfd.readouterr()
+    assert out.splitlines() == [
+        'src/foo.c: src/foo.c.jinja src/header.j2inc',
+        'src/foo.h: src/foo.h.jinja src/foo.h.json',
+        'src/bar.c: src/bar.c.jinja src/bar.c.py src/header.j2inc',
+    ]
+
+    yasha_cli(['-M', '--deps-format', 'json', 'src/foo.c.jinja', 'src/foo.h.jinja'])
+    out, _ = capfd.readouterr()
+    assert list(json.loads(out).items()) == [
+        ('src/foo.c', ['src/foo.c.jinja', 'src/header.j2inc']),
+        ('src/foo.h', ['src/foo.h.jinja', 'src/foo.h.json']),
+    ]
+
+
+def test_makefile_dependency_flag_m_many_templates_own_parsers(with_tmp_path, capfd):
+    "The parsers of the extension file of a template don't change the companion files found for the others"
+    Path('a.c.jinja').write_text('a')
+    Path('a.c.py').write_text('def parse_custom(file):\n    return {}\n')
+    Path('b.c.jinja').write_text('b')
+    Path('b.c.custom').write_text('')
+    Path('c.c.jinja').write_text('c')
+
+    yasha_cli(['-M', 'a.c.jinja', 'b.c.jinja', 'c.c.jinja'])
+    out, _ = capfd.readouterr()
+    assert out.splitlines() == [
+        'a.c: a.c.jinja a.c.py',
+        'b.c: b.c.jinja',
+        'c.c: c.c.jinja',
+    ]
+
+
+def test_makefile_dependency_flag_m_many_templates_closes_files(with_tmp_path, capfd, monkeypatch):
+    "The extension files found next to each template are closed once its dependencies are found"
+    import click
+    opened = []
+    open_file = click.open_file
+
+    def recording_open_file(*args, **kwargs):
+        opened.append(open_file(*args, **kwargs))
+        return opened[-1]
+    monkeypatch.setattr(click, 'open_file', recording_open_file)
+    for name in 'abc':
+        Path(f'{name}.c.jinja').write_text(name)
+        Path(f'{name}.c.py').write_text('')
+
+    yasha_cli(['-M', 'a.c.jinja', 'b.c.jinja', 'c.c.jinja'])
+    capfd.readouterr()
+    assert sorted(Path(f.name).name for f in opened if f.closed) == ['a.c.py', 'b.c.py']
+
+
+@pytest.mark.slowtest
+def test_cmake_module(with_tmp_path, fixtures_dir):
+    "Yasha.cmake renders the templates of the example project, with a single yasha -M call at configure time"
+    if not which('cmake') or not which('cc'):
+        pytest.skip("CMake or a C compiler is not installed")
+    # copytree() only copies into an existing directory since Python 3.8
+    project = with_tmp_path / 'project'
+    copytree(fixtures_dir / 'c_project', project)
+    chdir(project)
+    yasha = with_tmp_path / 'yasha'
+    yasha.write_text(wrap(f"""
+        #!/bin/sh
+        echo "$@" >> {with_tmp_path / 'yasha.log'}
+        PYTHONPATH={Path(__file__).resolve().parent.parent} exec {sys.executable} -c 'import sys; from yasha.cli import cli; cli(sys.argv[1:])' "$@"
+        """))
+    yasha.chmod(0o755)
+    module_path = run([str(yasha), '--cmake-module-path'], stdout=PIPE, encoding=ENCODING).stdout.strip()
+    Path('CMakeLists.txt').write_text(wrap(f"""
+        cmake_minimum_required(VERSION 3.5)
+        project(yasha C)
+        list(APPEND CMAKE_MODULE_PATH {module_path})
+        include(Yasha)
+        file(GLOB templates "src/*.jinja")
+        yasha_render(generated ${{templates}})
+        add_executable(a.out src/main.c ${{generated}})
+        """))
+
+    run(['cmake', '-S', '.', '-B', 'build', f'-DYASHA_EXECUTABLE={yasha}'], check=True, stdout=PIPE)
+    assert [line for line in (with_tmp_path / 'yasha.log').read_text().splitlines() if '-M' in line] == [
+        f'-M --deps-format cmake {project}/src/foo.c.jinja {project}/src/foo.h.jinja']
+    run(['cmake', '--build', 'build'], check=True, stdout=PIPE)
+    assert run(['./build/a.out'], stdout=PIPE, encoding=ENCODING).stdout == 'bar has 3 chars ...\n'
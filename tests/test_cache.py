@@ -0,0 +1,147 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from tests.conftest import yasha_cli
+from yasha.cache import OutputCache
+from yasha.cli import cli
+
+
+@pytest.fixture
+def project(with_tmp_path):
+    Path('template.j2').write_text('{% include "partial.j2" %} {{ foo }} {{ bar }}')
+    Path('partial.j2').write_text('partial')
+    Path('template.json').write_text('{"foo": "foo"}')
+    return with_tmp_path
+
+
+def stats(cache_dir='cache'):
+    return OutputCache(cache_dir).stats()
+
+
+def test_cache_hit(project):
+    yasha_cli('--cache-dir cache --bar=bar template.j2')
+    assert Path('template').read_text() == 'partial foo bar'
+    assert stats()['misses'] == 1
+    assert stats()['entries'] == 1
+
+    # Same inputs: the output is restored from the cache
+    Path('template').unlink()
+    yasha_cli('--cache-dir cache --bar=bar template.j2')
+    assert Path('template').read_text() == 'partial foo bar'
+    assert stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('change', [
+    lambda: Path('template.j2').write_text('{% include "partial.j2" %} {{ foo }}'),
+    lambda: Path('partial.j2').write_text('changed'),
+    lambda: Path('template.json').write_text('{"foo": "changed"}'),
+    lambda: Path('template.py').write_text('def filter_foo(s):\n    return s\n'),
+])
+def test_cache_miss_on_changed_input(project, change):
+    yasha_cli('--cache-dir cache template.j2')
+    change()
+    yasha_cli('--cache-dir cache template.j2')
+    assert stats()['misses'] == 2
+    assert stats()['entries'] == 2
+
+
+def test_cache_miss_on_changed_options(project):
+    yasha_cli('--cache-dir cache --bar=bar template.j2')
+    yasha_cli('--cache-dir cache --bar=baz template.j2')
+    yasha_cli('--cache-dir cache --mode pedantic --bar=bar template.j2')
+    assert stats()['misses'] == 3
+    assert Path('template').read_text() == 'partial foo bar'
+
+
+@pytest.mark.parametrize('output', ['compiled', 'compiled.zip'])
+def test_cache_miss_on_changed_precompiled(with_tmp_path, output):
+    Path('src').mkdir()
+    Path('src/template.j2').write_text('{% include "partial.j2" %}')
+    Path('src/partial.j2').write_text('partial')
+    yasha_cli(['compile', '-o', output, 'src'])
+    yasha_cli(['--cache-dir', 'cache', '--precompiled', output, 'src/template.j2'])
+    # Rebuilding the precompiled templates from changed sources invalidates the output
+    Path('src/partial.j2').write_text('changed')
+    yasha_cli(['compile', '-o', output, 'src'])
+    Path('src/partial.j2').write_text('partial')
+    yasha_cli(['--cache-dir', 'cache', '--precompiled', output, 'src/template.j2'])
+    assert stats()['misses'] == 2
+    assert stats()['entries'] == 2
+
+
+def test_cache_stats_counts(with_tmp_path):
+    cache = OutputCache('cache')
+    for _ in range(12):
+        cache.load('0' * 64)
+    assert stats()['misses'] == 12
+    # The counters don't grow with the number of lookups
+    assert Path('cache/stats/misses').read_bytes() == b'12'
+    # Counters written by earlier versions, with one byte per lookup, are carried over
+    Path('cache/stats/hits').write_bytes(b'...')
+    cache._count('hits')
+    assert stats()['hits'] == 4
+
+
+def test_cache_hardlink(project):
+    yasha_cli('--cache-dir cache --cache-hardlink template.j2')
+    yasha_cli('--cache-dir cache --cache-hardlink template.j2')
+    assert os.stat('template').st_nlink == 2
+
+    # Rendering something else into the output doesn't modify the cache entry
+    Path('template.json').write_text('{"foo": "changed"}')
+    yasha_cli('--cache-dir cache --cache-hardlink template.j2')
+    assert Path('template').read_text() == 'partial changed '
+    Path('template.json').write_text('{"foo": "foo"}')
+    yasha_cli('--cache-dir cache --cache-hardlink template.j2')
+    assert Path('template').read_text() == 'partial foo '
+
+
+def test_dynamic_include_is_not_cached(with_tmp_path):
+    Path('template.j2').write_text('{% include name %}')
+    Path('partial.j2').write_text('partial')
+    yasha_cli('--cache-dir cache --name=partial.j2 template.j2')
+    assert Path('template').read_text() == 'partial'
+    assert not Path('cache').exists()
+
+
+def test_cache_stats(project, monkeypatch):
+    yasha_cli('--cache-dir cache template.j2')
+    yasha_cli('--cache-dir cache template.j2')
+
+    for args in (['--cache-dir', 'cache', '--cache-stats'], ['--cache-stats', '--cache-dir', 'cache']):
+        result = CliRunner().invoke(cli, args)
+        assert result.exit_code == 0
+        assert 'Hits             1' in result.output
+        assert 'Misses           1' in result.output
+        assert 'Hit rate         50.0 %' in result.output
+
+    monkeypatch.setenv('YASHA_CACHE_DIR', 'cache')
+    result = CliRunner().invoke(cli, ['--cache-stats'])
+    assert 'Entries          1' in result.output
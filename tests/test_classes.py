@@ -0,0 +1,186 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import threading
+from pathlib import Path
+
+import pytest
+from jinja2 import TemplateSyntaxError
+
+from yasha.cache import FragmentCache, fingerprint
+from yasha.cmsis import SVDFile
+from yasha.filters import pure
+from yasha.main import Yasha
+from tests.conftest import yasha_cli
+
+
+def render_counting(y: Yasha, template: str, **variables):
+    calls = []
+    y.env.filters['count'] = lambda value: calls.append(value) or value
+    return y.render_template(template, variables=variables), calls
+
+
+def test_cache_tag():
+    template = '{% for i in items %}{% cache "item", i %}[{{ i.n|count }}]{% endcache %}{% endfor %}'
+    output, calls = render_counting(Yasha(), template, items=[{'n': 1}, {'n': 2}, {'n': 1}])
+    assert output == '[1][2][1]'
+    assert calls == [1, 2]
+
+
+def test_cache_tag_autoescape():
+    y = Yasha(autoescape=True)
+    assert y.render_template('{% for i in ["<a>", "<a>"] %}{% cache "k", i %}{{ i }}{% endcache %}{% endfor %}') == '&lt;a&gt;' * 2
+
+
+def test_cache_tag_autoescape_key(with_tmp_path):
+    "A fragment rendered without autoescaping isn't reused by an autoescaped render"
+    template = '{% cache "k", i %}{{ i }}{% endcache %}'
+    assert Yasha(fragment_cache_dir='fragments').render_template(template, variables={'i': '<a>'}) == '<a>'
+    assert Yasha(fragment_cache_dir='fragments', autoescape=True).render_template(template, variables={'i': '<a>'}) == '&lt;a&gt;'
+    assert Yasha().render_template('{% autoescape true %}' + template + '{% endautoescape %}' + template, variables={'i': '<'}) == '&lt;<'
+
+
+def test_cache_tag_persistence(with_tmp_path):
+    Path('template.j2').write_text('{% cache "greeting", name %}Hello {{ name|count }}{% endcache %}')
+
+    output, calls = render_counting(Yasha(fragment_cache_dir='fragments'), Path('template.j2'), name='world')
+    assert (output, calls) == ('Hello world', ['world'])
+    # Another instance, like another run, reuses the fragment
+    output, calls = render_counting(Yasha(fragment_cache_dir='fragments'), Path('template.j2'), name='world')
+    assert (output, calls) == ('Hello world', [])
+    output, calls = render_counting(Yasha(fragment_cache_dir='fragments'), Path('template.j2'), name='there')
+    assert (output, calls) == ('Hello there', ['there'])
+
+    # Editing the fragment invalidates it
+    Path('template.j2').write_text('{% cache "greeting", name %}Hi {{ name|count }}{% endcache %}')
+    output, calls = render_counting(Yasha(fragment_cache_dir='fragments'), Path('template.j2'), name='world')
+    assert (output, calls) == ('Hi world', ['world'])
+
+
+def test_cache_tag_cli(with_tmp_path):
+    Path('template.j2').write_text('{% cache "k", foo %}{{ foo }}{% endcache %}')
+    yasha_cli('--fragment-cache fragments --foo=bar template.j2')
+    assert Path('template').read_text() == 'bar'
+    assert FragmentCache('fragments').disk.stats() == {'entries': 1, 'bytes': 3, 'hits': 0, 'misses': 0}
+
+
+def test_fingerprint_svd(fixtures_dir):
+    def peripherals():
+        with open(str(fixtures_dir / 'nrf51.svd'), 'rb') as f:
+            svd = SVDFile(f)
+            svd.parse()
+        return svd.peripherals
+
+    first, second = peripherals(), peripherals()
+    assert fingerprint(first[0]) == fingerprint(second[0])
+    # The digest of a peripheral doesn't depend on the other peripherals of the device
+    second[1].name = 'renamed'
+    assert fingerprint(first[0]) == fingerprint(second[0])
+    assert fingerprint(first[1]) != fingerprint(second[1])
+    assert fingerprint(lambda: None) is None
+
+
+def test_memo_tag():
+    y = Yasha(profile=True)
+    template = '{% memo macro m(x) %}<{{ x|count }}{{ caller() if caller }}>{% endmacro %}' \
+        '{{ m(1) }}{{ m(2) }}{{ m(1) }}{% call m(1) %}!{% endcall %}'
+    output, calls = render_counting(y, template)
+    assert output == '<1><2><1><1!>'
+    assert calls == [1, 2, 1]
+    assert y.profiler.as_dict()['memo'] == {'macro m': {'hits': 1, 'misses': 2}}
+    # Each render starts afresh
+    assert render_counting(y, template) == ('<1><2><1><1!>', [1, 2, 1])
+
+
+def test_memo_tag_block_async():
+    y = Yasha(enable_async=True)
+    template = '{% memo %}{% macro a(x) %}a{{ x|count }}{% endmacro %}{% macro b(x) %}b{{ x|count }}{% endmacro %}{% endmemo %}' \
+        '{{ a(1) }}{{ b(1) }}{{ a(1) }}{{ b([1]) }}'
+    assert render_counting(y, template) == ('a1b1a1b[1]', [1, 1, [1]])
+
+
+def test_pure_filter_memo():
+    calls = []
+
+    @pure
+    def shout(value, suffix='!'):
+        calls.append(value)
+        return str(value).upper() + suffix
+
+    y = Yasha()
+    y.env.filters['shout'] = y._adapt_filter('shout', shout)
+    output = y.render_template('{% set d = {"a": 1} %}{{ "a"|shout }}{{ "a"|shout }}{{ "a"|shout("?") }}{{ d|shout }}{{ d|shout }}')
+    assert output == "A!A!A?{'A': 1}!{'A': 1}!"
+    assert calls == ['a', 'a', {'a': 1}]
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_parallel_for(workers):
+    y = Yasha()
+    y.env.parallel_workers = workers
+    items = [(i, i * 2) for i in range(10)]
+    body = '[{{ a }}-{{ b|string }} {{ loop.index }}/{{ loop.length }}{{ "!" if loop.last }}]'
+    expected = y.render_template('{% for a, b in items %}' + body + '{% endfor %}', variables={'items': items})
+    assert y.render_template('{% parallel for a, b in items %}' + body + '{% endfor %}', variables={'items': items}) == expected
+
+
+def test_parallel_for_async_autoescape():
+    assert Yasha(enable_async=True, autoescape=True).render_template('{% parallel for a in ["<", "b"] %}{{ a }}{% endfor %}') == '&lt;b'
+
+
+def test_parallel_for_else():
+    with pytest.raises(TemplateSyntaxError):
+        Yasha().render_template('{% parallel for a in items %}{{ a }}{% else %}none{% endfor %}')
+
+
+@pytest.mark.parametrize('body', ['{% set ns.n = ns.n + x %}{{ ns.n }},', '{% do items.append(x) %}'])
+def test_parallel_for_outer_scope_changes(body):
+    "Changes to the outer scope would depend on the number of workers"
+    y = Yasha()
+    y.env.add_extension('jinja2.ext.do')
+    with pytest.raises(TemplateSyntaxError):
+        y.render_template('{% set ns = namespace(n=0) %}{% parallel for x in items %}' + body + '{% endfor %}')
+
+
+def test_parallel_for_other_threads():
+    "Workers aren't forked while other threads could hold locks"
+    y = Yasha()
+    y.env.parallel_workers = 3
+    y.env.globals['pid'] = os.getpid
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait)
+    thread.start()
+    try:
+        pids = y.render_template('{% parallel for x in range(8) %}{{ pid() }},{% endfor %}')
+    finally:
+        release.set()
+        thread.join()
+    assert set(pids.split(',')[:-1]) == {str(os.getpid())}
+
+
+def test_parallel_for_cli(with_tmp_path):
+    Path('template.j2').write_text('{% parallel for x in items %}{{ x }},{% endfor %}')
+    yasha_cli(['-j', '2', '--items=[1, 2, 3]', 'template.j2'])
+    assert Path('template').read_text() == '1,2,3,'
@@ -26,7 +26,10 @@ THE SOFTWARE.
 from tests.conftest import yasha_cli, wrap
 from yasha.cli import cli
 
-from subprocess import run, PIPE
+import json
+import os
+import sys
+from subprocess import run, Popen, PIPE
 from pathlib import Path
 from typing import List
 
@@ -357,6 +360,35 @@ def test_render_template_from_stdin_to_stdout():
     assert out == b'bar'
 
 
+def test_stream_stdin_to_stdout():
+    "Rendered chunks reach a pipe as soon as they are rendered, not when the render is complete"
+    cmd = [sys.executable, '-c', 'import sys; from yasha.cli import cli; cli(sys.argv[1:])', '--foo=bar', '-']
+    root = Path(__file__).resolve().parent.parent
+    proc = Popen(cmd, cwd=str(root), stdin=PIPE, stdout=PIPE)
+    try:
+        proc.stdin.write(b'{{ foo }}\n{{ "sleep 1; echo baz"|shell }}')
+        proc.stdin.close()
+        assert proc.stdout.readline() == b'bar\n'
+        assert proc.poll() is None  # still rendering the second line
+        assert proc.stdout.read() == b'baz'
+    finally:
+        proc.wait()
+
+
+def test_stdin_error_exits_before_eof(with_tmp_path):
+    "A run failing before the template is needed doesn't wait for the end of stdin"
+    Path('broken.yaml').write_text('foo: [\n')
+    cmd = [sys.executable, '-c', 'import sys; from yasha.cli import cli; cli(sys.argv[1:])', '-v', 'broken.yaml', '-']
+    root = Path(__file__).resolve().parent.parent
+    env = dict(os.environ, PYTHONPATH=str(root))
+    proc = Popen(cmd, env=env, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    try:
+        assert proc.wait(timeout=10) != 0
+    finally:
+        proc.kill()
+        proc.communicate()
+
+
 def test_json_template(with_tmp_path, capfd):
     """gh-34, and gh-35"""
 
@@ -442,3 +474,157 @@ def test_extensions_file_with_do(with_tmp_path):
     output = Path('template')
     assert output.is_file()
     assert output.read_text() == '[1, 2, 3, 4]'
+
+
+def test_profile(with_tmp_path, capfd):
+    Path('data.json').write_text('{"foo": "bar"}')
+    Path('template.j2').write_text('{{ foo|upper }} {{ "echo baz"|shell }}')
+
+    yasha_cli('--profile --profile-format json -v data.json template.j2')
+
+    _, err = capfd.readouterr()
+    report = json.loads(err)
+    assert {'compile', 'parse data.json', 'render'} <= report['phases'].keys()
+    assert report['filters']['upper']['calls'] == 1
+    assert report['filters']['shell']['calls'] == 1
+    assert Path('template').read_text() == 'BAR baz'
+
+
+def test_trace(with_tmp_path, fixtures_dir):
+    svd = fixtures_dir / 'nrf51.svd'
+    Path('template.j2').write_text('{% for p in peripherals %}{{ p.name|lower }}{% endfor %}')
+
+    yasha_cli(['-v', str(svd), '--trace', 'trace.json', 'template.j2'])
+
+    trace = json.loads(Path('trace.json').read_text())
+    spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    names = {event['name'] for event in spans}
+    assert {'parse command line', f'parse {svd}', 'SvdPeripheral.from_element', 'SvdRegister.fold',
+            'compile', 'render', 'write output'} <= names
+    assert all(event['dur'] >= 0 and event['ts'] > 0 for event in spans)
+    assert Path('template').read_text().startswith('power')
+
+
+def test_foreach(with_tmp_path):
+    Path('data.yaml').write_text(wrap("""
+        project: demo
+        peripherals:
+          - name: uart
+            base: 0x4000
+          - name: spi
+            base: 0x5000
+    """))
+    Path('template.h.j2').write_text('{{ project }} {{ periph.name }} {{ periph.base }}')
+
+    yasha_cli(['-v', 'data.yaml', '--foreach', 'peripherals', '--foreach-as', 'periph', '-j', '2',
+               '-o', 'include/{periph[name]}.h', 'template.h.j2'])
+
+    assert Path('include/uart.h').read_text() == 'demo uart 16384'
+    assert Path('include/spi.h').read_text() == 'demo spi 20480'
+
+
+def test_foreach_default_output(with_tmp_path):
+    Path('template.txt.j2').write_text('{{ item }}')
+
+    yasha_cli(['--foreach', 'names', '--names=a,b', 'template.txt.j2'])
+
+    assert Path('template-0.txt').read_text() == 'a'
+    assert Path('template-1.txt').read_text() == 'b'
+
+
+def test_foreach_undefined_variable(with_tmp_path):
+    Path('template.j2').write_text('{{ item }}')
+    with pytest.raises(ClickException) as e:
+        yasha_cli('--foreach names template.j2')
+    assert "Variable 'names' is undefined" in e.value.message
+
+
+def test_foreach_svd_peripherals(with_tmp_path, fixtures_dir):
+    "An SVD file can be split into one output file per peripheral, and unchanged files are not rewritten"
+    svd = fixtures_dir / 'nrf51.svd'
+    Path('periph.txt.j2').write_text('{{ peripheral.name }} {{ "0x%08x"|format(peripheral.baseAddress) }}')
+    args = ['-v', str(svd), '--foreach', 'peripherals', '--foreach-as', 'peripheral', '-j', '4',
+            '-o', 'out/{peripheral.name}.txt', 'periph.txt.j2']
+
+    yasha_cli(args)
+    outputs = sorted(Path('out').iterdir())
+    assert len(outputs) > 10
+    assert Path('out/UART0.txt').read_text() == 'UART0 0x40002000'
+
+    # Render again, with a change in a single peripheral's output
+    for output in outputs:
+        os.utime(output, ns=(0, 0))
+    Path('out/UART0.txt').write_text('outdated')
+    yasha_cli(args)
+    assert [o for o in outputs if o.stat().st_mtime_ns != 0] == [Path('out/UART0.txt')]
+    assert Path('out/UART0.txt').read_text() == 'UART0 0x40002000'
+
+
+@pytest.mark.parametrize('buffer_size', ['0', '1', '5', '1000'])
+def test_buffer_size(with_tmp_path, buffer_size):
+    Path('template.j2').write_text('{% for i in range(100) %}{{ i }}{% if not loop.last %},{% endif %}{% endfor %}')
+
+    yasha_cli(['--buffer-size', buffer_size, 'template.j2'])
+
+    assert Path('template').read_text() == ','.join(str(i) for i in range(100))
+
+
+def test_xml_select(with_tmp_path):
+    Path('export.xml').write_text(wrap("""
+        <export version="2">
+            <meta><author>Foo</author></meta>
+            <devices>
+                <device id="1"><name>uart</name></device>
+                <ignored>bar</ignored>
+                <device id="2"><name>spi</name><irq>3</irq><irq>4</irq></device>
+            </devices>
+        </export>
+        """))
+    Path('template.j2').write_text(
+        '{% for d in export.devices.device %}{{ d["@id"] }}={{ d.name }}{{ d.irq }};{% endfor %}{{ export.meta is defined }}')
+
+    yasha_cli('-v export.xml template.j2')
+    assert Path('template').read_text() == "1=uart;2=spi['3', '4'];True"
+
+    yasha_cli('-v export.xml --xml-select export/devices/device template.j2')
+    assert Path('template').read_text() == "1=uart;2=spi['3', '4'];False"
+
+
+@pytest.mark.parametrize('target', ['compiled', 'compiled.zip'])
+def test_compile_and_render_precompiled(with_tmp_path, target):
+    Path('templates/common').mkdir(parents=True)
+    Path('templates/template.j2').write_text('<% for x in items %><< x|double >> <% endfor %><% include "common/footer.j2" %>')
+    Path('templates/template.py').write_text(wrap("""
+        BLOCK_START_STRING = '<%'
+        BLOCK_END_STRING = '%>'
+        VARIABLE_START_STRING = '<<'
+        VARIABLE_END_STRING = '>>'
+
+        def filter_double(value):
+            return value * 2
+        """))
+    Path('templates/template.yaml').write_text('items: [1, 2]')
+    Path('templates/common/footer.j2').write_text('{{ "end" }}')
+
+    yasha_cli(['compile', 'templates', '-o', target])
+    first = sorted(p.read_bytes() for p in Path(target).glob('*')) if Path(target).is_dir() else Path(target).read_bytes()
+    yasha_cli(['compile', 'templates', '-o', target])
+    second = sorted(p.read_bytes() for p in Path(target).glob('*')) if Path(target).is_dir() else Path(target).read_bytes()
+    assert first == second
+
+    # The templates are loaded from the precompiled modules, not from their sources
+    Path('templates/template.j2').write_text('modified')
+    Path('templates/common/footer.j2').write_text('modified')
+    yasha_cli(['--precompiled', target, '-o', 'output.txt', 'templates/template.j2'])
+    assert Path('output.txt').read_text() == '2 4 end'
+
+
+def test_precompiled_missing_template(with_tmp_path):
+    Path('templates').mkdir()
+    Path('templates/template.j2').write_text('foo')
+    yasha_cli('compile templates -o compiled')
+    Path('other.j2').write_text('bar')
+
+    with pytest.raises(ClickException) as e:
+        yasha_cli('--precompiled compiled other.j2')
+    assert "wasn't precompiled" in e.value.message
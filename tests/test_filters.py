@@ -24,7 +24,9 @@ THE SOFTWARE.
 """
 
 from tests.conftest import yasha_cli, wrap
+from yasha.filters import ShellCache
 
+import json
 import os
 from pathlib import Path
 
@@ -80,3 +82,80 @@ def test_subprocess_with_unknown_cmd_while_check_is_false(with_tmp_path):
     yasha_cli('template.j2')
 
     assert Path('template').read_text().strip() == 'True'
+
+
+def test_shell_cache(with_tmp_path):
+    Path('template.j2').write_text(wrap("""
+        {% for i in range(3) %}
+        {{ "echo x >> calls.txt; wc -l < calls.txt" | shell }}
+        {% endfor %}
+        {{ "echo x >> calls.txt; wc -l < calls.txt" | shell(cache=False) }}"""))
+
+    yasha_cli('template.j2')
+
+    assert Path('template').read_text().split() == ['1', '1', '1', '2']
+
+
+def test_shell_cache_is_cleared_between_runs(with_tmp_path):
+    Path('template.j2').write_text('{{ "echo x >> calls.txt; wc -l < calls.txt" | shell }}')
+
+    yasha_cli('template.j2')
+    yasha_cli('template.j2')
+
+    assert Path('template').read_text() == '2'
+
+
+def barrier_command(name, names):
+    "A command which waits until the commands of all `names` have started, so that it only finishes if they run concurrently"
+    others = ' && '.join(f'[ -e {other}.started ]' for other in names)
+    return f'touch {name}.started; until {others}; do sleep 0.01; done; echo {name}'
+
+
+def test_prefetch(with_tmp_path):
+    cache = ShellCache()
+    cmds = [barrier_command(i, (1, 2, 3)) for i in (1, 2, 3)]
+    cache.prefetch(cmds, timeout=10)
+    # Run one after the other, the first command would time out
+    assert [cache.shell(cmd, timeout=10) for cmd in cmds] == ['1', '2', '3']
+
+
+def test_prefetch_filter(with_tmp_path):
+    Path('template.j2').write_text(wrap("""
+        {{ ["echo foo", "echo bar"] | prefetch }}
+        {{ "echo foo" | shell }} {{ "echo bar" | shell }}"""))
+
+    yasha_cli('template.j2')
+
+    assert Path('template').read_text().strip() == 'foo bar'
+
+
+def test_shell_with_async_support(with_tmp_path):
+    Path('template.j2').write_text(wrap("""
+        {% set r = "uname" | subprocess %}
+        {{ "uname" | shell }} {{ r.stdout.decode().strip() }} {{ "foo" | greet }}"""))
+    Path('template.py').write_text(wrap("""
+        async def filter_greet(name):
+            return 'hello ' + name
+        """))
+
+    yasha_cli('--enable-async template.j2')
+
+    assert Path('template').read_text().strip() == f'{os.uname().sysname} {os.uname().sysname} hello foo'
+
+
+def test_pure_filter(with_tmp_path, capfd):
+    Path('template.j2').write_text('{% for x in [1, 2, 1, 1, True] %}{{ x|double }}{% endfor %} {{ x|double }}')
+    Path('template.py').write_text(wrap("""
+        from yasha.filters import pure
+
+        @pure
+        def filter_double(x):
+            return x * 2
+        """))
+
+    yasha_cli('--profile --profile-format json --x=a template.j2')
+
+    _, err = capfd.readouterr()
+    assert Path('template').read_text() == '24222 aa'
+    # True == 1, but it doesn't give the same result
+    assert json.loads(err)['memo']['double'] == {'hits': 2, 'misses': 4}
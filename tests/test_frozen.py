@@ -0,0 +1,74 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from yasha.frozen import FrozenDict, freeze
+from yasha.main import Yasha
+from tests.conftest import wrap
+
+import json
+import pickle
+from copy import deepcopy
+from pathlib import Path
+
+import pytest
+
+
+def test_freeze():
+    data = freeze({'a': [1, {'b': {2, 3}}], 'c': 'd'})
+
+    assert data == {'a': (1, {'b': frozenset({2, 3})}), 'c': 'd'}
+    assert isinstance(data, FrozenDict)
+    assert isinstance(data['a'][1], FrozenDict)
+    assert hash(data) == hash(freeze({'c': 'd', 'a': [1, {'b': {3, 2}}]}))
+    assert {data: 'memoized'}[freeze({'a': [1, {'b': {2, 3}}], 'c': 'd'})] == 'memoized'
+
+    with pytest.raises(TypeError):
+        data['c'] = 'e'
+    with pytest.raises(TypeError):
+        data.update(c='e')
+    with pytest.raises(TypeError):
+        data['a'][1].pop('b')
+
+
+def test_frozen_dict_copy_pickle_and_json():
+    data = freeze({'a': [1, 2], 'b': {'c': None}})
+
+    assert pickle.loads(pickle.dumps(data)) == data
+    assert isinstance(deepcopy(data), FrozenDict)
+    assert json.loads(json.dumps(data)) == {'a': [1, 2], 'b': {'c': None}}
+
+
+def test_yasha_freeze_variables(with_tmp_path):
+    Path('data.yaml').write_text(wrap("""
+        items:
+          - name: foo
+          - name: bar
+        """))
+    y = Yasha(variable_files=['data.yaml'], inline_variables={'extra': [1, 2]}, freeze_variables=True)
+
+    assert isinstance(y.env.globals['items'], tuple)
+    assert isinstance(y.env.globals['items'][0], FrozenDict)
+    assert y.env.globals['extra'] == (1, 2)
+    assert y.render_template('{% for i in items %}{{ i.name }} {% endfor %}{{ items|tojson }}') == \
+        'foo bar [{"name": "foo"}, {"name": "bar"}]'
@@ -0,0 +1,177 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from tests.conftest import yasha_cli
+from yasha.jobserver import Jobserver, get_jobserver
+
+
+@pytest.fixture
+def jobserver_pipe():
+    "A jobserver pipe holding 2 tokens, like the one of make -j3"
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'++')
+    yield read_fd, write_fd
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def tokens_left(read_fd):
+    os.set_blocking(read_fd, False)
+    try:
+        tokens = os.read(read_fd, 100)
+    except BlockingIOError:
+        tokens = b''
+    os.set_blocking(read_fd, True)
+    return tokens
+
+
+def test_makeflags(jobserver_pipe, tmp_path):
+    read_fd, write_fd = jobserver_pipe
+    for makeflags in (f' -j3 --jobserver-auth={read_fd},{write_fd}', f'-j --jobserver-fds={read_fd},{write_fd} -j'):
+        jobserver = Jobserver.from_makeflags(makeflags)
+        assert (jobserver.read_fd, jobserver.write_fd) == (read_fd, write_fd)
+
+    fifo = tmp_path / 'jobserver'
+    os.mkfifo(str(fifo))
+    jobserver = Jobserver.from_makeflags(f'-j3 --jobserver-auth=fifo:{fifo}')
+    assert jobserver.read_fd == jobserver.write_fd
+    os.close(jobserver.read_fd)
+
+    assert Jobserver.from_makeflags('') is None
+    assert Jobserver.from_makeflags('-k -- FOO=bar') is None
+    assert Jobserver.from_makeflags('--jobserver-auth=-2,-2') is None
+    assert Jobserver.from_makeflags('--jobserver-auth=1000,1001') is None  # closed by make
+
+    # Closed by make, and reused for other files since
+    with open(tmp_path / 'a', 'wb+') as a, open(tmp_path / 'b', 'wb+') as b:
+        assert Jobserver.from_makeflags(f'--jobserver-auth={a.fileno()},{b.fileno()}') is None
+        assert Jobserver.from_makeflags(f'--jobserver-auth={read_fd},{b.fileno()}') is None
+    assert Jobserver.from_makeflags(f'--jobserver-auth=fifo:{tmp_path / "a"}') is None
+
+
+def test_job_slots(jobserver_pipe):
+    "No more jobs run at once than the implicit job slot plus the tokens of the jobserver, which are all given back"
+    read_fd, write_fd = jobserver_pipe
+    jobserver = Jobserver(read_fd, write_fd)
+    running = []
+    most_running = 0
+    lock = threading.Lock()
+
+    def job(i):
+        nonlocal most_running
+        with jobserver.job():
+            with lock:
+                running.append(i)
+                most_running = max(most_running, len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(i)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(job, range(40)))
+
+    assert most_running == 3
+    assert tokens_left(read_fd) == b'++'
+
+
+def test_job_without_tokens(tmp_path):
+    "Jobs run without tokens once the jobserver can't be read or written"
+    path = tmp_path / 'jobserver'
+    path.write_bytes(b'')
+    read_fd = os.open(str(path), os.O_WRONLY)
+    write_fd = os.open(str(path), os.O_RDONLY)
+    try:
+        jobserver = Jobserver(read_fd, write_fd)
+        ran = []
+        with jobserver.job():
+            with jobserver.job():
+                ran.append(1)
+        assert ran == [1]
+        assert jobserver.failed
+
+        jobserver = Jobserver(write_fd, read_fd)
+        with jobserver.job():
+            with jobserver.job():
+                ran.append(2)
+        assert ran == [1, 2]
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def count_jobs(monkeypatch):
+    "Counts the jobs run by any jobserver"
+    jobs = []
+    job = Jobserver.job
+
+    def counted_job(self):
+        jobs.append(self)
+        return job(self)
+    monkeypatch.setattr(Jobserver, 'job', counted_job)
+    return jobs
+
+
+def test_foreach_with_jobserver(with_tmp_path, jobserver_pipe, monkeypatch):
+    read_fd, write_fd = jobserver_pipe
+    monkeypatch.setenv('MAKEFLAGS', f'-j3 --jobserver-auth={read_fd},{write_fd}')
+    jobs = count_jobs(monkeypatch)
+    get_jobserver.cache_clear()
+    try:
+        Path('template.j2').write_text('{{ item }}')
+        yasha_cli(['--foreach', 'items', '--items=a,b,c,d,e,f', '-j', '2', '-o', 'out/{index}', 'template.j2'])
+    finally:
+        get_jobserver.cache_clear()
+
+    assert [Path(f'out/{i}').read_text() for i in range(6)] == list('abcdef')
+    assert len(jobs) == 6
+    assert tokens_left(read_fd) == b'++'
+
+
+def test_foreach_with_jobserver_files(with_tmp_path, monkeypatch):
+    "Job server file descriptors which make didn't share, and which now refer to files, are left alone"
+    Path('template.j2').write_text('{{ item }}')
+    Path('a').write_text('{{ unchanged }}')
+    Path('b').write_text('')
+    jobs = count_jobs(monkeypatch)
+    with open('a', 'rb+') as a, open('b', 'rb+') as b:
+        monkeypatch.setenv('MAKEFLAGS', f'-j3 --jobserver-auth={a.fileno()},{b.fileno()}')
+        get_jobserver.cache_clear()
+        try:
+            yasha_cli(['--foreach', 'items', '--items=a,b,c,d,e,f', '-j', '2', '-o', 'out/{index}', 'template.j2'])
+            assert get_jobserver() is None
+        finally:
+            get_jobserver.cache_clear()
+
+    assert [Path(f'out/{i}').read_text() for i in range(6)] == list('abcdef')
+    assert jobs == []
+    assert Path('a').read_text() == '{{ unchanged }}'
+    assert Path('b').read_text() == ''
@@ -0,0 +1,71 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from pathlib import Path
+
+from yasha.lazy import LazyVariables, scan_variable_keys
+from yasha.parsers import PARSERS, make_xml_parser
+
+
+def test_scan_yaml_keys(with_tmp_path):
+    file = Path('variables.yaml')
+    file.write_text('---\n# comment\nfoo: 1\n"bar baz": |\n  text\nlist:\n- 1\n')
+    assert scan_variable_keys(file, PARSERS['.yaml']) == {'foo', 'bar baz', 'list'}
+    file.write_text('{foo: 1}\n')
+    assert scan_variable_keys(file, PARSERS['.yaml']) is None
+
+
+def test_scan_toml_keys(with_tmp_path):
+    file = Path('variables.toml')
+    file.write_text('foo = 1\ntext = """\n[not_a_table]\n"""\nmatrix = [\n  [1],\n]\n[bar.baz]\nqux = 2\n[[items]]\nname = "a"\n')
+    assert scan_variable_keys(file, PARSERS['.toml']) == {'foo', 'text', 'matrix', 'bar', 'items'}
+
+
+def test_scan_other_keys(with_tmp_path):
+    Path('variables.ini').write_text('[section]\nkey = value\n')
+    Path('variables.xml').write_text('<?xml version="1.0"?>\n<!-- comment -->\n<root><a/></root>')
+    Path('variables.json').write_text('{"foo": 1}')
+    assert scan_variable_keys(Path('variables.ini'), PARSERS['.ini']) == {'DEFAULT', 'section'}
+    assert scan_variable_keys(Path('variables.xml'), PARSERS['.xml']) == {'root'}
+    assert scan_variable_keys(Path('variables.xml'), make_xml_parser('root/a')) == {'root'}
+    assert scan_variable_keys(Path('variables.csv'), PARSERS['.csv']) == {'variables'}
+    assert scan_variable_keys(Path('variables.json'), PARSERS['.json']) is None
+
+
+def test_lazy_variables():
+    loaded = []
+
+    def load(file):
+        loaded.append(file)
+        return {'a': str(file)} if file == Path('first') else {'b': str(file)}
+
+    variables = LazyVariables()
+    variables.add_file(Path('first'), load, ['a'])
+    variables.add_file(Path('second'), load, ['a', 'b'])  # 'a' turns out not to be in the second file
+
+    assert variables.restrict(['b'])['b'] == 'second'
+    assert loaded == [Path('second')]
+    assert variables['a'] == 'first'
+    assert dict(variables) == {'a': 'first', 'b': 'second'}
+    assert 'c' not in variables.restrict(['c'])
@@ -24,10 +24,17 @@ THE SOFTWARE.
 
 from jinja2.environment import Template
 from yasha.main import Yasha, find_template_companion_files
+from yasha.util import DirectoryCache
 from tests.conftest import wrap
 
+import asyncio
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import pytest
+
 
 def test_template_companion_files(with_tmp_path):
     test_data = wrap("""
@@ -77,6 +84,33 @@ def test_template_companion_files(with_tmp_path):
     assert extension_files.isdisjoint(expected_data_files)
     
 
+def test_template_companion_files_directory_cache(with_tmp_path):
+    "Sibling templates should reuse the directory listings of a shared cache"
+    Path('nested').mkdir()
+    for path in ('nested/foo.j2', 'nested/bar.j2', 'nested/foo.json', 'foo.yaml', 'bar.yaml'):
+        Path(path).touch()
+    cache = DirectoryCache()
+
+    assert find_template_companion_files(Path('nested/foo.j2'), ['.json', '.yaml'], Path('.'), cache) == {Path('nested/foo.json'), Path('foo.yaml')}
+    assert find_template_companion_files(Path('nested/bar.j2'), ['.json', '.yaml'], Path('.'), cache) == {Path('bar.yaml')}
+    assert cache.candidates('nested', 'foo') == ['foo.j2', 'foo.json']
+
+    # Listings are refreshed once their directory changes
+    listing = cache.prefixes('nested')
+    assert cache.prefixes('nested') is listing
+    Path('nested/bar.json').touch()
+    os.utime('nested', ns=(0, 0))  # a different mtime, whatever the resolution of the filesystem
+    assert find_template_companion_files(Path('nested/bar.j2'), ['.json', '.yaml'], Path('.'), cache) == {Path('nested/bar.json'), Path('bar.yaml')}
+
+
+def test_template_companion_files_added(with_tmp_path):
+    "Without a cache, companion files added between lookups are found"
+    Path('foo.j2').touch()
+    assert find_template_companion_files(Path('foo.j2'), ['.json'], Path('.')) == set()
+    Path('foo.json').touch()
+    assert find_template_companion_files(Path('foo.j2'), ['.json'], Path('.')) == {Path('foo.json')}
+
+
 def test_yasha_datafile_loading(with_tmp_path):
     "Variables in data files should be merged together. conflicting variables in later data files should overwrite those variables from previous data files"
     Path('data.json').write_text('{"key1": "value1","key2": {"subkey1": "value"},"key3": "value"}')
@@ -276,4 +310,302 @@ def test_yasha_extension_file_isolation(with_tmp_path):
     assert y5.env.variable_start_string == '<<'
     assert y5.env.variable_end_string == '>>'
     assert y5.env.comment_start_string == '<#'
-    assert y5.env.comment_end_string == '#>'
\ No newline at end of file
+    assert y5.env.comment_end_string == '#>'
+
+def test_yasha_profile(with_tmp_path):
+    Path('template.j2').write_text('{% for x in range(3) %}{{ "echo %s"|format(x)|shell }}{{ foo|upper }}{% endfor %}')
+    Path('template.json').write_text('{"foo": "bar"}')
+    Path('template.py').write_text('def filter_upper(s):\n    return s.upper()\n')
+
+    y = Yasha(profile=True)
+    assert y.render_template(Path('template.j2')) == '0BAR1BAR2BAR'
+
+    report = y.profiler.as_dict()
+    assert {'find companion files', 'load extensions template.py', 'parse template.json', 'compile', 'render'} <= report['phases'].keys()
+    assert report['filters']['shell']['calls'] == 3
+    assert report['filters']['upper']['calls'] == 3
+    assert 'shell' in y.profiler.report()
+
+
+def test_yasha_trace(with_tmp_path):
+    Path('template.j2').write_text('{{ foo|upper }}')
+    Path('template.json').write_text('{"foo": "bar"}')
+
+    y = Yasha(trace=True)
+    with open('template', 'wb') as output:
+        y.render_template(Path('template.j2'), output=output)
+    y.profiler.write_trace('trace.json')
+
+    events = json.loads(Path('trace.json').read_text())['traceEvents']
+    assert events[0]['ph'] == 'M'
+    categories = {(event['name'], event['cat']) for event in events[1:]}
+    assert {('parse template.json', 'phase'), ('render', 'phase'), ('upper', 'filter'), ('write output', 'yasha')} <= categories
+    assert Path('template').read_text() == 'BAR'
+
+
+def test_yasha_profile_disabled(with_tmp_path):
+    y = Yasha()
+    assert y.render_template('{{ "echo foo"|shell }}') == 'foo'
+    assert y.profiler.as_dict() == {'phases': {}, 'filters': {}, 'memo': {}}
+
+
+def test_yasha_render_template_async(with_tmp_path):
+    # Each command waits until all of them have started, so the renders only finish if they run concurrently
+    barrier = 'touch %s.started; until [ -e foo.started ] && [ -e bar.started ] && [ -e baz.started ]; do sleep 0.01; done; echo %s'
+    Path('template.j2').write_text('{{ barrier|format(name, name)|shell(timeout=10) }} {{ name|greet }}')
+    Path('template.py').write_text(wrap("""
+        import asyncio
+
+        async def filter_greet(name):
+            await asyncio.sleep(0)
+            return 'hello ' + name
+        """))
+    y = Yasha(enable_async=True, inline_variables={'barrier': barrier})
+
+    async def render_all():
+        return await asyncio.gather(*(
+            y.render_template_async(f'{{% set name = "{name}" %}}' + Path('template.j2').read_text())
+            for name in ('foo', 'bar', 'baz')))
+
+    y._load_extensions_file(Path('template.py'))
+    assert asyncio.run(render_all()) == ['foo hello foo', 'bar hello bar', 'baz hello baz']
+
+
+def test_yasha_shell_cache_per_render(with_tmp_path):
+    "Shell commands run once per render, not once per Yasha instance"
+    y = Yasha()
+    template = '{{ "echo x >> calls.txt; wc -l < calls.txt"|shell }}'
+    assert y.render_template(template + template) == '11'
+    assert y.render_template(template) == '2'
+
+
+def test_yasha_async_filters_without_async_support(with_tmp_path):
+    Path('template.j2').write_text('{{ "foo"|greet }}')
+    Path('template.py').write_text(wrap("""
+        async def filter_greet(name):
+            return 'hello ' + name
+        """))
+    y = Yasha()
+    assert y.render_template(Path('template.j2')) == 'hello foo'
+    with pytest.raises(RuntimeError):
+        asyncio.run(y.render_template_async(Path('template.j2')))
+
+
+def test_yasha_async_filters_without_async_support_in_event_loop(with_tmp_path):
+    "The synchronous render runs async filters even when called from a coroutine"
+    Path('template.j2').write_text('{{ "foo"|greet }}')
+    Path('template.py').write_text(wrap("""
+        async def filter_greet(name):
+            return 'hello ' + name
+        """))
+    y = Yasha()
+
+    async def render():
+        return y.render_template(Path('template.j2'))
+
+    assert asyncio.run(render()) == 'hello foo'
+
+
+def test_yasha_isolated_env_globals(with_tmp_path):
+    Path('template.j2').write_text('{{ key1 }} {{ key2.subkey }}')
+    Path('data.json').write_text('{"key1": "value1", "key2": {"subkey": "value"}}')
+    y = Yasha(variable_files=['data.json'])
+
+    env = y._make_isolated_env_for_template(Path('template.j2'))
+    env.globals.update({'key1': 'overridden', 'key3': 'new'})
+
+    assert env.from_string('{{ key1 }} {{ key2.subkey }} {{ key3 }}').render() == 'overridden value new'
+    assert y.env.globals['key1'] == 'value1'
+    assert 'key3' not in y.env.globals
+    assert env.globals['key2'] is y.env.globals['key2']  # data is shared, not copied
+
+
+def test_yasha_render_template_isolation(with_tmp_path):
+    "Rendering a template shouldn't leave its companion files' data, extensions or directory behind in the Yasha instance"
+    Path('sub').mkdir()
+    Path('sub/template.j2').write_text('{{ foo|shout }}')
+    Path('sub/template.json').write_text('{"foo": "bar"}')
+    Path('sub/template.py').write_text('def filter_shout(s):\n    return s.upper()\n')
+    y = Yasha()
+
+    assert y.render_template(Path('sub/template.j2'), jinja_env_overrides={'variable_start_string': '{{'}) == 'BAR'
+    assert 'foo' not in y.env.globals
+    assert 'shout' not in y.env.filters
+    assert y.env.loader.searchpath == []
+
+
+def test_yasha_concurrent_renders(with_tmp_path):
+    "A single Yasha instance should render many templates from many threads at once"
+    for i in range(8):
+        Path(f'dir{i}').mkdir()
+        Path(f'dir{i}/template.j2').write_text('{% include "partial.j2" %} {{ value|tag }} {{ shared }}')
+        Path(f'dir{i}/partial.j2').write_text(f'partial{i}')
+        Path(f'dir{i}/template.json').write_text(f'{{"value": {i}}}')
+        Path(f'dir{i}/template.py').write_text(f'def filter_tag(v):\n    return "tag{i}-" + str(v)\n')
+    y = Yasha(inline_variables={'shared': 'common'})
+
+    def render(i):
+        return y.render_template(Path(f'dir{i % 8}/template.j2'))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(render, range(200)))
+
+    assert results == [f'partial{i % 8} tag{i % 8}-{i % 8} common' for i in range(200)]
+    assert y.env.loader.searchpath == []
+    assert 'value' not in y.env.globals
+
+
+def test_yasha_template_cache(with_tmp_path):
+    "File templates are compiled once, and recompiled when the template or one of its companion files changes"
+    template = Path('template.j2')
+    template.write_text('{{ foo }}')
+    Path('template.json').write_text('{"foo": "bar"}')
+    y = Yasha()
+
+    assert y.render_template(template) == 'bar'
+    assert y.render_template(template) == 'bar'
+    assert y.template_cache_info() == (1, 1, 64, 1)
+
+    # Modify a companion file
+    Path('template.json').write_text('{"foo": "baz!"}')
+    assert y.render_template(template) == 'baz!'
+    assert y.template_cache_info().misses == 2
+
+    # Modify the template
+    template.write_text('foo is {{ foo }}')
+    assert y.render_template(template) == 'foo is baz!'
+    assert y.template_cache_info().misses == 3
+
+    # Different rendering options are cached separately
+    assert y.render_template(template, find_data_files=False) == 'foo is '
+    assert y.template_cache_info() == (1, 4, 64, 2)
+
+
+def test_yasha_template_cache_disabled(with_tmp_path):
+    template = Path('template.j2')
+    template.write_text('{{ foo }}')
+    y = Yasha(inline_variables={'foo': 'bar'}, template_cache_size=0)
+
+    assert y.render_template(template) == 'bar'
+    assert y.render_template(template) == 'bar'
+    assert y.template_cache_info() == (0, 0, 0, 0)
+
+
+def test_yasha_render_template_variables(with_tmp_path):
+    "Per-render variables override the global variables, without modifying them"
+    template = Path('template.j2')
+    template.write_text('{{ foo }} {{ bar }}')
+    y = Yasha(inline_variables={'foo': 'global', 'bar': 'global'})
+
+    assert y.render_template(template, variables={'foo': 'local'}) == 'local global'
+    assert y.render_template(template) == 'global global'
+    assert y.template_cache_info().hits == 1
+
+
+def test_yasha_render_each(with_tmp_path):
+    "A template is compiled once and rendered into one file per context"
+    template = Path('template.j2')
+    template.write_text('{{ greeting }} {{ name }}')
+    y = Yasha(inline_variables={'greeting': 'hello'})
+    contexts = ({'name': name} for name in ['foo', 'bar', 'baz'])
+
+    outputs = y.render_each(template, contexts, 'out/{index}-{name}.txt', workers=2)
+
+    assert outputs == [Path('out/0-foo.txt'), Path('out/1-bar.txt'), Path('out/2-baz.txt')]
+    assert [p.read_text() for p in outputs] == ['hello foo', 'hello bar', 'hello baz']
+    assert y.template_cache_info().misses == 1
+
+
+def test_yasha_render_each_bounded(with_tmp_path):
+    "Contexts are pulled from a generator only a few renders ahead of the pool"
+    pulled = []
+    ahead = []
+
+    def contexts():
+        for index in range(50):
+            pulled.append(index)
+            yield {'name': index}
+
+    def record(name):
+        ahead.append(len(pulled) - name)
+        return ''
+
+    template = Path('template.j2')
+    template.write_text('{{ record(name) }}{{ name }}')
+    y = Yasha(inline_variables={'record': record})
+
+    outputs = y.render_each(template, contexts(), 'out/{index}.txt', workers=2)
+
+    assert len(outputs) == 50
+    assert max(ahead) <= 2 * 2 + 1
+
+
+def test_yasha_lazy_variables(with_tmp_path):
+    "Data files are only parsed once a template refers to one of their variables"
+    Path('board.yaml').write_text('board: nrf51\nflash:\n  size: 256\n')
+    Path('unused.yaml').write_text('unused: [\n')  # broken, but never parsed
+    Path('template.toml').write_text('extra = 3\n')
+    Path('include.j2').write_text('{{ extra }}')
+    template = Path('template.j2')
+    template.write_text('{{ board }} {{ flash.size }} {{ greeting }} {% include "include.j2" %}')
+    y = Yasha(variable_files=['board.yaml', 'unused.yaml'], inline_variables={'greeting': 'hi'}, lazy_variables=True)
+
+    assert y.lazy_variables.files(loaded=True) == []
+    assert y.render_template(template) == 'nrf51 256 hi 3'
+    assert y.lazy_variables.files(loaded=True) == [Path('board.yaml')]
+    # Inline variables override the data files
+    assert Yasha(variable_files=['board.yaml'], inline_variables={'board': 'x'}, lazy_variables=True).render_template('{{ board }}') == 'x'
+
+
+def test_yasha_lazy_variables_dynamic_include(with_tmp_path):
+    "Every variable is visible to templates whose includes are only known at render time"
+    Path('board.yaml').write_text('board: nrf51\n')
+    Path('include.j2').write_text('{{ board }}')
+    y = Yasha(variable_files=['board.yaml'], inline_variables={'name': 'include.j2'}, template_lookup_paths=['.'], 
+              lazy_variables=True)
+
+    assert y.render_template('{% include name %}') == 'nrf51'
+
+
+def test_yasha_lazy_variables_extension_globals(with_tmp_path):
+    "Globals installed by the extension file of a template are visible, along with the variables it refers to"
+    Path('template.yaml').write_text('foo: bar\n')
+    Path('template.py').write_text(wrap("""
+        import jinja2.ext
+
+        class GreetExtension(jinja2.ext.Extension):
+            def __init__(self, environment):
+                super().__init__(environment)
+                environment.globals['greet'] = lambda name: 'hi ' + name
+        """))
+    Path('template.j2').write_text('{{ greet(foo) }}')
+
+    assert Yasha(lazy_variables=True).render_template(Path('template.j2')) == 'hi bar'
+
+
+def test_yasha_lazy_variables_environment_filter(with_tmp_path):
+    "Every variable is visible to templates using a filter which gets the environment, and can read its globals"
+    Path('board.yaml').write_text('board: nrf51\n')
+    Path('template.py').write_text(wrap("""
+        from jinja2 import pass_environment
+
+        @pass_environment
+        def filter_lookup(environment, name):
+            return environment.globals[name]
+        """))
+    Path('template.j2').write_text('{{ "board"|lookup }}')
+
+    assert Yasha(variable_files=['board.yaml'], lazy_variables=True).render_template(Path('template.j2')) == 'nrf51'
+
+
+def test_yasha_precompiled(with_tmp_path):
+    Path('templates').mkdir()
+    Path('templates/template.j2').write_text('{{ greeting }} {% include "include.j2" %}')
+    Path('templates/include.j2').write_text('{{ name }}')
+    Path('templates/template.yaml').write_text('greeting: hello')
+    names = Yasha().compile_templates([Path('templates/template.j2'), Path('templates/include.j2')], 'compiled.zip', zip='stored')
+    assert names == ['templates/include.j2', 'templates/template.j2']
+
+    Path('templates/template.j2').write_text('modified')
+    y = Yasha(precompiled='compiled.zip', inline_variables={'name': 'world'}, lazy_variables=True)
+    assert y.render_template(Path('templates/template.j2')) == 'hello world'
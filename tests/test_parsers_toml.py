@@ -0,0 +1,88 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import datetime
+from io import BytesIO
+
+import pytest
+
+from yasha.parsers import TOML_BACKENDS, import_toml_backend, parse_toml
+
+
+TOML = b'''
+title = "Example"
+count = 42
+ratio = 0.5
+enabled = true
+tags = ["a", "b"]
+moment = 2020-08-23T10:00:00+02:00
+
+[owner]
+name = "Foo"
+
+[[items]]
+name = "x"
+
+[[items]]
+name = "y"
+'''
+
+
+def parse_with(backend):
+    try:
+        toml = import_toml_backend((backend,))
+    except ImportError:
+        pytest.skip(f'{backend} is not installed')
+    return toml.load(BytesIO(TOML))
+
+
+@pytest.mark.parametrize('backend', TOML_BACKENDS)
+def test_toml_backends_agree(backend):
+    variables = parse_with(backend)
+    assert variables == {
+        'title': 'Example',
+        'count': 42,
+        'ratio': 0.5,
+        'enabled': True,
+        'tags': ['a', 'b'],
+        'moment': datetime.datetime(2020, 8, 23, 8, 0, tzinfo=datetime.timezone.utc),
+        'owner': {'name': 'Foo'},
+        'items': [{'name': 'x'}, {'name': 'y'}],
+    }
+    assert type(variables['count']) is int
+    assert type(variables['tags']) is list
+    assert type(variables['owner']) is dict
+
+
+def test_toml_backend_preference():
+    assert import_toml_backend().__name__ in TOML_BACKENDS
+    assert import_toml_backend(('no_such_toml_module', 'pytoml')).__name__ == 'pytoml'
+    with pytest.raises(ImportError):
+        import_toml_backend(('no_such_toml_module',))
+
+
+def test_parse_toml():
+    file = BytesIO(TOML)
+    file.name = 'variables.toml'
+    assert parse_toml(file)['owner'] == {'name': 'Foo'}
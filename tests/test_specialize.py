@@ -0,0 +1,96 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from pathlib import Path
+
+from jinja2 import Environment, nodes
+
+from yasha.main import Yasha
+from yasha.precompiled import PrecompiledLoader
+from yasha.specialize import specialize
+from tests.conftest import yasha_cli
+
+
+class Device:
+    name = 'nrf51'
+
+
+def specialized(source: str, **variables):
+    env = Environment()
+    template, remaining = specialize(env, env.parse(source), variables)
+    return env.from_string(template), template, remaining
+
+
+def test_specialize_folds_and_prunes():
+    source = '{% if debug %}debug {% elif fields and x %}fields {% else %}none {% endif %}' \
+        '{{ device.name|upper }} {{ "on" if debug or x else "off" }} {{ x }}'
+    template, ast, remaining = specialized(source, debug=False, fields=True, device=Device())
+    assert template.render(x=1) == Environment().from_string(source).render(x=1, debug=False, fields=True, device=Device())
+    assert template.render(x=0) == 'none NRF51 off 0'
+    assert {n.name for n in ast.find_all(nodes.Name)} == {'x'}
+    assert remaining == set()
+
+
+def test_specialize_keeps_objects_and_assigned_names():
+    source = '{% set FLAG = False %}{% for item in items %}{% if FLAG %}!{% endif %}{{ item }}{% endfor %}{{ device }}'
+    template, ast, remaining = specialized(source, item='static', items=[1, 2], device=Device())
+    # The loop variable isn't the static one, and the device can't be written into a template
+    assert template.render(device='dev') == '12dev'
+    assert not any(ast.find_all(nodes.If))
+    assert remaining == {'device'}
+
+
+def test_specialize_templates(with_tmp_path):
+    Path('template.j2').write_text('{% if config.debug %}{{ "debug"|shout }} {% endif %}{{ config.name }} {{ build }}')
+    Path('template.yaml').write_text('config: {debug: true, name: foo}')
+    Path('template.py').write_text('def filter_shout(s):\n    return s.upper()\n')
+
+    assert Yasha().specialize_templates([Path('template.j2')], 'specialized') == {'template.j2': set()}
+    Path('template.yaml').write_text('config: {debug: false, name: bar}')
+    # The static variables were written into the template
+    env = Yasha(yasha_extensions_files=['template.py']).env
+    assert PrecompiledLoader('specialized').load_file(env, 'template.j2').render(build=2) == 'DEBUG foo 2'
+
+
+def test_specialize_cli(with_tmp_path, capfd):
+    Path('template.j2').write_text('{% if NO_FIELDS %}none{% else %}{{ fields|join(",") }}{% endif %} {{ build }}')
+
+    yasha_cli(['specialize', '--NO_FIELDS=False', '--fields=[1, 2]', '-o', 'specialized.zip', 'template.j2'])
+    yasha_cli(['--precompiled', 'specialized.zip', '--build=3', 'template.j2'])
+    assert Path('template').read_text() == '1,2 3'
+    _, err = capfd.readouterr()
+    assert err == ''
+
+
+def test_specialize_cli_include(with_tmp_path):
+    "The templates referenced by a specialized template are compiled along with it, as they are"
+    Path('template.j2').write_text('{% if DEBUG %}D{% endif %}{% include "inc.j2" %}')
+    Path('inc.j2').write_text('{% import "macros.j2" as m %}{{ m.name(DEBUG) }}')
+    Path('macros.j2').write_text('{% macro name(debug) %}{{ "debug" if debug else "release" }}{% endmacro %}')
+
+    yasha_cli(['specialize', '--DEBUG=True', '-o', 'out', 'template.j2'])
+    Path('inc.j2').write_text('modified')
+    yasha_cli(['--precompiled', 'out', '--DEBUG=False', 'template.j2'])
+    # Only the top template was specialized
+    assert Path('template').read_text() == 'Drelease'
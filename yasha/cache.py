@@ -0,0 +1,271 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import secrets
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Union
+
+from jinja2.utils import LRUCache
+
+try:
+    import fcntl
+except ImportError:  # Windows, where concurrent lookups may miss a count
+    fcntl = None  # type: ignore
+
+
+class OutputCache:
+    """A directory of rendered outputs, addressed by a digest of everything the render depends on.
+
+    Entries are written atomically, so the directory can be shared by concurrent yasha processes, e.g. CI
+    workers on a common filesystem. The number of hits and misses is kept in the `stats/hits` and
+    `stats/misses` files, which each process updates under a file lock after a lookup, unless `stats` is False.
+    """
+
+    def __init__(self, directory: Union[str, Path], hardlink: bool = False, stats: bool = True):
+        self.directory = Path(directory)
+        self.hardlink = hardlink
+        self.count_lookups = stats
+
+    @staticmethod
+    def key(inputs: Iterable[Union[str, bytes]]) -> str:
+        "Returns the digest of the render inputs, which can be strings or bytes"
+        digest = hashlib.sha256()
+        for value in inputs:
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            # Prefix every input with its length, so that the boundaries between inputs are part of the digest
+            digest.update(len(value).to_bytes(8, 'little'))
+            digest.update(value)
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.directory / key[:2] / key[2:]
+
+    def _count(self, name: str):
+        if not self.count_lookups:
+            return
+        stats = self.directory / 'stats'
+        stats.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(stats / name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)  # released when the file is closed
+            data = str(_read_count(fd) + 1).encode('ascii')
+            # The new count is never shorter than the previous one, so a crash never leaves a smaller count
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, data)
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+
+    def restore(self, key: str, output: Path) -> bool:
+        """Places the cached output of `key` at `output`, as a hard link if enabled and possible, or as a copy.
+        Returns False if there is no such entry."""
+        entry = self._entry(key)
+        if not entry.is_file():
+            self._count('misses')
+            return False
+        tmp = self._temporary(output.parent)
+        try:
+            if self.hardlink:
+                try:
+                    os.unlink(tmp)
+                    os.link(str(entry), tmp)
+                except OSError:
+                    shutil.copyfile(str(entry), tmp)
+            else:
+                shutil.copyfile(str(entry), tmp)
+            os.replace(tmp, str(output))
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self._count('hits')
+        return True
+
+    def load(self, key: str) -> Optional[bytes]:
+        "Returns the cached data of `key`, or None if there is no such entry"
+        try:
+            data = self._entry(key).read_bytes()
+        except OSError:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return data
+
+    def store(self, key: str, data: bytes):
+        "Adds the rendered output `data` to the cache"
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._temporary(entry.parent)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, str(entry))
+
+    @staticmethod
+    def _temporary(directory: Path) -> str:
+        """An empty file in `directory`, to be renamed over the final file once complete. 
+        Unlike tempfile.mkstemp, it gets the same permissions as any new file."""
+        if directory != Path():
+            directory.mkdir(parents=True, exist_ok=True)
+        name = str(directory / f'.yasha-{os.getpid()}-{secrets.token_hex(8)}')
+        os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        return name
+
+    def stats(self) -> Dict[str, int]:
+        def size(path):
+            try:
+                return path.stat().st_size
+            except OSError:
+                return 0
+
+        def count(path):
+            try:
+                fd = os.open(str(path), os.O_RDONLY)
+            except OSError:
+                return 0
+            try:
+                return _read_count(fd)
+            finally:
+                os.close(fd)
+        entries = [p for p in self.directory.glob('??/*') if p.is_file() and not p.name.startswith('.')]
+        return {
+            'entries': len(entries),
+            'bytes': sum(size(p) for p in entries),
+            'hits': count(self.directory / 'stats' / 'hits'),
+            'misses': count(self.directory / 'stats' / 'misses'),
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        rate = 100 * stats['hits'] / lookups if lookups else 0
+        return '\n'.join([
+            f"Cache directory  {self.directory}",
+            f"Entries          {stats['entries']}",
+            f"Size             {stats['bytes']} bytes",
+            f"Hits             {stats['hits']}",
+            f"Misses           {stats['misses']}",
+            f"Hit rate         {rate:.1f} %",
+        ])
+
+
+def _read_count(fd: int) -> int:
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = b''
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    # Caches written by earlier versions count with one byte per lookup
+    return int(data) if data.isdigit() else len(data)
+
+
+def write_atomically(path: Path, data: bytes):
+    """Replaces the file `path` with one holding `data`. Unlike writing into the existing file, this never
+    modifies a cache entry which `path` may be a hard link to."""
+    tmp = OutputCache._temporary(path.parent)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, str(path))
+
+
+def _reduce_object(obj):
+    # Only used to digest objects, never to unpickle them
+    return (type(obj), (), {k: v for k, v in vars(obj).items() if k != 'parent'})
+
+
+class _ObjectReducers(dict):
+    "A pickle dispatch table which pickles the instances of any class with a __dict__ by their attributes"
+
+    def __getitem__(self, cls):
+        if getattr(cls, '__dictoffset__', 0) and cls.__module__ != 'builtins':
+            return _reduce_object
+        raise KeyError(cls)
+
+    def get(self, cls, default=None):
+        try:
+            return self[cls]
+        except KeyError:
+            return default
+
+
+def fingerprint(value: Any) -> Optional[str]:
+    """Returns a digest of a template value, which is the same in every run for equal values, 
+    or None if the value can't be digested.
+
+    The value is pickled, objects by their attributes, except for the `parent` attributes through which 
+    the SVD model links each element to the one containing it, so that the digest of a peripheral only depends 
+    on the peripheral. Equal values which pickle differently, like dicts in a different order, or sets of strings 
+    in another run, get different digests: a fragment cache then misses, but never returns a wrong fragment.
+    """
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=4)
+    pickler.dispatch_table = _ObjectReducers()  # type: ignore
+    try:
+        pickler.dump(value)
+    except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+        return None  # e.g. functions defined in templates
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+class FragmentCache:
+    """Rendered template fragments, addressed by a digest of the template, the fragment and its dependencies.
+
+    Fragments are kept in an in-memory LRU cache and, if `directory` is given, in an `OutputCache` 
+    in that directory, so that they can be reused by later runs. Fragment lookups, which happen for every 
+    fragment of every render, aren't counted in the statistics of the directory.
+    """
+
+    def __init__(self, directory: Union[str, Path, None] = None, size: int = 1024):
+        self.memory = LRUCache(size)
+        self.disk = OutputCache(directory, stats=False) if directory else None
+
+    @staticmethod
+    def key(template: Optional[str], source: str, key: Any, dependencies: Iterable[Any], autoescape: bool = False) -> Optional[str]:
+        """The key of a fragment, or None if the fragment can't be cached because its key or dependencies can't be digested.
+        A fragment rendered with `autoescape` is escaped, so it's never reused by a render without, or the other way around."""
+        digest = fingerprint((key, list(dependencies)))
+        if digest is None:
+            return None
+        return OutputCache.key([template or '', source, digest, 'autoescape' if autoescape else ''])
+
+    def get(self, key: str) -> Optional[str]:
+        fragment = self.memory.get(key)
+        if fragment is None and self.disk is not None:
+            data = self.disk.load(key)
+            if data is not None:
+                fragment = self.memory[key] = data.decode('utf-8', errors='surrogatepass')
+        return fragment
+
+    def set(self, key: str, fragment: str):
+        self.memory[key] = fragment
+        if self.disk is not None:
+            self.disk.store(key, fragment.encode('utf-8', errors='surrogatepass'))
@@ -23,7 +23,187 @@ THE SOFTWARE.
 
 """
 
-from typing import List, Union
+import hashlib
+import os
+from typing import Any, Callable, List, Optional, Union
+
+from jinja2 import nodes, pass_eval_context
 from jinja2.ext import Extension
+from jinja2.async_utils import auto_to_list
+from jinja2.nodes import EvalContext
+from jinja2.runtime import LoopContext, Macro
+from markupsafe import Markup
+
+from yasha.cache import FragmentCache
+from yasha.filters import MEMO_SIZE, Memo
+from yasha.jobserver import get_jobserver
+from yasha.parallel import render_parallel
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the `cache` tag, which renders a fragment of a template once and reuses it afterwards:
+
+        {% cache "peripheral", peripheral %}
+        ...
+        {% endcache %}
+
+    The first argument is the key of the fragment, and the others are the values it depends on. A fragment
+    is reused when it is rendered again, in the same template, with the same key and equal dependencies.
+    Changing the fragment itself invalidates it, but not changing the templates it includes, or the filters
+    it uses. Fragments are kept in `environment.fragment_cache`, a `yasha.cache.FragmentCache` which is only
+    kept in memory unless it's replaced by one with a directory, to reuse fragments across runs.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        # The repr of the nodes of the fragment stands for its source
+        source = hashlib.sha256(repr(body).encode('utf-8')).hexdigest()
+        call = self.call_method('_render_fragment', [nodes.Const(parser.name), nodes.Const(source), nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    @pass_eval_context
+    def _render_fragment(self, eval_ctx: EvalContext, template: Optional[str], source: str, args: List[Any], caller: Callable):
+        cache: FragmentCache = self.environment.fragment_cache  # type: ignore
+        key = cache.key(template, source, args[0], args[1:], eval_ctx.autoescape)
+        if key is None:
+            return caller()
+        fragment = cache.get(key)
+        if fragment is not None:
+            # The fragment was escaped when it was rendered, if the template is autoescaped
+            return Markup(fragment) if eval_ctx.autoescape else fragment
+        if self.environment.is_async:
+            return self._store_async(cache, key, caller())
+        fragment = caller()
+        cache.set(key, str(fragment))
+        return fragment
+
+    async def _store_async(self, cache: FragmentCache, key: str, rendering):
+        fragment = await rendering
+        cache.set(key, str(fragment))
+        return fragment
+
+
+class MemoExtension(Extension):
+    """Adds the `memo` tag, which memoizes macros within each render:
+
+        {% memo macro register(r) %}
+        ...
+        {% endmacro %}
+
+    or, for several macros at once:
+
+        {% memo %}
+        {% macro register(r) %}...{% endmacro %}
+        {% macro field(f) %}...{% endmacro %}
+        {% endmemo %}
+
+    A memoized macro which is called again with the same arguments returns its previous output, so its
+    output must only depend on its arguments. Arguments which can't be hashed, like dicts and lists, are
+    compared by identity. Hits and misses are recorded by `environment.yasha_profiler`, if there is one.
+    """
+    tags = {'memo'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        if parser.stream.current.test('name:macro'):
+            body = [parser.parse_macro()]
+        else:
+            body = parser.parse_statements(('name:endmemo',), drop_needle=True)
+        output = []
+        for node in body:
+            output.append(node)
+            if isinstance(node, nodes.Macro):
+                call = self.call_method('_memoize_macro', [nodes.Name(node.name, 'load'), nodes.Const(node.name)])
+                output.append(nodes.Assign(nodes.Name(node.name, 'store'), call).set_lineno(lineno))
+        return output
+
+    def _memoize_macro(self, macro: Macro, name: str) -> Callable:
+        memo = Memo(f'macro {name}', MEMO_SIZE, getattr(self.environment, 'yasha_profiler', None))
+        call = memo.call_async if self.environment.is_async else memo.call
+
+        # A function rather than a Macro subclass, which jinja calls as fast as the macro itself
+        def memoized_macro(*args, **kwargs):
+            # The output of a {% call %} block depends on its body
+            if 'caller' in kwargs:
+                return macro(*args, **kwargs)
+            return call(macro, args, kwargs)
+        return memoized_macro
+
+
+class ParallelForExtension(Extension):
+    """Adds the `parallel` tag, which renders the iterations of a loop in several processes:
+
+        {% parallel for p in peripherals %}
+        ...
+        {% endfor %}
+
+    The iterations must be independent of each other, as each worker renders its own. Loops assigning
+    namespace attributes or running `{% do %}` statements, whose results would depend on the number of
+    workers, are rejected. Anything else they change, like a list with `append` in an expression, isn't
+    seen by the other iterations or the rest of the template, and `loop.changed` only compares with the
+    previous iteration of the same worker. Only the rendered
+    iterations must be picklable, as the workers are forked. The number of workers is
+    `environment.parallel_workers`, or the number of CPUs if it is None. Without `fork`, in async mode,
+    in a parallel loop and while other threads are running, the iterations are rendered one after the other.
+    """
+    tags = {'parallel'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(parallel_workers=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        loop = parser.parse_for()
+        if loop.else_ or loop.test or loop.recursive:
+            parser.fail('parallel for loops support neither else blocks, loop filters nor recursion', lineno)
+        for node in loop.find_all((nodes.NSRef, nodes.ExprStmt)):
+            # Changes made by an iteration are only seen by the iterations rendered by the same worker
+            parser.fail('parallel for loops can neither assign namespace attributes nor run do statements', node.lineno)
+        # The body becomes a caller(yasha_item, loop), which unpacks yasha_item into the loop target
+        body = [nodes.Assign(loop.target, nodes.Name('yasha_item', 'load')).set_lineno(lineno)] + loop.body
+        args = [nodes.Name('yasha_item', 'param'), nodes.Name('loop', 'param')]
+        call = self.call_method('_render_parallel', [loop.iter])
+        return nodes.CallBlock(call, args, [], body).set_lineno(lineno)
+
+    def _render_parallel(self, items, caller: Callable):
+        if self.environment.is_async:
+            return self._render_async(items, caller)
+        items = list(items)
+
+        def render_range(start: int, stop: int) -> List[str]:
+            rendered = []
+            for index, (item, loop) in enumerate(LoopContext(items, self.environment.undefined)):
+                if index >= stop:
+                    break
+                if index >= start:
+                    rendered.append(caller(item, loop))
+            return rendered
+
+        workers = self.environment.parallel_workers or os.cpu_count() or 1  # type: ignore
+        return self._join(render_parallel(render_range, len(items), workers, get_jobserver()))
+
+    async def _render_async(self, items, caller: Callable):
+        rendered = []
+        for item, loop in LoopContext(await auto_to_list(items), self.environment.undefined):
+            rendered.append(await caller(item, loop))
+        return self._join(rendered)
+
+    @staticmethod
+    def _join(rendered: List[str]) -> str:
+        # Iterations of an autoescaped template are Markup, which is already escaped
+        if rendered and isinstance(rendered[0], Markup):
+            return Markup('').join(rendered)
+        return ''.join(rendered)
+
 
-CLASSES: List[Union[str, Extension]] = []
+CLASSES: List[Union[str, Extension]] = [FragmentCacheExtension, MemoExtension, ParallelForExtension]
@@ -25,20 +25,31 @@ THE SOFTWARE.
 """
 
 import os
+import sys
 import encodings
 import ast
 import csv
+import glob
+import io
+import json
+import threading
+from concurrent.futures import Future
 from pathlib import Path
+from time import perf_counter
 
 import click
 from click import ClickException
-from jinja2.exceptions import UndefinedError as JinjaUndefinedError
+from jinja2.exceptions import TemplateNotFound, UndefinedError as JinjaUndefinedError
 
 from yasha import __version__, util, constants
 from yasha.tests import TESTS
-from yasha.filters import FILTERS
+from yasha.filters import FILTERS, ASYNC_FILTERS, SHELL_CACHE
 from yasha.classes import CLASSES
-from yasha.parsers import PARSERS
+from yasha.parsers import PARSERS, make_xml_parser
+from yasha.profiling import Profiler, span
+from yasha.jobserver import get_jobserver
+from yasha.cache import FragmentCache, OutputCache, write_atomically
+from yasha.precompiled import PrecompiledLoader, find_templates
 
 def print_version(ctx, param, value):
     if not value or ctx.resilient_parsing:
@@ -47,6 +58,69 @@ def print_version(ctx, param, value):
     ctx.exit()
 
 
+def print_cmake_module_path(ctx, param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    click.echo(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cmake'))
+    ctx.exit()
+
+
+def print_cache_stats(ctx, param, value):
+    """Prints the statistics of the output cache and exits. Both --cache-stats and --cache-dir are eager,
+    so this runs as soon as both of them have been processed, whatever their order on the command line."""
+    if ctx.resilient_parsing:
+        return value
+    if param.name == 'cache_stats':
+        if not value:
+            return value
+        ctx.meta['yasha_cache_stats'] = True
+        if 'cache_dir' not in ctx.params:
+            return value  # wait for --cache-dir
+        cache_dir = ctx.params['cache_dir']
+    else:
+        if not ctx.meta.get('yasha_cache_stats'):
+            return value
+        cache_dir = value
+    if not cache_dir:
+        raise click.UsageError("Option --cache-stats requires --cache-dir or YASHA_CACHE_DIR")
+    click.echo(OutputCache(cache_dir).report())
+    ctx.exit()
+
+
+def render_inputs(template, includes, variables, extensions, template_variables, options):
+    "Everything the output of a render depends on, for the output cache"
+    import jinja2
+    yield __version__
+    yield jinja2.__version__
+    yield json.dumps(options, sort_keys=True)
+    yield json.dumps(list(template_variables))
+    for file in [template.name] + includes + list(variables) + ([extensions.name] if extensions else []):
+        yield Path(file).read_bytes()
+    if options.get('precompiled'):
+        # The compiled templates are rendered rather than their sources, which may not have changed
+        precompiled = Path(options['precompiled'])
+        files = sorted(precompiled.rglob('*.py')) if precompiled.is_dir() else [precompiled]
+        for file in files:
+            yield os.path.relpath(str(file), str(precompiled))
+            yield file.read_bytes()
+
+
+def read_in_background(file):
+    """Read `file` in a daemon thread, so that a run which fails before the
+    content is needed exits without waiting for the end of the file. Returns a
+    future of the content."""
+    source = Future()
+
+    def read():
+        try:
+            source.set_result(file.read())
+        except BaseException as e:
+            source.set_exception(e)
+
+    threading.Thread(target=read, daemon=True).start()
+    return source
+
+
 def parse_cli_variables(args):
     variables = dict()
     for i, arg in enumerate(args):
@@ -78,7 +152,206 @@ def parse_cli_variables(args):
     return variables
 
 
-@click.command(context_settings=dict(
+def parse_cli_templates(args):
+    """Returns the arguments which are neither template variables (--foo=bar
+    or --foo bar) nor their values. With -M, these are additional templates."""
+    templates = []
+    for i, arg in enumerate(args):
+        if arg[:2] == '--':
+            continue
+        if i > 0 and args[i-1][:2] == '--' and args[i-1] != '--' and '=' not in args[i-1]:
+            continue  # value of the previous variable
+        templates.append(arg)
+    return templates
+
+
+def expand_templates(patterns):
+    "Expands glob patterns into template file names, keeping plain file names as they are"
+    templates = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        if not matches or not all(os.path.isfile(t) for t in matches):
+            raise ClickException("No template found for '{}'".format(pattern))
+        templates.extend(matches)
+    return templates
+
+
+def find_companion_files(template_name, variables, extensions, no_variable_file, no_extension_file, cache, parsers=PARSERS):
+    """Returns the variable files and the extension file of a template: the ones
+    given on the command line, or else the ones found next to the template,
+    whose variable files are the ones `parsers` can parse"""
+    if extensions and variables:
+        return variables, extensions
+    template_companion = list(util.find_template_companion(template_name, cache=cache))
+
+    if not extensions and not no_extension_file:
+        for file in template_companion:
+            if file.endswith(constants.EXTENSION_FILE_FORMATS):
+                extensions = click.open_file(file, "rb")
+                break
+
+    if not variables and not no_variable_file:
+        for file in template_companion:
+            if file.endswith(tuple(parsers.keys())):
+                variables = (file,)
+                break
+    return variables, extensions
+
+
+def find_dependencies(template, variables, extensions, include_path):
+    "Returns the files which the rendering of `template` depends on, starting with the template itself"
+    deps = [os.path.relpath(template.name)]
+    for file in variables:
+        deps.append(os.path.relpath(file))
+    if extensions:
+        deps.append(os.path.relpath(extensions.name))
+    for d in util.find_referenced_templates(template, include_path):
+        deps.append(os.path.relpath(d))
+    return deps
+
+
+def cmake_quote(value):
+    return '"' + value.replace('\\', '/').replace('"', '\\"').replace('$', '\\$') + '"'
+
+
+def format_dependencies(targets, deps_format):
+    """Formats a list of (output, dependencies) pairs, as Makefile rules, as a
+    JSON object or as a CMake script which can be include()d"""
+    if deps_format == 'json':
+        return json.dumps({output: deps for output, deps in targets}, indent=2)
+    if deps_format == 'cmake':
+        lines = ['set(YASHA_OUTPUTS']
+        lines += ['  ' + cmake_quote(os.path.abspath(output)) for output, _ in targets]
+        lines[-1] += ')'
+        for output, deps in targets:
+            output = os.path.abspath(output)
+            deps = [os.path.abspath(d) for d in deps]
+            lines.append('set({} {})'.format(cmake_quote('YASHA_TEMPLATE_' + output), cmake_quote(deps[0])))
+            lines.append('set({}'.format(cmake_quote('YASHA_DEPENDS_' + output)))
+            lines += ['  ' + cmake_quote(d) for d in deps]
+            lines[-1] += ')'
+        return '\n'.join(lines)
+    return '\n'.join(os.path.relpath(output) + ": " + " ".join(deps) for output, deps in targets)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.argument("src_dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--output", "-o", required=True, type=click.Path(), help="Write the compiled templates into DIRECTORY, or into a zip file if it ends with .zip.")
+@click.option("--extensions", "-e", envvar='YASHA_EXTENSIONS', type=click.Path(exists=True, dir_okay=False), multiple=True, help="Read template extensions from FILENAME, for every template. A Python file is expected.")
+@click.option("--encoding", "-c", default=constants.ENCODING, help="Default is UTF-8.")
+@click.option("--no-extension-file", is_flag=True, help="Omit template extension files.")
+@click.option("--no-trim-blocks", is_flag=True, help="Load Jinja with trim_blocks=False.")
+@click.option("--no-lstrip-blocks", is_flag=True, help="Load Jinja with lstrip_blocks=False.")
+@click.option("--keep-trailing-newline", is_flag=True, help="Load Jinja with keep_trailing_newline=True.")
+@click.option("--enable-async", is_flag=True, help="Compile the templates for Jinja's async mode, to be rendered with --enable-async.")
+def compile_cli(src_dir, output, extensions, encoding, no_extension_file, no_trim_blocks, no_lstrip_blocks, keep_trailing_newline, enable_async):
+    """Compiles every template under SRC_DIR, with the filters, tests, Jinja
+    extensions and template syntax of its extension files, into Python
+    modules. Variable files, extension files and hidden files are skipped.
+
+        yasha compile templates -o build/templates.zip
+
+    Rendering with --precompiled then loads the templates from there
+    instead of compiling them:
+
+        yasha --precompiled build/templates.zip templates/foo.c.j2
+
+    Templates are named after their path relative to the current
+    directory, so both commands must be run from the same directory.
+    """
+    from jinja2.exceptions import TemplateSyntaxError
+    from yasha.main import Yasha
+
+    if encodings.search_function(encoding) is None:
+        raise ClickException("Unrecognized encoding name '{}'".format(encoding))
+    yasha = Yasha(
+        yasha_extensions_files=extensions, encoding=encoding, enable_async=enable_async,
+        trim_blocks=not no_trim_blocks, lstrip_blocks=not no_lstrip_blocks, keep_trailing_newline=keep_trailing_newline)
+    try:
+        yasha.compile_templates(
+            find_templates(Path(src_dir)), output, zip='deflated' if output.endswith('.zip') else None, 
+            find_extension_files=not no_extension_file)
+    except TemplateSyntaxError as e:
+        raise ClickException("{} ({}, line {})".format(e.message, os.path.relpath(e.filename or e.name), e.lineno))
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"], ignore_unknown_options=True))
+@click.argument("template_variables", nargs=-1, type=click.UNPROCESSED)
+@click.argument("template", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", "-o", required=True, type=click.Path(), help="Write the specialized template into DIRECTORY, or into a zip file if it ends with .zip.")
+@click.option("--variables", "-v", type=click.Path(exists=True, dir_okay=False), multiple=True, help="Read static template variables from FILENAME.")
+@click.option("--extensions", "-e", envvar='YASHA_EXTENSIONS', type=click.Path(exists=True, dir_okay=False), multiple=True, help="Read template extensions from FILENAME. A Python file is expected.")
+@click.option("--encoding", "-c", default=constants.ENCODING, help="Default is UTF-8.")
+@click.option("--no-variable-file", is_flag=True, help="Omit template variable file.")
+@click.option("--no-extension-file", is_flag=True, help="Omit template extension file.")
+@click.option("--no-trim-blocks", is_flag=True, help="Load Jinja with trim_blocks=False.")
+@click.option("--no-lstrip-blocks", is_flag=True, help="Load Jinja with lstrip_blocks=False.")
+@click.option("--keep-trailing-newline", is_flag=True, help="Load Jinja with keep_trailing_newline=True.")
+@click.option("--enable-async", is_flag=True, help="Compile the template for Jinja's async mode, to be rendered with --enable-async.")
+def specialize_cli(template_variables, template, output, variables, extensions, encoding, no_variable_file, no_extension_file,
+                   no_trim_blocks, no_lstrip_blocks, keep_trailing_newline, enable_async):
+    """Specializes TEMPLATE for variables which don't change between
+    builds, and compiles it like 'yasha compile'. The variables given here,
+    in variable files or on the command line, and in the variable file of
+    the template, are static: they are replaced by their values, constant
+    expressions are evaluated and if branches which can't be taken are
+    removed.
+
+        yasha specialize -v device.yaml --NO_FIELDS=True -o build/specialized foo.c.j2
+
+    The specialized template is then rendered with --precompiled and the
+    other variables:
+
+        yasha --precompiled build/specialized -v build.yaml foo.c.j2
+
+    Static variables whose values can't be written into a template, like
+    the objects of SVD files, must still be given to render it.
+    """
+    from jinja2.exceptions import TemplateSyntaxError
+    from yasha.main import Yasha
+
+    if encodings.search_function(encoding) is None:
+        raise ClickException("Unrecognized encoding name '{}'".format(encoding))
+    yasha = Yasha(
+        variable_files=variables, inline_variables=parse_cli_variables(template_variables),
+        yasha_extensions_files=extensions, encoding=encoding, enable_async=enable_async,
+        trim_blocks=not no_trim_blocks, lstrip_blocks=not no_lstrip_blocks, keep_trailing_newline=keep_trailing_newline)
+    try:
+        remaining = yasha.specialize_templates(
+            [template], output, zip='deflated' if output.endswith('.zip') else None,
+            find_data_files=not no_variable_file, find_extension_files=not no_extension_file)
+    except TemplateSyntaxError as e:
+        raise ClickException("{} ({}, line {})".format(e.message, os.path.relpath(e.filename or e.name), e.lineno))
+    except TemplateNotFound as e:
+        raise ClickException("Template {} referenced by {} wasn't found".format(e.name, template))
+    for name, names in remaining.items():
+        if names:
+            click.echo("{} still refers to the static variables {}".format(name, ", ".join(sorted(names))), err=True)
+
+
+class YashaCommand(click.Command):
+    "The yasha command, which renders a template unless its first argument is the name of one of the SUBCOMMANDS"
+
+    SUBCOMMANDS = {'compile': compile_cli, 'specialize': specialize_cli}
+
+    def main(self, args=None, prog_name=None, **extra):
+        # Before any file is opened, see get_jobserver
+        get_jobserver()
+        args = sys.argv[1:] if args is None else list(args)
+        if args and args[0] in self.SUBCOMMANDS:
+            prog_name = "{} {}".format(prog_name or "yasha", args[0])
+            return self.SUBCOMMANDS[args[0]].main(args[1:], prog_name, **extra)
+        return super().main(args, prog_name, **extra)
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # The time spent parsing the command line is part of the --trace of the render
+        start = perf_counter()
+        ctx = super().make_context(info_name, args, parent, **extra)
+        ctx.meta['yasha.parse_time'] = (start, perf_counter())
+        return ctx
+
+
+@click.command(cls=YashaCommand, context_settings=dict(
     help_option_names=["-h", "--help"],
     ignore_unknown_options=True,
 ))
@@ -97,17 +370,37 @@ def parse_cli_variables(args):
 @click.option("--mode", type=click.Choice(['pedantic', 'debug']), help="In pedantic mode Yasha becomes extremely picky on templates, e.g. undefined variables will raise an error. In debug mode undefined variables will print as is.")
 @click.option("-M", is_flag=True, help="Outputs Makefile compatible list of dependencies. Doesn't render the template.")
 @click.option("-MD", is_flag=True, help="Creates Makefile compatible .d file alongside the rendered template.")
+@click.option("--deps-format", type=click.Choice(['make', 'json', 'cmake']), default='make', help="Format of the -M output: Makefile rules, a JSON object mapping outputs to their dependencies, or a CMake script defining YASHA_OUTPUTS, YASHA_TEMPLATE_<output> and YASHA_DEPENDS_<output>. Default is make.")
+@click.option("--enable-async", is_flag=True, help="Load Jinja with enable_async=True, allowing async filters in extension files.")
+@click.option("--profile", is_flag=True, help="Print the time spent in each phase of the render, and in each filter, to stderr.")
+@click.option("--profile-format", type=click.Choice(['text', 'json']), default='text', help="Format of the --profile report. Default is text.")
+@click.option("--trace", metavar="FILENAME", type=click.Path(dir_okay=False), help="Write a trace of the run into FILENAME, in the Chrome trace event format read by Perfetto and chrome://tracing.")
+@click.option("--xml-select", metavar="PATH", help="Only load the elements at PATH of XML variable files, like 'export/devices/device', streaming the rest of the file.")
+@click.option("--foreach", metavar="VAR", help="Render the template once for each item of the list variable VAR. The output filename given by -o is a pattern like 'out/{item[name]}.h', which can refer to the item and its {index}.")
+@click.option("--foreach-as", metavar="NAME", default="item", help="Name of the --foreach item in the template and the output filename pattern. Default is item.")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), help="With --foreach, number of threads rendering items at once. Default is 1, as rendering mostly keeps a single CPU busy whatever the number of threads; more threads help templates waiting on shell commands. Also the number of processes rendering a {% parallel for %} loop, by default the number of CPUs. When run by make -jN, the renders beyond the first take job slots of make.")
+@click.option("--buffer-size", type=click.IntRange(min=0), help="Number of rendered chunks to encode and write at once. 0 renders the whole template before writing it. By default the size depends on the output: large for files, small for pipes and terminals.")
+@click.option("--cache-dir", envvar="YASHA_CACHE_DIR", type=click.Path(file_okay=False), is_eager=True, callback=print_cache_stats, help="Reuse the outputs rendered from identical inputs, stored in DIRECTORY, which can be shared between machines. Templates, included templates, variable and extension files, command-line variables and options are part of the inputs.")
+@click.option("--cache-hardlink", is_flag=True, envvar="YASHA_CACHE_HARDLINK", help="Hard link outputs from the cache instead of copying them. Outputs must then not be modified in place.")
+@click.option("--fragment-cache", "fragment_cache_dir", envvar="YASHA_FRAGMENT_CACHE_DIR", type=click.Path(file_okay=False), help="Keep the fragments rendered by {% cache %} tags in DIRECTORY, to reuse them in later runs.")
+@click.option("--cache-stats", is_flag=True, is_eager=True, expose_value=False, callback=print_cache_stats, help="Print the statistics of the output cache and exit.")
+@click.option("--precompiled", type=click.Path(exists=True), help="Load the templates from the DIRECTORY or zip file written by 'yasha compile', instead of compiling them.")
+@click.option('--cmake-module-path', is_flag=True, callback=print_cmake_module_path, expose_value=False, is_eager=True, help="Print the directory of the Yasha.cmake module and exit.")
 @click.option('--version', is_flag=True, callback=print_version, expose_value=False, is_eager=True, help="Print version and exit.")
 def cli(
         template_variables, template, output, variables, extensions,
         encoding, include_path, no_variable_file, no_extension_file,
         no_trim_blocks, no_lstrip_blocks, keep_trailing_newline,
-        mode, m, md):
+        mode, m, md, deps_format, enable_async, profile, profile_format, trace,
+        xml_select, foreach, foreach_as, jobs, buffer_size, cache_dir, cache_hardlink, fragment_cache_dir, precompiled):
     """Reads the given Jinja TEMPLATE and renders its content
     into a new file. For example, a template called 'foo.c.j2'
     will be written into 'foo.c' in case the output file is not
     explicitly given.
 
+    Templates precompiled by 'yasha compile SRC_DIR -o OUT', or specialized
+    by 'yasha specialize TEMPLATE -o OUT', are rendered with --precompiled OUT.
+
     Template variables can be defined in a separate file or
     given as part of the command-line call, e.g.
 
@@ -116,6 +409,12 @@ def cli(
     defines a variable 'hello' for a template like:
 
         Hello {{ hello }} !
+
+    With -M, any number of templates, or quoted glob patterns like
+    'src/**/*.jinja', can be given before TEMPLATE, and the dependencies of
+    all of them are printed at once:
+
+        yasha -M --deps-format cmake 'src/*.h.jinja' src/main.c.jinja
     """
 
     # Set the encoding of the template file
@@ -124,82 +423,179 @@ def cli(
         raise ClickException(msg.format(encoding))
     constants.ENCODING = encoding
 
+    profiler = Profiler(enabled=profile or bool(trace), trace=bool(trace))
+    if trace:
+        ctx = click.get_current_context()
+        profiler.add_span('parse command line', 'cli', *ctx.meta['yasha.parse_time'])
+        # Written even when the run stops early, or fails
+        ctx.call_on_close(lambda: profiler.write_trace(trace))
+
+    stdin_source = None
+    if template.name == "<stdin>" and not (m or md):
+        # Keep reading the template from stdin while the variable and extension files are loaded
+        stdin_source = read_in_background(template)
+    # Commands run by the shell filters are cached for the duration of this run only
+    SHELL_CACHE.clear()
+
     # Append include path of referenced templates
     include_path = [os.path.dirname(template.name)] + list(include_path)
 
-    if not extensions or not variables:
-        template_companion = util.find_template_companion(template.name)
-        template_companion = list(template_companion)
+    # Extension files may redefine the template syntax and add parsers, see the dependencies of additional -M templates below
+    import jinja2.defaults
+    jinja_syntax = {name: getattr(jinja2.defaults, name) for name in dir(jinja2.defaults) if name.isupper()}
+    default_registries = dict(TESTS), dict(FILTERS), dict(PARSERS), list(CLASSES)
+    directory_cache = util.DirectoryCache()
+    cli_variables, cli_extensions = variables, extensions
 
-    if not extensions and not no_extension_file:
-        for file in template_companion:
-            if file.endswith(constants.EXTENSION_FILE_FORMATS):
-                extensions = click.open_file(file, "rb")
-                break
+    with profiler.phase('find companion files'):
+        variables, extensions = find_companion_files(
+            template.name, variables, extensions, no_variable_file, no_extension_file, directory_cache)
 
     if extensions:
-        util.load_extensions(extensions)
-
-    if not variables and not no_variable_file:
-        for file in template_companion:
-            if file.endswith(tuple(PARSERS.keys())):
-                variables = (file,)
-                break
+        with profiler.phase(f'load extensions {extensions.name}'):
+            util.load_extensions(extensions)
 
-    if not output:
+    if foreach:
+        if m or md:
+            raise ClickException("Option --foreach can't be combined with -M or -MD")
+        if output:
+            output_pattern = output.name
+        elif template.name == "<stdin>":
+            raise ClickException("Option --foreach requires an output filename pattern for templates read from stdin")
+        else:
+            # foo.h.j2 renders into foo-0.h, foo-1.h, ...
+            root, ext = os.path.splitext(os.path.splitext(template.name)[0])
+            output_pattern = root + "-{index}" + ext
+    elif not output:
         if template.name == "<stdin>":
-            output = click.open_file("-", "wb")
+            output = click.get_binary_stream("stdout")
         else:
             output = os.path.splitext(template.name)[0]
             output = click.open_file(output, "wb", lazy=True)
 
     if m or md:
-        deps = [os.path.relpath(template.name)]
-        for file in variables:
-            deps.append(os.path.relpath(file))
-        if extensions:
-            deps.append(os.path.relpath(extensions.name))
-        for d in util.find_referenced_templates(template, include_path):
-            deps.append(os.path.relpath(d))
-
-        deps = os.path.relpath(output.name) + ": " + " ".join(deps)
+        targets = [(output.name, find_dependencies(template, variables, extensions, include_path))]
         if m:
-            click.echo(deps)
+            extra_templates = expand_templates(parse_cli_templates(template_variables))
+            if extra_templates and output.name != os.path.splitext(template.name)[0]:
+                raise ClickException("Option -o can't be used with several templates")
+            extra_targets = []
+            for name in extra_templates:
+                # Scan each template as if it was given alone, with its own companion files, template syntax and
+                # registries of tests, filters, parsers and classes, which the extension files of others don't change
+                for attr, value in jinja_syntax.items():
+                    setattr(jinja2.defaults, attr, value)
+                t_registries = tuple(registry.copy() for registry in default_registries)
+                t_variables, t_extensions = find_companion_files(
+                    name, cli_variables, cli_extensions, no_variable_file, no_extension_file, directory_cache, t_registries[2])
+                try:
+                    if t_extensions:
+                        util.load_extensions(t_extensions, *t_registries)
+                    with open(name, "rb") as t:
+                        deps = find_dependencies(t, t_variables, t_extensions, [os.path.dirname(name)] + include_path[1:])
+                finally:
+                    # The extension file found next to the template, not the one given with -e
+                    if t_extensions and t_extensions is not cli_extensions:
+                        t_extensions.close()
+                extra_targets.append((os.path.splitext(name)[0], deps))
+            # TEMPLATE is the last template of the command line
+            click.echo(format_dependencies(extra_targets + targets, deps_format))
             return  # Template won't be rendered
         if md:
-            deps += os.linesep
+            deps = format_dependencies(targets, 'make') + os.linesep
             output_d = click.open_file(output.name + ".d", "wb")
             output_d.write(deps.encode(constants.ENCODING))
 
+    # Reuse the output of an earlier render of the same inputs
+    cache = None
+    if cache_dir and not foreach and template.name != "<stdin>" and output.name != "-":
+        includes = util.find_all_referenced_templates(Path(template.name), include_path)
+        # Without knowing every included template, a render can't be cached
+        if includes is not None:
+            options = dict(
+                trim_blocks=not no_trim_blocks, lstrip_blocks=not no_lstrip_blocks, keep_trailing_newline=keep_trailing_newline,
+                mode=mode, enable_async=enable_async, encoding=constants.ENCODING, xml_select=xml_select, precompiled=precompiled)
+            cache = OutputCache(cache_dir, hardlink=cache_hardlink)
+            cache_key = cache.key(render_inputs(template, includes, variables, extensions, template_variables, options))
+            with profiler.phase('cache lookup'):
+                hit = cache.restore(cache_key, Path(output.name))
+            if hit:
+                if profile:
+                    click.echo(profiler.report(profile_format), err=True)
+                return
+
     # Load Jinja
     jinja = util.load_jinja(
         path=include_path,
         tests=TESTS,
-        filters=FILTERS,
+        filters=dict(FILTERS, **ASYNC_FILTERS) if enable_async else FILTERS,
         classes=CLASSES,
         mode=mode,
         trim_blocks=not no_trim_blocks,
         lstrip_blocks=not no_lstrip_blocks,
-        keep_trailing_newline=keep_trailing_newline
+        keep_trailing_newline=keep_trailing_newline,
+        enable_async=enable_async
    )
-
-    # Get template
-    if template.name == "<stdin>":
-        stdin = template.read()
-        t = jinja.from_string(stdin.decode(constants.ENCODING))
-    else:
-        t = jinja.get_template(os.path.basename(template.name))
+    if profiler.enabled:
+        jinja.filters.update(profiler.wrap_filters(jinja.filters))
+        jinja.yasha_profiler = profiler
+    if precompiled:
+        jinja.loader = PrecompiledLoader(precompiled, include_path)
+    if fragment_cache_dir:
+        jinja.fragment_cache = FragmentCache(fragment_cache_dir)
+    if jobs:
+        jinja.parallel_workers = jobs
 
     # Parse variables
+    parsers = PARSERS
+    if xml_select:
+        parsers = dict(PARSERS, **{'.xml': make_xml_parser(xml_select)})
     context = dict()
     for file in variables:
-        context.update(util.parse_variable_file(Path(file)))
+        with profiler.phase(f'parse {file}'):
+            context.update(util.parse_variable_file(Path(file), parsers))
     context.update(parse_cli_variables(template_variables))
 
+    # Get template
+    with profiler.phase('compile'):
+        if template.name == "<stdin>":
+            stdin = stdin_source.result()
+            t = jinja.from_string(stdin.decode(constants.ENCODING))
+        elif precompiled:
+            try:
+                t = jinja.get_template(os.path.basename(template.name))
+            except TemplateNotFound:
+                raise ClickException("Template {} wasn't precompiled into {}".format(template.name, precompiled))
+        else:
+            t = jinja.get_template(os.path.basename(template.name))
+
     # Finally render template and save it
     try:
-        t_stream = t.stream(context)
-        t_stream.enable_buffering(size=5)
-        t_stream.dump(output, encoding=constants.ENCODING)
+        if foreach:
+            if foreach not in context:
+                raise ClickException("Variable '{}' is undefined".format(foreach))
+            contexts = (dict(context, **{foreach_as: item}) for item in context[foreach])
+            # Threads render in parallel only as far as Python lets them, so they don't take job slots of make unless asked to
+            jobserver = get_jobserver() if jobs else None
+            with profiler.phase('render'):
+                util.render_each(t, contexts, output_pattern, encoding=constants.ENCODING, workers=jobs or 1, jobserver=jobserver)
+        else:
+            with profiler.phase('render'):
+                if cache:
+                    rendered = io.BytesIO()
+                    util.dump_template(t, context, rendered, encoding=constants.ENCODING, buffer_size=buffer_size)
+                    # Replace the output rather than writing into it, as it may be a hard link to a cache entry
+                    with span('write output'):
+                        write_atomically(Path(output.name), rendered.getvalue())
+                    cache.store(cache_key, rendered.getvalue())
+                else:
+                    util.dump_template(t, context, output, encoding=constants.ENCODING, buffer_size=buffer_size)
     except JinjaUndefinedError as e:
         raise ClickException("Variable {}".format(e))
+    except TemplateNotFound as e:
+        if not precompiled:
+            raise
+        raise ClickException("Template {} wasn't precompiled into {}".format(e.name, precompiled))
+
+    if profile:
+        click.echo(profiler.report(profile_format), err=True)
@@ -0,0 +1,66 @@
+# Yasha.cmake - render Jinja templates with Yasha as part of a CMake build
+#
+# The MIT License (MIT), Copyright (c) 2020 Alex Tremblay
+#
+# Usage:
+#
+#   execute_process(COMMAND yasha --cmake-module-path OUTPUT_VARIABLE yasha_module_path OUTPUT_STRIP_TRAILING_WHITESPACE)
+#   list(APPEND CMAKE_MODULE_PATH ${yasha_module_path})
+#   include(Yasha)
+#
+#   file(GLOB templates "src/*.jinja")
+#   yasha_render(generated_sources ${templates} ARGS --mode pedantic)
+#   add_executable(a.out src/main.c ${generated_sources})
+#
+# yasha_render(<output variable> <template>... [ARGS <yasha options>...])
+#
+#   Adds a custom command rendering each template next to it, e.g. src/foo.c.jinja into src/foo.c,
+#   and sets <output variable> to the list of rendered files. The dependencies of all templates
+#   (variable and extension files, included templates) are found by a single `yasha -M` call at
+#   configure time, and CMake re-runs the configuration when one of the templates changes.
+#   ARGS are passed to every yasha call.
+#
+# Set YASHA_EXECUTABLE to use a specific yasha executable.
+
+find_program(YASHA_EXECUTABLE yasha)
+if(NOT YASHA_EXECUTABLE)
+    message(FATAL_ERROR "yasha not found, install it or set YASHA_EXECUTABLE")
+endif()
+
+function(yasha_render output_variable)
+    cmake_parse_arguments(YASHA "" "" "ARGS" ${ARGN})
+    set(templates)
+    foreach(template ${YASHA_UNPARSED_ARGUMENTS})
+        get_filename_component(template "${template}" ABSOLUTE)
+        list(APPEND templates "${template}")
+    endforeach()
+    if(NOT templates)
+        set(${output_variable} "" PARENT_SCOPE)
+        return()
+    endif()
+
+    string(MD5 deps_hash "${templates}")
+    set(deps_file "${CMAKE_CURRENT_BINARY_DIR}/yasha-${deps_hash}.cmake")
+    execute_process(
+        COMMAND ${YASHA_EXECUTABLE} -M --deps-format cmake ${YASHA_ARGS} ${templates}
+        WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
+        OUTPUT_FILE ${deps_file}
+        RESULT_VARIABLE result
+        ERROR_VARIABLE error
+    )
+    if(NOT result EQUAL 0)
+        message(FATAL_ERROR "yasha -M failed: ${error}")
+    endif()
+    include(${deps_file})
+    set_property(DIRECTORY APPEND PROPERTY CMAKE_CONFIGURE_DEPENDS ${templates})
+
+    foreach(output ${YASHA_OUTPUTS})
+        add_custom_command(
+            OUTPUT ${output}
+            COMMAND ${YASHA_EXECUTABLE} ${YASHA_ARGS} -o ${output} ${YASHA_TEMPLATE_${output}}
+            DEPENDS ${YASHA_DEPENDS_${output}}
+            WORKING_DIRECTORY ${CMAKE_CURRENT_SOURCE_DIR}
+        )
+    endforeach()
+    set(${output_variable} ${YASHA_OUTPUTS} PARENT_SCOPE)
+endfunction()
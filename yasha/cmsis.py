@@ -24,6 +24,8 @@ THE SOFTWARE.
 
 from xml.etree import ElementTree
 
+from yasha.profiling import span
+
 class SVDFile():
     """SVD File: Entry class to parse CMSIS-SVD file
 
@@ -33,11 +35,12 @@ class SVDFile():
     """
 
     def __init__(self, file):
-        if isinstance(file, str):
-            self.root = ElementTree.fromstring(file)
-        else:
-            tree = ElementTree.parse(file)
-            self.root = tree.getroot()
+        with span('SVDFile read XML', 'svd'):
+            if isinstance(file, str):
+                self.root = ElementTree.fromstring(file)
+            else:
+                tree = ElementTree.parse(file)
+                self.root = tree.getroot()
 
         self.cpu = None
         self.device = None
@@ -56,9 +59,10 @@ class SVDFile():
             self.peripherals.append(periph)
             self.peripherals_dict[periph.name] = periph
 
-        for periph in [self.peripherals_dict[name] for name in derived_periphs]:
-            base = self.peripherals_dict[periph.derivedFrom]
-            periph.inherit_from(base)
+        with span('SVDFile derive peripherals', 'svd'):
+            for periph in [self.peripherals_dict[name] for name in derived_periphs]:
+                base = self.peripherals_dict[periph.derivedFrom]
+                periph.inherit_from(base)
 
 
 class SvdElement(object):
@@ -157,6 +161,11 @@ class SvdPeripheral(SvdElement):
     ]
 
     def from_element(self, element, defaults={}):
+        with span('SvdPeripheral.from_element', 'svd') as args:
+            self._from_element(element, defaults)
+            args['name'] = self.name
+
+    def _from_element(self, element, defaults):
         SvdElement.from_element(self, element, defaults)
         self.registers = []
         self.interrupts = []
@@ -246,6 +255,11 @@ class SvdRegister(SvdElement):
         itself, where nothing else than the '%s' placeholder in it's name
         has been replaced with value of the dim element.
         """
+        with span('SvdRegister.fold', 'svd') as args:
+            args['name'] = self.name
+            return self._fold()
+
+    def _fold(self):
         if self.dim is None:
             return [self]
         if self.name.endswith("[%s]"):  # C array like
@@ -22,18 +22,25 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import asyncio
+import inspect
 import os
 import sys
 import subprocess
-from typing import Callable, Dict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import update_wrapper, wraps
+from typing import Any, Callable, Dict, Iterable, Optional
 
 from click import ClickException
+from jinja2 import pass_context
+from jinja2.utils import _PassArg
 from yasha.constants import ENCODING
 
 def do_env(value, default=None):
     return os.environ.get(value, default)
 
-def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2):
+def run_command(cmd, stdout=True, stderr=True, timeout=2):
     assert sys.version_info >= (3,5)
     kwargs = dict(
         stdout=subprocess.PIPE if stdout else None,
@@ -44,28 +51,345 @@ def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2):
     )
 
     try:
-        result = subprocess.run(cmd, **kwargs)
+        return subprocess.run(cmd, **kwargs)
     except subprocess.TimeoutExpired:
         msg = "Command '{}' timed out after waiting for {} seconds"
         raise ClickException(msg.format(cmd, timeout))
 
-    if check and result.returncode:
+async def run_command_async(cmd, stdout=True, stderr=True, timeout=2):
+    process = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=subprocess.PIPE if stdout else None,
+        stderr=subprocess.PIPE if stderr else None,
+    )
+
+    try:
+        out, err = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        msg = "Command '{}' timed out after waiting for {} seconds"
+        raise ClickException(msg.format(cmd, timeout))
+
+    return subprocess.CompletedProcess(cmd, process.returncode, out, err)
+
+def check_result(cmd, result):
+    if result.returncode:
         errno = result.returncode
-        error = result.stderr.decode().strip()
+        error = result.stderr.decode().strip() if result.stderr else ''
         msg = "Command '{}' returned non-zero exit status {}\n{}"
         raise ClickException(msg.format(cmd, errno, error))
 
-    return result
-
-def do_shell(cmd, strip=True, check=True, timeout=2):
-    result = do_subprocess(cmd, stderr=False, check=check, timeout=timeout)
+def decode_output(result, strip=True):
     if not strip:
         return result.stdout.decode(encoding=ENCODING)
     else:
         return result.stdout.decode(encoding=ENCODING).strip()
 
+def sync_filter(func: Callable) -> Callable:
+    "Returns a synchronous version of the async filter `func`, for jinja environments without async support"
+    if not inspect.iscoroutinefunction(func):
+        return func
+
+    @wraps(func)
+    def run_until_complete(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(func(*args, **kwargs))
+        # Called from a coroutine, whose event loop can't run another one: run it in a helper thread
+        with ThreadPoolExecutor(max_workers=1) as helper:
+            return helper.submit(asyncio.run, func(*args, **kwargs)).result()
+    return run_until_complete
+
+
+# Default number of results kept for each pure filter or memoized macro, per render
+MEMO_SIZE = 4096
+
+
+def pure(func: Callable = None, *, maxsize: int = MEMO_SIZE):
+    """Marks the filter `func` as pure: its result only depends on its arguments, and calling it has no side effects.
+
+    Yasha memoizes pure filters within each render, keeping the last `maxsize` results. It can be used as
+    `@pure` or `@pure(maxsize=...)` on the filters of an extension file.
+    """
+    def mark(func):
+        func.yasha_pure = maxsize
+        return func
+    return mark if func is None else mark(func)
+
+
+class _Identity:
+    "Stands for a value which can't be hashed, like a dict or a list, by its identity in a memo key"
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value  # keeps the value alive, so that its id isn't reused while it's in the cache
+
+    def __hash__(self):
+        return id(self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.value is self.value
+
+
+def _memo_part(value):
+    try:
+        hash(value)
+    except TypeError:
+        return _Identity(value)
+    # 1, 1.0 and True are equal, but don't give the same result in a template
+    return type(value), value
+
+
+def memo_key(args: tuple, kwargs: dict) -> tuple:
+    """Returns a hashable key for a call with `args` and `kwargs`.
+
+    Arguments which can't be hashed stand for themselves by identity, so a template must not modify a
+    dict or a list between two calls of a memoized function with it.
+    """
+    key = tuple(map(_memo_part, args))
+    if kwargs:
+        key += tuple((name, _memo_part(value)) for name, value in sorted(kwargs.items()))
+    return key
+
+
+class Memo:
+    """The results of a pure function, which reports its hits and misses to a profiler under `name`.
+
+    It keeps at most `maxsize` results, and forgets the oldest ones first. It belongs to a single render,
+    so unlike jinja's LRUCache it doesn't need a lock.
+    """
+
+    def __init__(self, name: str, maxsize: int = MEMO_SIZE, profiler: Any = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.results: Dict[tuple, Any] = dict()
+        self.profiler = profiler
+
+    def _store(self, key: tuple, result):
+        if len(self.results) >= self.maxsize:
+            del self.results[next(iter(self.results))]
+        self.results[key] = result
+        if self.profiler is not None:
+            self.profiler.record_memo(self.name, False)
+
+    def call(self, func: Callable, args: tuple, kwargs: dict):
+        key = memo_key(args, kwargs)
+        if key in self.results:
+            if self.profiler is not None:
+                self.profiler.record_memo(self.name, True)
+            return self.results[key]
+        result = func(*args, **kwargs)
+        self._store(key, result)
+        return result
+
+    async def call_async(self, func: Callable, args: tuple, kwargs: dict):
+        key = memo_key(args, kwargs)
+        if key in self.results:
+            if self.profiler is not None:
+                self.profiler.record_memo(self.name, True)
+            return self.results[key]
+        result = await func(*args, **kwargs)
+        self._store(key, result)
+        return result
+
+
+def memoize_filter(name: str, func: Callable, maxsize: Optional[int] = None) -> Callable:
+    """Returns a version of the filter `func` which is memoized within each render.
+
+    The results are kept in the jinja context of the render, so each render, and each included template,
+    starts afresh. Hits and misses are recorded by `environment.yasha_profiler`, if there is one.
+    """
+    if getattr(func, 'yasha_memoized', False):
+        return func
+    if maxsize is None:
+        maxsize = getattr(func, 'yasha_pure', None) or MEMO_SIZE
+    passes = _PassArg.from_obj(func)
+
+    def memo(context) -> Memo:
+        memos = context.__dict__.setdefault('yasha_memos', {})
+        if memoized not in memos:
+            memos[memoized] = Memo(name, maxsize, getattr(context.environment, 'yasha_profiler', None))
+        return memos[memoized]
+
+    def passed(context) -> tuple:
+        if passes is _PassArg.context:
+            return (context,)
+        if passes is _PassArg.eval_context:
+            return (context.eval_ctx,)
+        if passes is _PassArg.environment:
+            return (context.environment,)
+        return ()
+
+    if inspect.iscoroutinefunction(func):
+        async def memoized(context, *args, **kwargs):
+            return await memo(context).call_async(func, passed(context) + args, kwargs)
+    else:
+        def memoized(context, *args, **kwargs):
+            return memo(context).call(func, passed(context) + args, kwargs)
+    update_wrapper(memoized, func)
+    memoized.yasha_memoized = True  # type: ignore
+    return pass_context(memoized)
+
+
+def memoize_pure_filters(filters: Dict[str, Callable]) -> Dict[str, Callable]:
+    "Returns a copy of the `filters` dict in which the filters marked with `pure` are memoized"
+    return {name: memoize_filter(name, func) if getattr(func, 'yasha_pure', None) else func for name, func in filters.items()}
+
+
+class ShellCache:
+    """Results of the commands run by the `shell` and `subprocess` filters.
+
+    Templates often run the same command many times, like `{{ "git rev-parse HEAD"|shell }}` in a loop
+    or in every template of a batch. Each command is run once per working directory and environment, and
+    later calls reuse its result. Independent commands can also be prefetched, to run concurrently
+    before the template asks for them.
+    """
+
+    def __init__(self):
+        self._results: Dict[tuple, Future] = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(cmd, stdout, stderr):
+        return (cmd, os.getcwd(), tuple(sorted(os.environ.items())), bool(stdout), bool(stderr))
+
+    def _claim(self, key):
+        "Returns the future holding the result of `key`, and whether the caller is responsible for running the command"
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None:
+                return future, False
+            future = self._results[key] = Future()
+            return future, True
+
+    def _execute(self, key, future, cmd, stdout, stderr, timeout):
+        try:
+            future.set_result(run_command(cmd, stdout, stderr, timeout))
+        except BaseException as e:
+            # Failures to run the command (like timeouts) aren't cached, later calls will try again
+            with self._lock:
+                self._results.pop(key, None)
+            future.set_exception(e)
+
+    def run(self, cmd, stdout=True, stderr=True, timeout=2):
+        key = self._key(cmd, stdout, stderr)
+        future, owner = self._claim(key)
+        if owner:
+            self._execute(key, future, cmd, stdout, stderr, timeout)
+        return future.result()
+
+    async def run_async(self, cmd, stdout=True, stderr=True, timeout=2):
+        key = self._key(cmd, stdout, stderr)
+        future, owner = self._claim(key)
+        if owner:
+            try:
+                future.set_result(await run_command_async(cmd, stdout, stderr, timeout))
+            except BaseException as e:
+                with self._lock:
+                    self._results.pop(key, None)
+                future.set_exception(e)
+        return await asyncio.wrap_future(future)
+
+    def prefetch(self, cmds: Iterable[str], stdout=True, stderr=False, timeout=2, max_workers=None):
+        """Start running the commands `cmds` concurrently, without waiting for them to finish.
+        The `stdout` and `stderr` arguments should match the ones of the later filter calls,
+        the defaults match the ones of the `shell` filter."""
+        executor = None
+        for cmd in cmds:
+            key = self._key(cmd, stdout, stderr)
+            future, owner = self._claim(key)
+            if owner:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=max_workers)
+                executor.submit(self._execute, key, future, cmd, stdout, stderr, timeout)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def subprocess(self, cmd, stdout=True, stderr=True, check=True, timeout=2, cache=True):
+        if cache:
+            result = self.run(cmd, stdout=stdout, stderr=stderr, timeout=timeout)
+        else:
+            result = run_command(cmd, stdout=stdout, stderr=stderr, timeout=timeout)
+
+        if check:
+            check_result(cmd, result)
+        return result
+
+    def shell(self, cmd, strip=True, check=True, timeout=2, cache=True):
+        result = self.subprocess(cmd, stderr=False, check=check, timeout=timeout, cache=cache)
+        return decode_output(result, strip)
+
+    async def subprocess_async(self, cmd, stdout=True, stderr=True, check=True, timeout=2, cache=True):
+        if cache:
+            result = await self.run_async(cmd, stdout=stdout, stderr=stderr, timeout=timeout)
+        else:
+            result = await run_command_async(cmd, stdout=stdout, stderr=stderr, timeout=timeout)
+
+        if check:
+            check_result(cmd, result)
+        return result
+
+    async def shell_async(self, cmd, strip=True, check=True, timeout=2, cache=True):
+        result = await self.subprocess_async(cmd, stderr=False, check=check, timeout=timeout, cache=cache)
+        return decode_output(result, strip)
+
+    def prefetch_filter(self, cmds, stderr=False, timeout=2):
+        "Template filter version of `prefetch`, which renders as an empty string"
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        self.prefetch(cmds, stderr=stderr, timeout=timeout)
+        return ''
+
+    def filters(self) -> Dict[str, Callable]:
+        "The `shell`, `subprocess` and `prefetch` filters, using this cache"
+        return {
+            'shell': self.shell,
+            'subprocess': self.subprocess,
+            'prefetch': self.prefetch_filter,
+        }
+
+    def async_filters(self) -> Dict[str, Callable]:
+        "The `shell`, `subprocess` and `prefetch` filters, using this cache, for jinja environments with async support"
+        return {
+            'shell': self.shell_async,
+            'subprocess': self.subprocess_async,
+            'prefetch': self.prefetch_filter,
+        }
+
+
+# Used by the module-level filters, and therefore by the command-line tool
+SHELL_CACHE = ShellCache()
+
+def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2, cache=True):
+    return SHELL_CACHE.subprocess(cmd, stdout=stdout, stderr=stderr, check=check, timeout=timeout, cache=cache)
+
+def do_shell(cmd, strip=True, check=True, timeout=2, cache=True):
+    return SHELL_CACHE.shell(cmd, strip=strip, check=check, timeout=timeout, cache=cache)
+
+def do_prefetch(cmds, stderr=False, timeout=2):
+    return SHELL_CACHE.prefetch_filter(cmds, stderr=stderr, timeout=timeout)
+
+async def do_subprocess_async(cmd, stdout=True, stderr=True, check=True, timeout=2, cache=True):
+    return await SHELL_CACHE.subprocess_async(cmd, stdout=stdout, stderr=stderr, check=check, timeout=timeout, cache=cache)
+
+async def do_shell_async(cmd, strip=True, check=True, timeout=2, cache=True):
+    return await SHELL_CACHE.shell_async(cmd, strip=strip, check=check, timeout=timeout, cache=cache)
+
 FILTERS: Dict[str, Callable] = {
     'env': do_env,
     'shell': do_shell,
     'subprocess': do_subprocess,
+    'prefetch': do_prefetch,
+}
+
+# Replace the filters of the same name in FILTERS, for jinja environments with async support
+ASYNC_FILTERS: Dict[str, Callable] = {
+    'shell': do_shell_async,
+    'subprocess': do_subprocess_async,
 }
@@ -0,0 +1,148 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import re
+import select
+import shlex
+import stat
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional
+
+
+class Jobserver:
+    """Client of the GNU Make jobserver, which shares the job slots of `make -jN` between make and its sub-processes.
+
+    Every process started by make owns one implicit job slot. Any additional job which runs at the same time
+    needs a token, read from the jobserver pipe (or named pipe), and written back once the job is done.
+    `job()` takes care of both, so that yasha never runs more jobs at once than make allows. If reading or
+    writing a token fails, the jobserver is left alone, and jobs run without tokens from then on.
+    """
+
+    def __init__(self, read_fd: int, write_fd: int):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.failed = False
+        self._implicit_slot = threading.Lock()
+
+    @classmethod
+    def from_makeflags(cls, makeflags: str) -> Optional['Jobserver']:
+        """Returns a client of the jobserver described by the MAKEFLAGS environment variable of make,
+        or None if there isn't one, or if it isn't available to this process.
+
+        Understands `--jobserver-auth=fifo:PATH` (make 4.4+), `--jobserver-auth=R,W` (make 4.2+)
+        and `--jobserver-fds=R,W` (older versions). The last one given wins, like in make.
+        """
+        try:
+            words = shlex.split(makeflags)
+        except ValueError:
+            words = makeflags.split()
+        auth = None
+        for word in words:
+            match = re.match(r'--jobserver-(?:auth|fds)=(.+)$', word)
+            if match:
+                auth = match.group(1)
+        if auth is None:
+            return None
+
+        if auth.startswith('fifo:'):
+            try:
+                fd = os.open(auth[5:], os.O_RDWR)
+            except OSError:
+                return None
+            if not _is_pipe(fd):
+                os.close(fd)
+                return None
+            return cls(fd, fd)
+
+        try:
+            read_fd, write_fd = (int(fd) for fd in auth.split(','))
+        except ValueError:
+            return None
+        if read_fd < 0 or write_fd < 0:
+            return None  # make -j without N, or a jobserver which isn't shared with this process
+        # make closes the jobserver file descriptors for commands which aren't marked as recursive (+), but still
+        # passes them in MAKEFLAGS: they may be closed, or reused for other files by now
+        if not (_is_pipe(read_fd) and _is_pipe(write_fd)):
+            return None
+        return cls(read_fd, write_fd)
+
+    def acquire(self) -> Optional[bytes]:
+        "Waits for a token from the jobserver, and returns it, or None if the jobserver can't be read"
+        while not self.failed:
+            try:
+                token = os.read(self.read_fd, 1)
+            except BlockingIOError:
+                # make may have set the pipe in non-blocking mode
+                select.select([self.read_fd], [], [])
+                continue
+            except OSError:
+                token = b''
+            if token:
+                return token
+            self.failed = True
+        return None
+
+    def release(self, token: bytes):
+        "Gives a token back to the jobserver"
+        try:
+            os.write(self.write_fd, token)
+        except OSError:
+            self.failed = True
+
+    @contextmanager
+    def job(self):
+        "Runs the block of code in the `with` statement as a job: in the implicit job slot if it is free, or else with a token"
+        if self._implicit_slot.acquire(blocking=False):
+            try:
+                yield
+            finally:
+                self._implicit_slot.release()
+            return
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            if token is not None:
+                self.release(token)
+
+
+def _is_pipe(fd: int) -> bool:
+    "Whether the file descriptor `fd` is open on a pipe or a named pipe"
+    try:
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def get_jobserver() -> Optional[Jobserver]:
+    """The jobserver of the make process which started yasha, if any.
+
+    The first call must come before yasha opens any file, which could reuse the file descriptors
+    of a jobserver that make didn't share with yasha.
+    """
+    return Jobserver.from_makeflags(os.environ.get('MAKEFLAGS', ''))
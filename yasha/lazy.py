@@ -0,0 +1,256 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import re
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set
+
+from yasha.constants import ENCODING
+from yasha import parsers
+
+# A plain top-level YAML key, or a quoted one, followed by the `:` indicator
+_YAML_KEY = re.compile(r'''(?:([A-Za-z_][\w.-]*)|"([^"\\]*)"|'([^']*)')[ \t]*:(?:[ \t]|$)''')
+# A bare or quoted TOML key, at the start of a `key = value` line or of a `[table]` / `[[array]]` header
+_TOML_KEY = r'''(?:([A-Za-z0-9_-]+)|"([^"\\]*)"|'([^']*)')'''
+_TOML_ASSIGNMENT = re.compile(_TOML_KEY + r'[ \t]*[=.]')
+_TOML_HEADER = re.compile(r'\[\[?[ \t]*' + _TOML_KEY + r'[ \t]*(?:\.[^\]]*)?\]\]?[ \t]*(?:#.*)?$')
+_TOML_STRINGS = re.compile(r'''"(?:[^"\\]|\\.)*"|'[^']*'|#.*''')
+_INI_SECTION = re.compile(r'\[([^\]]+)\]')
+_XML_PROLOG = re.compile(rb'<\?.*?\?>|<!--.*?-->|<!\[CDATA\[.*?\]\]>|<!DOCTYPE[^>\[]*(?:\[.*?\])?\s*>', re.DOTALL)
+_XML_ROOT = re.compile(rb'\s*<([^\s/>!?]+)')
+
+
+def _lines(file: Path, encoding: str) -> Iterator[str]:
+    with file.open('r', encoding=encoding, errors='replace') as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def _key(match) -> str:
+    return next(group for group in match.groups() if group is not None)
+
+
+def scan_yaml_keys(file: Path, encoding: str = ENCODING) -> Optional[Set[str]]:
+    """The top-level keys of a YAML mapping: every key which starts at column 0.
+    Returns None for anything but a simple block mapping (flow mappings, merge keys, several documents...)"""
+    keys: Set[str] = set()
+    started = False
+    for line in _lines(file, encoding):
+        if not line or line[0] in ' \t#':
+            continue
+        if line.startswith('%'):
+            continue  # directive
+        if line.startswith('---'):
+            if started:
+                return None
+            started = True
+            if line[3:].strip() and not line[3:].lstrip().startswith('#'):
+                return None  # content on the document start line
+            continue
+        if line.startswith('...'):
+            continue
+        if line == '-' or line.startswith(('- ', '-\t')):
+            if not keys:
+                return None  # a list, not a mapping
+            continue  # a list which is the value of the previous key
+        match = _YAML_KEY.match(line)
+        if not match:
+            return None
+        started = True
+        keys.add(_key(match))
+    return keys
+
+
+def scan_toml_keys(file: Path, encoding: str = ENCODING) -> Optional[Set[str]]:
+    """The top-level keys of a TOML document: the keys assigned before the first table, 
+    and the first part of the name of every table. Returns None if a line can't be understood."""
+    keys: Set[str] = set()
+    in_root = True
+    multiline = None  # delimiter of the multi-line string being skipped
+    depth = 0  # nesting of the multi-line array or inline table being skipped
+    for line in _lines(file, encoding):
+        if multiline:
+            if line.count(multiline) % 2:
+                multiline = None
+            continue
+        stripped = line.strip()
+        if depth:
+            code = _TOML_STRINGS.sub('', stripped)
+            depth += code.count('[') + code.count('{') - code.count(']') - code.count('}')
+            continue
+        if not stripped or stripped.startswith('#'):
+            continue
+        if stripped.startswith('['):
+            match = _TOML_HEADER.match(stripped)
+            if not match:
+                return None
+            keys.add(_key(match))
+            in_root = False
+            continue
+        match = _TOML_ASSIGNMENT.match(stripped)
+        if not match:
+            return None
+        if in_root:
+            keys.add(_key(match))
+        for delimiter in ('"""', "'''"):
+            if stripped.count(delimiter) % 2:
+                multiline = delimiter
+                break
+        else:
+            code = _TOML_STRINGS.sub('', stripped)
+            depth = max(0, code.count('[') + code.count('{') - code.count(']') - code.count('}'))
+    return keys
+
+
+def scan_ini_keys(file: Path, encoding: str = ENCODING) -> Optional[Set[str]]:
+    "The sections of an INI file, which are its top-level keys along with DEFAULT"
+    keys = {'DEFAULT'}
+    for line in _lines(file, encoding):
+        match = _INI_SECTION.match(line)
+        if match:
+            keys.add(match.group(1))
+    return keys
+
+
+def scan_xml_keys(file: Path, encoding: str = ENCODING) -> Optional[Set[str]]:
+    "The name of the root element of an XML file, which is the only top-level key `parse_xml` returns"
+    with file.open('rb') as f:
+        head = f.read(65536)
+    match = _XML_ROOT.match(_XML_PROLOG.sub(b'', head))
+    if not match:
+        return None
+    return {match.group(1).decode(encoding, errors='replace')}
+
+
+def scan_variable_keys(file: Path, parser: Callable, encoding: str = ENCODING) -> Optional[Set[str]]:
+    """Returns the top-level keys of the variables `parser` would load from `file`, without parsing the file.
+
+    The keys can be a superset of the real ones, but never miss one. Returns None when they can't be 
+    found cheaply, which is the case for JSON files and for the parsers of extension files."""
+    if parser is parsers.parse_yaml:
+        return scan_yaml_keys(file, encoding)
+    if parser is parsers.parse_toml:
+        return scan_toml_keys(file, encoding)
+    if parser is parsers.parse_ini:
+        return scan_ini_keys(file, encoding)
+    if parser is parsers.parse_xml:
+        return scan_xml_keys(file, encoding)
+    if parser is parsers.parse_svd:
+        return {'cpu', 'device', 'peripherals'}
+    if parser is parsers.parse_csv:
+        return {file.stem}
+    steps = getattr(parser, 'xml_select', None)
+    if steps and steps[0] != '*':
+        # An XML parser made by make_xml_parser only returns the root element if something in it is selected
+        return {steps[0]}
+    return None
+
+
+class LazyFile:
+    "A variable file which is parsed the first time its variables are needed"
+
+    def __init__(self, file: Optional[Path], load: Callable[[Optional[Path]], Mapping]):
+        self.file = file
+        self._load = load
+        self._data: Optional[Mapping] = None
+        self._lock = Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    def data(self) -> Mapping:
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self._load(self.file)
+        return self._data
+
+
+class LazyVariables(Mapping):
+    """The variables of a list of data files, which are only parsed once one of their variables is looked up.
+
+    Each file is added with the top-level keys it provides, as found by `scan_variable_keys`. When several files 
+    provide the same variable, the last one added wins, like with `dict.update`. Iterating over the whole mapping 
+    parses every file, so jinja environments should see it through `restrict`, with the names a template uses.
+    """
+
+    def __init__(self, providers: Dict[str, List[LazyFile]] = None):
+        self._providers: Dict[str, List[LazyFile]] = dict(providers or {})  # variable name -> files which may provide it
+
+    def add_file(self, file: Path, load: Callable[[Path], Mapping], keys: Optional[Iterable[str]] = None) -> LazyFile:
+        "Adds a file which provides `keys`. If `keys` is None, the file is loaded right away to find them."
+        lazy_file = LazyFile(file, load)
+        self._add(lazy_file, lazy_file.data().keys() if keys is None else keys)
+        return lazy_file
+
+    def add_variables(self, variables: Mapping):
+        "Adds variables which are already loaded, overriding the ones from the files added so far"
+        lazy_file = LazyFile(None, lambda _: variables)
+        lazy_file.data()
+        self._add(lazy_file, variables.keys())
+
+    def _add(self, lazy_file: LazyFile, keys: Iterable[str]):
+        for key in keys:
+            # The lists may be shared with copies of this mapping
+            self._providers[key] = self._providers.get(key, []) + [lazy_file]
+
+    def __getitem__(self, key):
+        for lazy_file in reversed(self._providers.get(key, ())):
+            data = lazy_file.data()
+            if key in data:
+                return data[key]
+        raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        # A scanned key may turn out not to be in its file
+        return (key for key in list(self._providers) if key in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def copy(self) -> 'LazyVariables':
+        return type(self)(self._providers)
+
+    def restrict(self, names: Optional[Iterable[str]]) -> 'LazyVariables':
+        "A view of only the variables in `names`, so that other files are never parsed. None means every variable."
+        if names is None:
+            return self.copy()
+        return type(self)({name: self._providers[name] for name in names if name in self._providers})
+
+    def files(self, loaded: Optional[bool] = None) -> List[Path]:
+        "The files providing these variables, or only the loaded or not loaded ones if `loaded` is given"
+        seen: Dict[int, LazyFile] = dict()
+        for providers in self._providers.values():
+            for lazy_file in providers:
+                seen.setdefault(id(lazy_file), lazy_file)
+        return [f.file for f in seen.values() if f.file is not None and (loaded is None or f.loaded == loaded)]
@@ -23,24 +23,46 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
-from yasha.parsers import PARSERS
+from yasha.parsers import PARSERS, make_xml_parser
 from yasha.classes import CLASSES
-from yasha.filters import FILTERS
+from yasha.filters import FILTERS, ShellCache, memoize_filter, memoize_pure_filters, sync_filter
 from yasha.tests import TESTS
 from yasha.constants import EXTENSION_FILE_FORMATS, ENCODING
+from yasha.util import DirectoryCache, dump_template, render_each
+from yasha.profiling import Profiler
+from yasha.frozen import freeze
+from yasha.jobserver import get_jobserver
+from yasha.cache import FragmentCache
+from yasha.lazy import LazyVariables, scan_variable_keys
+from yasha.precompiled import PrecompiledLoader, template_name, write_modules
+from yasha.specialize import specialize
 
 from pathlib import Path
-from typing import BinaryIO, Callable, Dict, List, Union, Iterable, Set
-from copy import deepcopy
+from threading import Lock
+from typing import BinaryIO, Callable, Dict, List, Mapping, Optional, Tuple, Union, Iterable, Set
+import inspect
+import os
+from functools import partial
+from collections import ChainMap, namedtuple
+from types import MappingProxyType
 
 from typing_extensions import Literal
-from jinja2.environment import Environment, TemplateStream
+from jinja2.environment import Environment, Template
 from jinja2.loaders import FileSystemLoader
-from jinja2.meta import find_referenced_templates
+from jinja2.utils import LRUCache, _PassArg
+from jinja2.meta import find_referenced_templates, find_undeclared_variables
+from jinja2.exceptions import TemplateNotFound
+from jinja2 import nodes
+import jinja2.filters
+import jinja2.tests
 from jinja2 import StrictUndefined, DebugUndefined
 
+# Filters, tests and global functions getting the render context or the environment can look up any variable, 
+# so the variables a template refers to aren't known before rendering it when it uses one of them
+UNKNOWABLE_PASS_ARGS = (_PassArg.context, _PassArg.environment)
 
-def find_template_companion_files(template: Path, extensions: Iterable[str], recurse_up_to: Path = None) -> Set[Path]:
+
+def find_template_companion_files(template: Path, extensions: Iterable[str], recurse_up_to: Path = None, cache: DirectoryCache = None) -> Set[Path]:
     """for a given template and list of extensions, find every file related to that template which has one of the extensions.
 
     Args:
@@ -49,6 +71,9 @@ def find_template_companion_files(template: Path, extensions: Iterable[str], rec
         recurse_up_to (Path, optional): 
             Optional parent directory. If provided, will recursively search for companion files 
             in all parent directories up to this one. Defaults to None.
+        cache (DirectoryCache, optional):
+            Directory listings to check for the companion files, shared by several lookups. 
+            Defaults to None, which lists the directories for this lookup only.
     
     Examples:
         `_find_template_companion_files(template=Path('/etc/test/nested/path/template.sh.j2'), extensions=['.json','.yaml','.xml'])` 
@@ -68,7 +93,7 @@ def find_template_companion_files(template: Path, extensions: Iterable[str], rec
             Path('/etc/test/template.json')
             Path('/etc/test/template.yaml')
     """
-    files_to_check = []
+    folders_to_check = [template.parent]
 
     # Get a list of all file names to look for in each folder
     data_file_names = []
@@ -76,19 +101,36 @@ def find_template_companion_files(template: Path, extensions: Iterable[str], rec
     for i in range(len(template.suffixes)):
         ext = ''.join(template.suffixes[:i+1])
         for data_file_ext in extensions:
-            data_file_names.append(Path(basename + ext).with_suffix(data_file_ext))
-
-    # Look for those files in the template's current folder (a.k.a. parent directory)
-    files_to_check.extend([template.parent / file_name for file_name in data_file_names])
+            data_file_names.append(Path(basename + ext).with_suffix(data_file_ext).name)
 
     if recurse_up_to and recurse_up_to in template.parents:
         # Look for those files in every parent directory up to `recurse_up_to`, 
-        # excluding the template's parent directory which has already been checked
+        # excluding the template's parent directory which is already checked
         relative_path = template.parent.relative_to(recurse_up_to)
         for folder in relative_path.parents:
-            for file in data_file_names:
-                files_to_check.append(recurse_up_to / folder / file)
-    return set([file for file in files_to_check if file.is_file()])
+            folders_to_check.append(recurse_up_to / folder)
+
+    cache = cache or DirectoryCache()
+    found = set()
+    for folder in folders_to_check:
+        files_in_folder = cache.files(folder, basename)
+        found.update(folder / file for file in data_file_names if file in files_in_folder)
+    return found
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def _files_signature(files: Iterable[Path]) -> tuple:
+    "A value which changes whenever one of `files` is modified"
+    signature = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+            signature.append((str(file), stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((str(file), None, None))
+    return tuple(signature)
 
 
 class Yasha:
@@ -100,10 +142,21 @@ class Yasha:
             template_lookup_paths: List[Union[Path,str]] = list(), 
             mode: Union[Literal['pedantic'], Literal['debug'], None] = None,
             encoding: str = ENCODING, 
+            profile: bool = False,
+            enable_async: bool = False,
+            freeze_variables: bool = False,
+            template_cache_size: int = 64,
+            buffer_size: int = None,
+            xml_select: str = None,
+            lazy_variables: bool = False,
+            precompiled: Union[Path, str] = None,
+            fragment_cache_dir: Union[Path, str] = None,
+            trace: bool = False,
             **jinja_configs):
         """The core component of this software is the Yasha class. 
         When used as a command-line tool, a new instance will be create with each invocation. 
-        When used as a library, multiple different instances can be created with different configurations
+        When used as a library, multiple different instances can be created with different configurations, 
+        and a single instance can render templates concurrently from multiple threads.
 
         Args:
             root_dir (Path, optional): 
@@ -121,52 +174,138 @@ class Yasha:
                 List of paths to add to jinja's template loader, for `include` and `extends` directives and such.
             mode (Union[Literal[, optional): Whether to run jinja in pedantic or debug mode. Defaults to None.
             encoding (str, optional): file encoding to use for all file operations. Defaults to 'utf-8'.
+            profile (bool, optional): 
+                Whether or not to record the time spent in each phase of loading and rendering, and in each filter.
+                The results are available through `self.profiler.report()`. Defaults to False.
+            enable_async (bool, optional): 
+                Whether or not to compile templates with jinja's async support, which allows templates to be rendered with 
+                `render_template_async`, and the `shell` and `subprocess` filters and async filters from extension files 
+                to run without blocking the event loop. Defaults to False.
+            freeze_variables (bool, optional): 
+                Whether or not to convert the variables from data files and inline variables into immutable, hashable 
+                data structures (see `yasha.frozen.freeze`). Frozen variables can be shared between templates and 
+                threads without copies, and used as memoization keys by filters. Defaults to False.
+            template_cache_size (int, optional): 
+                Number of compiled file templates to keep, along with the data and extensions from their companion files. 
+                A cached template is reused until the template file or one of its companion files is modified. 
+                Set to 0 to compile templates on every render. Defaults to 64.
+            buffer_size (int, optional): 
+                Number of rendered chunks to encode and write at once when rendering into an output file. 
+                0 renders the whole template before writing it. Defaults to None, which picks a size suited to the output.
+            xml_select (str, optional): 
+                Only load the elements at this path of XML variable files, like 'export/devices/device' 
+                (see `yasha.parsers.make_xml_parser`). Defaults to None, which loads whole XML files.
+            lazy_variables (bool, optional): 
+                Whether or not to defer parsing data files until a template looks up one of their variables. 
+                The top-level keys of YAML, TOML, INI, XML, SVD and CSV files are found without parsing them, and a 
+                template only ever sees the variables it, and the templates it includes, imports or extends, refer to, 
+                so data files which provide none of those are never parsed (see `yasha.lazy`). Defaults to False.
+            precompiled (Union[Path, str], optional): 
+                Directory or zip file of templates compiled by `compile_templates` (or `yasha compile`). File templates, 
+                and the templates they include, import or extend, are loaded from there instead of being compiled. 
+                Defaults to None.
+            fragment_cache_dir (Union[Path, str], optional): 
+                Directory in which the `{% cache %}` tag keeps rendered fragments, to reuse them in later runs 
+                (see `yasha.classes.FragmentCacheExtension`). Defaults to None, which keeps them in memory only.
+            trace (bool, optional): 
+                Whether or not to also record every phase, filter call, parser stage and output write as a span of a trace, 
+                which `self.profiler.write_trace(path)` writes in the Chrome trace event format. Implies `profile`. Defaults to False.
             **jinja_configs: any additional keyword arguments with be passed to the constructor of the jinja environment at the core of this class
         """
         self.root = root_dir
         self.parsers = PARSERS.copy()
+        if xml_select:
+            self.parsers['.xml'] = make_xml_parser(xml_select)
         self.template_lookup_paths = [Path(p) for p in template_lookup_paths]
         self.yasha_extensions_files = [Path(p) for p in yasha_extensions_files]
         self.variable_files = [Path(f) for f in variable_files]
         self.encoding = encoding
+        self.freeze_variables = freeze_variables
+        self.profiler = Profiler(enabled=profile or trace, trace=trace)
+        # Directory listings used by the automatic file lookups, shared by every template rendered by this instance.
+        self.directory_cache = DirectoryCache()
+        self.buffer_size = buffer_size
+        self.lazy_variables = LazyVariables() if lazy_variables else None
+        self.precompiled = Path(precompiled) if precompiled else None
+        self._template_cache = LRUCache(template_cache_size) if template_cache_size else None
+        self._template_cache_hits = 0
+        self._template_cache_misses = 0
+        self._template_cache_lock = Lock()
         self.env = Environment()
+        self.env.is_async = enable_async
         if mode == 'pedantic': self.env.undefined = StrictUndefined
         if mode == 'debug': self.env.undefined = DebugUndefined
-        self.env.filters.update(FILTERS)
+        self.env.filters.update(memoize_pure_filters(FILTERS))
+        # Commands run by the shell filters are cached for the duration of a render, or a batch of renders
+        # with `render_each`: each call of a render method runs them again, like each run of the command line.
+        self.shell_cache = ShellCache()
+        if enable_async:
+            self.env.filters.update(self.shell_cache.async_filters())
+        else:
+            self.env.filters.update(self.shell_cache.filters())
         self.env.tests.update(TESTS)
         for jinja_extension in CLASSES:
             self.env.add_extension(jinja_extension)
+        if fragment_cache_dir:
+            self.env.fragment_cache = FragmentCache(fragment_cache_dir)  # type: ignore
+        if self.profiler.enabled:
+            # Memoized filters and macros report their hits and misses to it
+            self.env.yasha_profiler = self.profiler  # type: ignore
         if jinja_configs:
             for config, value in jinja_configs.items():
                 setattr(self.env, config, value)
         for ext in self.yasha_extensions_files:
             self._load_extensions_file(ext)
-        self.env.loader = FileSystemLoader(self.template_lookup_paths)
-        self._load_data_files(self.variable_files)  # data from the data files becomes the baseline for jinja global vars
+        self.env.loader = self._make_loader(self.template_lookup_paths)
+        if self.lazy_variables is not None:
+            # The data files go under the globals set so far, but the variables set from now on (inline ones included) override them
+            self.env.globals = ChainMap(dict(), self.lazy_variables, self.env.globals)  # type: ignore
+        self._load_data_files(self.variable_files, lazy=self.lazy_variables)  # data from the data files becomes the baseline for jinja global vars
+        if freeze_variables: inline_variables = freeze(inline_variables)
         self.env.globals.update(inline_variables) # data from inline variables / directly-specified global variables overrides data from the data files
 
-    def _load_data_files(self, files: Iterable[Path]):
-        "load a list of data files using file parsers from self.parsers, and merge the resulting dicts together into the jinja env globals dict"
+    def _load_data_files(self, files: Iterable[Path], env: Environment = None, parsers: Dict[str, Callable] = None, 
+            lazy: LazyVariables = None):
+        """load a list of data files using file parsers from self.parsers (or `parsers`), 
+        and merge the resulting dicts together into the jinja env globals dict (or the globals of `env`).
+        If `lazy` is given, the files are added to it instead, to be parsed when one of their variables is looked up"""
+        env = env or self.env
+        parsers = self.parsers if parsers is None else parsers
         data = {}
         for file in files:
             ext = file.suffix
-            parser = self.parsers.get(ext)
+            parser = parsers.get(ext)
             if not parser:
                 raise Exception(f"No parser found for data file {file}")
-            # Yasha 4.4 and below used a global variable to track the file encoding each file parser should use.
-            # In Yasha 5.0, the Yasha class instance keeps track of that. 
-            # We need a way to notify the file parsers what the value of the Yasha instance's encoding property is, 
-            # without breaking backwards compatability with existing file parsers people have 
-            # put into extension files out in the wild.
+            if lazy is not None:
+                lazy.add_file(file, partial(self._parse_data_file, parser=parser), scan_variable_keys(file, parser, self.encoding))
+            else:
+                data.update(self._parse_data_file(file, parser))
+        env.globals.update(data)
+
+    def _parse_data_file(self, file: Path, parser: Callable) -> dict:
+        # Yasha 4.4 and below used a global variable to track the file encoding each file parser should use.
+        # In Yasha 5.0, the Yasha class instance keeps track of that. 
+        # We need a way to notify the file parsers what the value of the Yasha instance's encoding property is, 
+        # without breaking backwards compatability with existing file parsers people have 
+        # put into extension files out in the wild.
+        with self.profiler.phase(f'parse {file}'):
             if parser.__code__.co_argcount < 2:
                 # This is an old-style parser
-                data.update(parser(file.open('rb')))
+                data = parser(file.open('rb'))
             else:
-                data.update(parser(file.open('rb'), encoding=self.encoding))
-        self.env.globals.update(data)
+                data = parser(file.open('rb'), encoding=self.encoding)
+        if self.freeze_variables:
+            data = freeze(data)
+        return data
+
+    def _load_extensions_file(self, extensions_file: Path, env: Environment = None, parsers: Dict[str, Callable] = None):
+        """Loads jinja and yasha extensions from a given extension file, and update the jinja environment 
+        (or `env`) and the parsers dict (or `parsers`) with those extensions"""
+        with self.profiler.phase(f'load extensions {extensions_file}'):
+            self._exec_extensions_file(extensions_file, env or self.env, self.parsers if parsers is None else parsers)
 
-    def _load_extensions_file(self, extensions_file: Path):
-        "Loads jinja and yasha extensions from a given extension file, and update the jinja environment with those extensions"
+    def _exec_extensions_file(self, extensions_file: Path, env: Environment, parsers: Dict[str, Callable]):
         from importlib.util import spec_from_file_location, module_from_spec
         from jinja2.ext import Extension
         # load the module
@@ -184,38 +323,38 @@ class Yasha:
             # Tests
             if name.startswith('test_'):
                 name = name[5:]
-                self.env.tests[name] = value
+                env.tests[name] = value
                 continue
             if name == 'TESTS':
-                self.env.tests.update(value)
+                env.tests.update(value)
                 continue
             
             # Filters
             if name.startswith('filter_'):
                 name = name[7:]
-                self.env.filters[name] = value
+                env.filters[name] = self._adapt_filter(name, value)
                 continue
             if name == 'FILTERS':
-                self.env.filters.update(value)
+                env.filters.update({k: self._adapt_filter(k, v) for k, v in value.items()})
                 continue
             
             # Parsers
             if name.startswith('parse_'):
                 name = name[6:]
-                self.parsers['.' + name] = value
+                parsers['.' + name] = value
                 continue
             if name == 'PARSERS':
-                self.parsers.update(value)
+                parsers.update(value)
                 continue
             
             # Jinja Extensions
             if isinstance(value, type) and issubclass(value, Extension):
-                self.env.add_extension(value)
+                env.add_extension(value)
                 continue
             if name == 'CLASSES':
                 assert isinstance(value, list), f"The CLASSES variable in {extensions_file} must be a list of jinja extension classes, or strings referencing jinja extension classes"
                 for ext in value:
-                    self.env.add_extension(ext)
+                    env.add_extension(ext)
                 continue
                 
             # Jinja Configuration
@@ -226,14 +365,24 @@ class Yasha:
             ]
             if name in configuration_directives:
                 name = name.lower()
-                setattr(self.env, name, value)
+                setattr(env, name, value)
     
+    def _adapt_filter(self, name: str, func: Callable) -> Callable:
+        """async filters from extension files can only be awaited in environments with async support, other environments run them to completion.
+        Filters marked with `yasha.filters.pure` are memoized within each render."""
+        if not self.env.is_async:
+            func = sync_filter(func)
+        if getattr(func, 'yasha_pure', None):
+            func = memoize_filter(name, func)
+        return func
+
     def render_template(self, 
             template: Union[Path, str], 
             find_data_files = True, 
             find_extension_files = True, 
             jinja_env_overrides = dict(), 
-            output: BinaryIO = None) -> Union[str, BinaryIO]:
+            output: BinaryIO = None,
+            variables: dict = None) -> Union[str, BinaryIO]:
         """Render a single template
 
         Args:
@@ -249,41 +398,371 @@ class Yasha:
                 Defaults to True.
             jinja_env_overrides (dict, optional): Any Jinja environment configurations to override for this specific template.
             output (BinaryIO, optional): an open binary file to render the template into.
+            variables (dict, optional): variables for this render only, which override the global variables.
+        """
+        compiled_template = self._compile_template(template, find_data_files, find_extension_files, jinja_env_overrides)
+        self.shell_cache.clear()
+
+        if output:
+            # Don't return the rendered template, stream it to a file
+            with self.profiler.phase('render'):
+                dump_template(compiled_template, variables or {}, output, encoding=self.encoding, buffer_size=self.buffer_size)
+            return output
+        else:
+            with self.profiler.phase('render'):
+                return compiled_template.render(variables or {})
+
+    def render_each(self, 
+            template: Union[Path, str], 
+            contexts: Iterable[Mapping], 
+            output_pattern: str, 
+            find_data_files = True, 
+            find_extension_files = True, 
+            jinja_env_overrides = dict(), 
+            workers: int = 1) -> List[Path]:
+        """Render a single template once for each set of variables in `contexts`, for example once per row of a CSV file.
+        The template and its companion files are loaded and compiled only once.
+
+        Args:
+            template (Union[Path, str]): the path to the template file to render, or a template string to render
+            contexts (Iterable[Mapping]): 
+                variables for each render, which override the global variables. 
+                Can be any iterable, including a generator, and is consumed as the renders progress.
+            output_pattern (str): 
+                `str.format` pattern of the file to render each context into. It can refer to `{index}`, 
+                the position of the context, and to any of the context's variables, e.g. 'include/{peripheral[name]}.h'
+            find_data_files, find_extension_files, jinja_env_overrides: see `render_template`
+            workers (int, optional): 
+                Number of threads rendering at once. None picks a number based on the CPU count. Defaults to 1. 
+                When running under `make -jN`, the renders also share the job slots of make (see `yasha.jobserver`).
+
+        Returns:
+            List[Path]: the rendered files, in the order of `contexts`
+        """
+        compiled_template = self._compile_template(template, find_data_files, find_extension_files, jinja_env_overrides)
+        self.shell_cache.clear()
+        with self.profiler.phase('render'):
+            return render_each(compiled_template, contexts, output_pattern, encoding=self.encoding, workers=workers, 
+                               jobserver=get_jobserver())
+
+    async def render_template_async(self, 
+            template: Union[Path, str], 
+            find_data_files = True, 
+            find_extension_files = True, 
+            jinja_env_overrides = dict(), 
+            output: BinaryIO = None,
+            variables: dict = None) -> Union[str, BinaryIO]:
+        """Render a single template without blocking the event loop. Requires the instance to be created with `enable_async=True`.
+        Takes the same arguments as `render_template`.
         """
+        if not self.env.is_async:
+            raise RuntimeError("render_template_async requires a Yasha instance created with enable_async=True")
+        compiled_template = self._compile_template(template, find_data_files, find_extension_files, jinja_env_overrides)
+        self.shell_cache.clear()
+
+        with self.profiler.phase('render'):
+            if output:
+                # Don't return the rendered template, stream it to a file
+                async for chunk in compiled_template.generate_async(variables or {}):
+                    output.write(chunk.encode(self.encoding))
+                return output
+            else:
+                return await compiled_template.render_async(variables or {})
+
+    def _compile_template(self, 
+            template: Union[Path, str], 
+            find_data_files: bool, 
+            find_extension_files: bool, 
+            jinja_env_overrides: dict) -> Template:
+        """Load the files related to a template, and compile it. 
+        Everything specific to this render happens in an isolated environment, leaving the base environment untouched, 
+        so that a single Yasha instance can render many templates concurrently.
+        File templates are kept in the template cache along with their isolated environment."""
+        if isinstance(template, Path) and self._template_cache is not None:
+            key = (template.resolve(), find_data_files, find_extension_files, repr(sorted(jinja_env_overrides.items())))
+            cached = self._template_cache.get(key)
+            if cached is not None:
+                signature, parser_extensions, referenced_files, compiled_template = cached
+                if signature == self._template_signature(template, find_data_files, find_extension_files, parser_extensions, referenced_files):
+                    self._count_template_cache(hit=True)
+                    return compiled_template
+            self._count_template_cache(hit=False)
+            compiled_template, parsers, referenced_files = self._compile_template_uncached(template, find_data_files, find_extension_files, jinja_env_overrides)
+            signature = self._template_signature(template, find_data_files, find_extension_files, parsers.keys(), referenced_files)
+            self._template_cache[key] = (signature, tuple(parsers), referenced_files, compiled_template)
+            return compiled_template
+        return self._compile_template_uncached(template, find_data_files, find_extension_files, jinja_env_overrides)[0]
+
+    def _template_signature(self, template: Path, find_data_files: bool, find_extension_files: bool, parser_extensions: Iterable[str], 
+            referenced_files: Iterable[Path] = ()) -> tuple:
+        """A value which changes whenever the template file or one of its companion files is modified, 
+        or one of `referenced_files`, the templates whose variables were taken into account with lazy variables"""
+        files = [template, *referenced_files]
+        if find_extension_files:
+            files.extend(sorted(find_template_companion_files(template, EXTENSION_FILE_FORMATS, self.root, self.directory_cache)))
+        if find_data_files:
+            files.extend(sorted(find_template_companion_files(template, parser_extensions, self.root, self.directory_cache)))
+        return _files_signature(files)
+
+    def _count_template_cache(self, hit: bool):
+        with self._template_cache_lock:
+            if hit:
+                self._template_cache_hits += 1
+            else:
+                self._template_cache_misses += 1
+
+    def template_cache_info(self) -> CacheInfo:
+        "Hit and miss statistics of the compiled template cache, in the style of `functools.lru_cache`"
+        with self._template_cache_lock:
+            if self._template_cache is None:
+                return CacheInfo(self._template_cache_hits, self._template_cache_misses, 0, 0)
+            return CacheInfo(self._template_cache_hits, self._template_cache_misses, 
+                             self._template_cache.capacity, len(self._template_cache))
+
+    def clear_template_cache(self):
+        if self._template_cache is not None:
+            self._template_cache.clear()
+
+    def _compile_template_uncached(self, 
+            template: Union[Path, str], 
+            find_data_files: bool, 
+            find_extension_files: bool, 
+            jinja_env_overrides: dict) -> Tuple[Template, Dict[str, Callable], Tuple[Path, ...]]:
+        """Returns the compiled template, the parsers of its data files, and the templates it references 
+        whose variables were taken into account with lazy variables"""
+        env = self._make_isolated_env_for_template(template)
+        if env is self.env and (jinja_env_overrides or self.profiler.enabled or self.lazy_variables is not None):
+            # This render alters the environment after all
+            env = self._make_isolated_env()
+        # With lazy variables, the data files of this template are added on top of the ones of the Yasha instance
+        lazy = LazyVariables() if self.lazy_variables is not None else None
 
         if isinstance(template, Path):
             # Automatic file lookup only works if template is a file. 
             # If template is a str (like, for example, something piped in to Yasha's STDIN), then don't bother trying to find related files
+            parsers = self.parsers.copy()
 
             if find_extension_files:
                 # load extension files related to this template, updating the local env and the local parsers dict
-                extension_files = find_template_companion_files(template, EXTENSION_FILE_FORMATS, self.root)
+                with self.profiler.phase('find companion files'):
+                    extension_files = find_template_companion_files(template, EXTENSION_FILE_FORMATS, self.root, self.directory_cache)
                 for ext in extension_files:
-                    self._load_extensions_file(ext)
+                    self._load_extensions_file(ext, env, parsers)
 
             if find_data_files:
                 # load variable files related to this template, merging their variables into the local env's globals object
-                data_files = find_template_companion_files(template, self.parsers.keys(), self.root)
-                self._load_data_files(data_files)
+                with self.profiler.phase('find companion files'):
+                    data_files = find_template_companion_files(template, parsers.keys(), self.root, self.directory_cache)
+                self._load_data_files(data_files, env, parsers, lazy)
             
             # Add the template's directory to the template loader's search path
-            self.env.loader.searchpath.append(template.parent) # type: ignore
-            # Read the template string from the template path
-            template_text = template.read_text()
+            env.loader.searchpath.append(template.parent) # type: ignore
         else:
-            template_text = template
+            parsers = self.parsers
             
-        for k, v in jinja_env_overrides:
-            setattr(self.env, k, v)
-        
-        if output:
-            # Don't return the rendered template, stream it to a file
-            compiled_template: TemplateStream = self.env.from_string(template_text).stream()
-            compiled_template.enable_buffering(5)
-            compiled_template.dump(output, encoding=self.encoding)
-            return output
+        for k, v in jinja_env_overrides.items():
+            setattr(env, k, v)
+
+        if self.profiler.enabled:
+            env.filters = self.profiler.wrap_filters(env.filters)
+
+        referenced_files: Tuple[Path, ...] = ()
+        precompiled = self.precompiled is not None and isinstance(template, Path)
+        if precompiled:
+            # Precompiled templates are never compiled, or even read
+            source = None
+        elif isinstance(template, Path):
+            # Read the template through a loader, like jinja does for included templates, so that error messages 
+            # and tracebacks point to the template file
+            source, filename, uptodate = FileSystemLoader(template.parent, encoding=self.encoding).get_source(env, template.name)
         else:
-            return self.env.from_string(template_text).render()
+            source, filename, uptodate = template, None, None
+
+        if lazy is not None:
+            names = None
+            # The globals set for this template, like the ones installed by its extension files, are kept as they are
+            template_globals = env.globals.maps[0] if isinstance(env.globals, ChainMap) else dict(env.globals)
+            if source is not None:
+                with self.profiler.phase('find variables'):
+                    # jinja leaves the names of global variables out of the undeclared ones, looking them up in the process
+                    env.globals = dict()
+                    names, referenced_files = self._find_variable_names(env, source, template_globals)
+            # Only the variables the template can look up are visible, so that jinja never asks for the others
+            maps = self.env.globals.maps if isinstance(self.env.globals, ChainMap) else [self.env.globals]
+            env.globals = ChainMap(template_globals, lazy.restrict(names), *(  # type: ignore
+                m.restrict(names) if isinstance(m, LazyVariables) else MappingProxyType(m) for m in maps))
+
+        if precompiled:
+            with self.profiler.phase('load precompiled'):
+                return env.loader.load_file(env, template), parsers, referenced_files  # type: ignore
+
+        with self.profiler.phase('compile'):
+            if isinstance(template, Path):
+                code = env.compile(source, template.name, filename)
+                return env.template_class.from_code(env, code, env.make_globals(None), uptodate), parsers, referenced_files
+            return env.from_string(template), parsers, referenced_files
+
+    def compile_templates(self, 
+            templates: Iterable[Union[Path, str]], 
+            target: Union[Path, str], 
+            zip: Union[Literal['deflated'], Literal['stored'], None] = None,
+            find_extension_files = True) -> List[str]:
+        """Compile template files ahead of time into python modules, for the `precompiled` argument or jinja's `ModuleLoader`.
+
+        Like `jinja2.Environment.compile_templates`, but each template is compiled with the jinja extensions, filters, 
+        tests and template syntax of its own extension files. The output only depends on the templates and extensions, 
+        so the same sources always give the same bytes.
+
+        Args:
+            templates (Iterable[Union[Path, str]]): the template files to compile, see `yasha.precompiled.find_templates`
+            target (Union[Path, str]): directory to write the modules to, or zip file if `zip` is given
+            zip (str, optional): compression of the zip file, 'deflated' or 'stored'. Defaults to None, which writes a directory.
+            find_extension_files (bool, optional): Wether or not to load the extension files of each template. Defaults to True.
+
+        Returns:
+            List[str]: the names of the compiled templates, which are their paths relative to the current directory
+        """
+        modules = dict()
+        for template in map(Path, templates):
+            env = self._make_isolated_env()
+            if find_extension_files:
+                with self.profiler.phase('find companion files'):
+                    extension_files = find_template_companion_files(template, EXTENSION_FILE_FORMATS, self.root, self.directory_cache)
+                for ext in extension_files:
+                    self._load_extensions_file(ext, env, self.parsers.copy())
+            name = template_name(template)
+            source, filename, _ = FileSystemLoader(template.parent, encoding=self.encoding).get_source(env, template.name)
+            with self.profiler.phase('compile'):
+                modules[name] = env.compile(source, name, filename, raw=True, defer_init=True)
+        with self.profiler.phase('write precompiled'):
+            write_modules(modules, target, zip)
+        return sorted(modules)
+
+    def specialize_templates(self, 
+            templates: Iterable[Union[Path, str]], 
+            target: Union[Path, str], 
+            zip: Union[Literal['deflated'], Literal['stored'], None] = None,
+            find_data_files = True,
+            find_extension_files = True) -> Dict[str, Set[str]]:
+        """Specialize template files for the variables of this instance and of their data files, which are static, 
+        and compile them ahead of time like `compile_templates`.
+
+        Static variables are replaced by their values, constant expressions are evaluated and `if` branches which 
+        can't be taken are removed (see `yasha.specialize.Specializer`). The compiled templates are then rendered 
+        with the `precompiled` argument, and the remaining, dynamic variables. Included, imported and extended 
+        templates aren't specialized, but they are compiled into `target` too, like `compile_templates` does, 
+        so that the specialized templates can be rendered from it. Templates whose names are only known at 
+        render time must be compiled separately.
+
+        Args:
+            templates (Iterable[Union[Path, str]]): the template files to specialize
+            target (Union[Path, str]): directory to write the modules to, or zip file if `zip` is given
+            zip (str, optional): compression of the zip file, 'deflated' or 'stored'. Defaults to None, which writes a directory.
+            find_data_files (bool, optional): Wether or not to load the data files of each template as static variables. Defaults to True.
+            find_extension_files (bool, optional): Wether or not to load the extension files of each template. Defaults to True.
+
+        Returns:
+            Dict[str, Set[str]]: the name of each specialized template -> the static variables it still refers to, 
+                because their values can't be written into a template, like objects. They must still be given to render it.
+        """
+        modules = dict()
+        referenced: Dict[str, str] = dict()
+        remaining = dict()
+        for template in map(Path, templates):
+            env = self._make_isolated_env()
+            parsers = self.parsers.copy()
+            if find_extension_files:
+                with self.profiler.phase('find companion files'):
+                    extension_files = find_template_companion_files(template, EXTENSION_FILE_FORMATS, self.root, self.directory_cache)
+                for ext in extension_files:
+                    self._load_extensions_file(ext, env, parsers)
+            if find_data_files:
+                with self.profiler.phase('find companion files'):
+                    data_files = find_template_companion_files(template, parsers.keys(), self.root, self.directory_cache)
+                self._load_data_files(data_files, env, parsers)
+            name = template_name(template)
+            source, filename, _ = FileSystemLoader(template.parent, encoding=self.encoding).get_source(env, template.name)
+            with self.profiler.phase('specialize'):
+                ast, remaining[name] = specialize(env, env.parse(source, name, filename), env.globals, name)
+            with self.profiler.phase('compile'):
+                modules[name] = env.compile(ast, name, filename, raw=True, defer_init=True)
+            self._compile_referenced_templates(env, ast, template, referenced, find_extension_files)
+        with self.profiler.phase('write precompiled'):
+            # The specialized version of a template wins over its plain version referenced by another template
+            write_modules(dict(referenced, **modules), target, zip)
+        return remaining
+
+    def _compile_referenced_templates(self, env: Environment, ast: nodes.Template, template: Path, modules: Dict[str, str], 
+            find_extension_files: bool):
+        """Compiles the templates `ast`, the template file `template` parsed by `env`, includes, imports or extends, 
+        and the ones they reference in turn, into `modules`, a dict of template name -> python source code, 
+        like `compile_templates` does. Templates whose names are computed at render time are left out."""
+        pending = [(env, ast, template)]
+        while pending:
+            env, ast, template = pending.pop()
+            # Found like the loader of a render of `template` would find them
+            loader = FileSystemLoader(env.loader.searchpath + [template.parent], encoding=self.encoding)  # type: ignore
+            for reference in find_referenced_templates(ast):
+                if reference is None:
+                    continue
+                _, filename, _ = loader.get_source(env, reference)
+                file = Path(filename)  # type: ignore
+                name = template_name(file)
+                if name in modules:
+                    continue
+                file_env = self._make_isolated_env()
+                if find_extension_files:
+                    with self.profiler.phase('find companion files'):
+                        extension_files = find_template_companion_files(file, EXTENSION_FILE_FORMATS, self.root, self.directory_cache)
+                    for ext in extension_files:
+                        self._load_extensions_file(ext, file_env, self.parsers.copy())
+                source, filename, _ = FileSystemLoader(file.parent, encoding=self.encoding).get_source(file_env, file.name)
+                file_ast = file_env.parse(source, name, filename)
+                with self.profiler.phase('compile'):
+                    modules[name] = file_env.compile(file_ast, name, filename, raw=True, defer_init=True)
+                pending.append((file_env, file_ast, file))
+
+    def _find_variable_names(self, env: Environment, source: str, template_globals: Mapping = {}) -> Tuple[Optional[Set[str]], Tuple[Path, ...]]:
+        """The names of the global variables a template, and the templates it includes, imports or extends, can look up,
+        along with the files of those templates. The names are None if they can't be known before rendering: when a 
+        template name is computed at render time, or when a filter, test, global function (of the Yasha instance or 
+        in `template_globals`) or jinja extension from outside of jinja and yasha gets the whole render context 
+        or the environment, whose globals it could read."""
+        files: List[Path] = []
+        if any(not type(ext).__module__.startswith(('jinja2.', 'yasha.')) for ext in env.extensions.values()):
+            return None, ()
+        eager_globals = [m for m in self.env.globals.maps if not isinstance(m, LazyVariables)] \
+            if isinstance(self.env.globals, ChainMap) else [self.env.globals]
+        names: Set[str] = set()
+        seen: Set[str] = set()
+        pending = [source]
+        while pending:
+            ast = env.parse(pending.pop())
+            names.update(find_undeclared_variables(ast))
+            for node in ast.find_all((nodes.Filter, nodes.Test)):
+                table, builtins = (env.filters, jinja2.filters.FILTERS) if isinstance(node, nodes.Filter) else (env.tests, jinja2.tests.TESTS)
+                func = table.get(node.name)
+                func = inspect.unwrap(func) if func is not None else None  # filters wrapped by the profiler or memoized
+                if func is not builtins.get(node.name) and _PassArg.from_obj(func) in UNKNOWABLE_PASS_ARGS:
+                    return None, tuple(files)
+            for name in find_referenced_templates(ast):
+                if name is None:
+                    return None, tuple(files)
+                if name in seen:
+                    continue
+                seen.add(name)
+                try:
+                    source, filename, _ = env.loader.get_source(env, name)  # type: ignore
+                except TemplateNotFound:
+                    return None, tuple(files)
+                if filename:
+                    files.append(Path(filename))
+                pending.append(source)
+        for name in names:
+            for m in [template_globals, *eager_globals]:
+                if name in m and _PassArg.from_obj(m[name]) in UNKNOWABLE_PASS_ARGS:
+                    return None, tuple(files)
+        return names, tuple(files)
 
     def _make_isolated_env_for_template(self, template: Union[Path, str]) -> Environment:
         """When rendering or working with multiple template files, we load extension files related to those templates, 
@@ -295,18 +774,27 @@ class Yasha:
         if isinstance(template, str):
             # string tempaltes have no associated files, and therefore don't alter the environment. They can use the base environment directly
             return self.env
-        
+        return self._make_isolated_env()
+
+    def _make_isolated_env(self) -> Environment:
         # Deplicate the base env, but replace references to dictionaries in the base env with copies of those dictionaries
         env: Environment = self.env.overlay()
-        # globals can be a nested data structure, so it must be deep copied
-        env.globals = deepcopy(env.globals)
+        # Rather than copying the globals, which can hold large data structures, layer a per-template dict 
+        # on top of a read-only view of the base env's globals. Variables set for this template go into the 
+        # top layer and shadow the base ones, while the base env's globals are never written to.
+        env.globals = ChainMap(dict(), MappingProxyType(self.env.globals))  # type: ignore
         # filters and tests can be shallow-copied
         env.filters = env.filters.copy()
         env.tests = env.tests.copy()
         # create a new filesystem loader
         searchpath = env.loader.searchpath.copy()  # type: ignore
-        env.loader = FileSystemLoader(searchpath=searchpath)
+        env.loader = self._make_loader(searchpath)
         return env
+
+    def _make_loader(self, searchpath: List[Union[Path, str]]) -> Union[FileSystemLoader, PrecompiledLoader]:
+        if self.precompiled is not None:
+            return PrecompiledLoader(self.precompiled, searchpath)
+        return FileSystemLoader(searchpath=searchpath)
     
     def get_makefile_dependencies(self, template: Union[Path, str]) -> List[Path]:
         """Produces a list of all files that the rendering of this template depends on, 
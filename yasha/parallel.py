@@ -0,0 +1,79 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from yasha.jobserver import Jobserver
+
+# The ranges rendered by the parallel loop being rendered, which the worker processes inherit when they are forked
+_work: Optional[Callable[[int, int], List[str]]] = None
+_lock = threading.Lock()
+
+
+def _render_range(bounds: Tuple[int, int]) -> List[str]:
+    start, stop = bounds
+    return _work(start, stop)  # type: ignore
+
+
+def can_fork() -> bool:
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def render_parallel(render_range: Callable[[int, int], List[str]], count: int, workers: int,
+                    jobserver: Optional[Jobserver] = None) -> List[str]:
+    """Renders the items 0 to `count` of a loop with `render_range(start, stop)`, which returns the rendered items
+    of a range, in `workers` processes. Returns the rendered items in order.
+
+    The worker processes are forked, so `render_range` and the data it renders don't need to be picklable,
+    but the rendered items do. With a `jobserver`, every range is a job of the GNU Make jobserver. The items
+    are rendered in this process when there's a single worker or item, when the platform can't fork,
+    when another parallel loop is being rendered, like in a worker or in another thread, and when other
+    threads are running: a lock they hold when the process forks, like the one of jinja's template cache,
+    would never be released in the workers.
+    """
+    global _work
+    if workers <= 1 or count <= 1 or not can_fork() or threading.active_count() > 1 \
+            or not _lock.acquire(blocking=False):
+        return render_range(0, count)
+    try:
+        _work = render_range
+        # A few ranges per worker, so that a slow range doesn't keep the others waiting
+        size = max(1, -(-count // (workers * 4)))
+        ranges = [(start, min(start + size, count)) for start in range(0, count, size)]
+        with multiprocessing.get_context('fork').Pool(min(workers, len(ranges))) as pool:
+            if jobserver is None:
+                parts = pool.map(_render_range, ranges, chunksize=1)
+            else:
+                def render_job(bounds):
+                    with jobserver.job():
+                        return pool.apply(_render_range, (bounds,))
+                with ThreadPoolExecutor(max_workers=workers) as threads:
+                    parts = list(threads.map(render_job, ranges))
+    finally:
+        _work = None
+        _lock.release()
+    return [item for part in parts for item in part]
@@ -23,8 +23,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
+from functools import lru_cache
+from importlib import import_module
 from pathlib import Path
-from typing import BinaryIO, Callable, Dict
+from types import ModuleType
+from typing import BinaryIO, Callable, Dict, Tuple
 
 from yasha.constants import ENCODING
 
@@ -41,8 +44,23 @@ def parse_yaml(file: BinaryIO, encoding = ENCODING):
     variables = yaml.safe_load(file)
     return variables if variables else dict()
 
+# TOML modules, in order of preference: the standard library (Python 3.11+), its backport, then the original pure Python parser
+TOML_BACKENDS = ('tomllib', 'tomli', 'pytoml')
+
+
+@lru_cache(maxsize=None)
+def import_toml_backend(names: Tuple[str, ...] = TOML_BACKENDS) -> ModuleType:
+    """Returns the first of the TOML modules `names` which can be imported.
+    They all provide a `load` function which takes a binary file and returns dicts, lists and plain values."""
+    for name in names:
+        try:
+            return import_module(name)
+        except ImportError:
+            continue
+    raise ImportError(f"No TOML parser found, install one of {', '.join(names)}")
+
 def parse_toml(file: BinaryIO, encoding = ENCODING):
-    import pytoml as toml
+    toml = import_toml_backend()
     assert file.name.endswith('.toml')
     variables = toml.load(file)
     return variables if variables else dict()
@@ -50,9 +68,90 @@ def parse_toml(file: BinaryIO, encoding = ENCODING):
 def parse_xml(file: BinaryIO, encoding = ENCODING):
     import xmltodict
     assert file.name.endswith('.xml')
-    variables = xmltodict.parse(file.read().decode(ENCODING))
+    # xmltodict feeds a file object to expat chunk by chunk, instead of decoding it into one big str
+    variables = xmltodict.parse(file)
     return variables if variables else dict()
 
+
+def _local_name(tag: str) -> str:
+    "'{http://example.com/ns}item' -> 'item'"
+    return tag.rsplit('}', 1)[-1]
+
+
+def _xml_element_to_dict(element):
+    "Converts an ElementTree element to the same value xmltodict gives it"
+    value = dict(('@' + _local_name(k), v) for k, v in element.attrib.items())
+    for child in element:
+        name = _local_name(child.tag)
+        child_value = _xml_element_to_dict(child)
+        if name in value:
+            if not isinstance(value[name], list):
+                value[name] = [value[name]]
+            value[name].append(child_value)
+        else:
+            value[name] = child_value
+    text = (element.text or '').strip()
+    if not value:
+        return text or None
+    if text:
+        value['#text'] = text
+    return value
+
+
+def make_xml_parser(select: str) -> Callable:
+    """Returns an XML file parser which only loads the elements matching `select`.
+
+    `select` is a path of element names from the root element, like 'export/devices/device',
+    in which `*` matches any name. Namespaces are ignored. The file is streamed with
+    `ElementTree.iterparse`, and every element outside of the selected ones is dropped
+    as soon as it has been parsed, so the size of the file doesn't matter, only the size
+    of the selection. The selected elements keep their place in the document: the
+    variables are the ones `parse_xml` would return, minus everything which isn't selected.
+    """
+    steps = [step for step in select.split('/') if step]
+    if not steps:
+        raise ValueError(f"Invalid XML selector '{select}'")
+
+    def matches(path):
+        return len(path) == len(steps) and all(s in ('*', p) for s, p in zip(steps, path))
+
+    def parse_xml(file: BinaryIO, encoding = ENCODING):
+        from xml.etree.ElementTree import iterparse
+        variables: dict = dict()
+        path = []
+        elements = []
+        selected = None  # the selected element which is currently being parsed, if any
+        for event, element in iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                path.append(_local_name(element.tag))
+                elements.append(element)
+                if selected is None and matches(path):
+                    selected = element
+                continue
+            if element is selected:
+                parent = variables
+                for name in path[:-1]:
+                    parent = parent.setdefault(name, dict())
+                value = _xml_element_to_dict(element)
+                if path[-1] in parent:
+                    if not isinstance(parent[path[-1]], list):
+                        parent[path[-1]] = [parent[path[-1]]]
+                    parent[path[-1]].append(value)
+                else:
+                    parent[path[-1]] = value
+                selected = None
+            if selected is None:
+                # Drop the element, so that memory use doesn't grow with the size of the file
+                element.clear()
+                if len(elements) > 1:
+                    elements[-2].remove(element)
+            path.pop()
+            elements.pop()
+        return variables
+
+    parse_xml.xml_select = steps  # type: ignore
+    return parse_xml
+
 def parse_svd(file: BinaryIO, encoding = ENCODING):
     # TODO: To be moved into its own repo
     from .cmsis import SVDFile
@@ -0,0 +1,98 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from jinja2.environment import Environment, Template
+from jinja2.exceptions import TemplateNotFound
+from jinja2.loaders import ModuleLoader
+
+from yasha.constants import EXTENSION_FILE_FORMATS
+from yasha.parsers import PARSERS
+
+
+def template_name(path: Union[Path, str]) -> str:
+    """The name of a precompiled template: the path of its source file relative to the current directory, 
+    with forward slashes, so that templates are found by the same paths when they're precompiled and rendered"""
+    return Path(os.path.relpath(str(path))).as_posix()
+
+
+def find_templates(directory: Path) -> List[Path]:
+    "Every file under `directory` which isn't a variable file, an extension file or hidden, in a stable order"
+    templates = []
+    for root, dirs, files in os.walk(str(directory)):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__')
+        for file in sorted(files):
+            if file.startswith('.') or file.endswith(EXTENSION_FILE_FORMATS) or file.endswith(tuple(PARSERS)):
+                continue
+            templates.append(Path(root) / file)
+    return templates
+
+
+def write_modules(modules: Dict[str, str], target: Union[Path, str], zip: Optional[str] = None):
+    """Writes compiled templates, a dict of template name -> python source code, the way 
+    `jinja2.Environment.compile_templates` does: as modules in the directory `target`, or with `zip` 
+    ('deflated' or 'stored') in the zip file `target`. The files are written in a stable order, 
+    with fixed timestamps in zip files, so that the same templates always give the same bytes."""
+    files = sorted((ModuleLoader.get_module_filename(name), code.encode('utf8')) for name, code in modules.items())
+    if zip:
+        with ZipFile(str(target), 'w', dict(deflated=ZIP_DEFLATED, stored=ZIP_STORED)[zip]) as zip_file:
+            for filename, data in files:
+                info = ZipInfo(filename)  # dated 1980-01-01
+                info.external_attr = 0o644 << 16
+                info.compress_type = zip_file.compression
+                zip_file.writestr(info, data)
+        return
+    os.makedirs(str(target), exist_ok=True)
+    for filename, data in files:
+        with open(os.path.join(str(target), filename), 'wb') as f:
+            f.write(data)
+
+
+class PrecompiledLoader(ModuleLoader):
+    """Loads the templates compiled by `yasha compile` or `Yasha.compile_templates`, from a directory or a zip file.
+
+    Like a `FileSystemLoader`, a template name is looked up in each directory of `searchpath` in turn, 
+    and found if the file it names there was precompiled. Templates are never compiled from their sources.
+    """
+
+    def __init__(self, path: Union[Path, str], searchpath: Iterable[Union[Path, str]] = ('.',)):
+        # zipimport caches the contents of zip files by path, which must not depend on the current directory
+        super().__init__(os.path.abspath(str(path)))
+        self.searchpath = [str(p) or '.' for p in searchpath]
+
+    def load(self, environment: Environment, name: str, globals=None) -> Template:
+        for directory in self.searchpath:
+            try:
+                return super().load(environment, template_name(os.path.join(directory, name)), globals)
+            except TemplateNotFound:
+                continue
+        raise TemplateNotFound(name)
+
+    def load_file(self, environment: Environment, path: Union[Path, str]) -> Template:
+        "Loads the precompiled template of the file `path`, with the globals of `environment`"
+        return super().load(environment, template_name(path), environment.make_globals(None))
@@ -0,0 +1,214 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import inspect
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+from typing_extensions import Literal
+
+
+# The profiler of the phase running in each thread, which records the spans of the code it calls, see `span`
+_active = threading.local()
+
+
+def active_profiler() -> Optional['Profiler']:
+    return getattr(_active, 'profiler', None)
+
+
+@contextmanager
+def activated(profiler: Optional['Profiler']):
+    "Make `profiler` the active profiler of this thread, for the block of code in the `with` statement"
+    previous = getattr(_active, 'profiler', None)
+    _active.profiler = profiler
+    try:
+        yield
+    finally:
+        _active.profiler = previous
+
+
+@contextmanager
+def span(name: str, category: str = 'yasha') -> Iterator[dict]:
+    """Record the block of code in the `with` statement as a span of the trace of the active profiler, if it
+    records one. Code which doesn't know about the profiler, like parsers, uses it. The `with` statement gets
+    a dict of arguments, which are shown along with the span."""
+    profiler = getattr(_active, 'profiler', None)
+    if profiler is None or not profiler.tracing:
+        yield dict()
+        return
+    with profiler.span(name, category) as args:
+        yield args
+
+
+class Profiler:
+    """Collects the time spent in each phase of a render, the number of calls and time spent in each filter,
+    and the hits and misses of the memoized filters and macros. With `trace`, it also records every phase,
+    filter call and span as an event of a trace, in the Chrome trace event format (see `trace_events`).
+
+    A disabled profiler records nothing, so instrumented code can use it unconditionally.
+    """
+
+    def __init__(self, enabled: bool = True, trace: bool = False):
+        self.enabled = enabled
+        self.tracing = enabled and trace
+        self.events: List[dict] = list()  # complete ('X') trace events
+        self.phases: Dict[str, List[float]] = dict()  # phase name -> [calls, total seconds]
+        self.filters: Dict[str, List[float]] = dict()  # filter name -> [calls, total seconds]
+        self.memos: Dict[str, List[int]] = dict()  # memoized filter or macro name -> [hits, misses]
+        self._lock = threading.Lock()
+
+    def _record(self, table: Dict[str, List[float]], name: str, elapsed: float):
+        with self._lock:
+            entry = table.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def add_span(self, name: str, category: str, start: float, end: float, args: dict = None):
+        "Add a span which started and ended at the `perf_counter()` times `start` and `end` to the trace"
+        event = dict(name=name, cat=category, ph='X', ts=start * 1e6, dur=(end - start) * 1e6,
+                     pid=os.getpid(), tid=threading.get_ident())
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'yasha') -> Iterator[dict]:
+        "Record the block of code in the `with` statement as a span of the trace. The `with` statement gets a dict of arguments for the span"
+        args: dict = dict()
+        if not self.tracing:
+            yield args
+            return
+        start = perf_counter()
+        try:
+            yield args
+        finally:
+            self.add_span(name, category, start, perf_counter(), args)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the block of code in the `with` statement as one call of the phase `name`.
+        The profiler is the active one during the phase, see `span`"""
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            with activated(self):
+                yield
+        finally:
+            end = perf_counter()
+            self._record(self.phases, name, end - start)
+            if self.tracing:
+                self.add_span(name, 'phase', start, end)
+
+    def record_memo(self, name: str, hit: bool):
+        "Record a call of the memoized filter or macro `name`, which was either a cache hit or a miss"
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.memos.setdefault(name, [0, 0])
+            entry[0 if hit else 1] += 1
+
+    def wrap_filter(self, name: str, func: Callable) -> Callable:
+        "Returns a version of the filter `func` which records its calls under `name`"
+        if not self.enabled or getattr(func, 'yasha_profiled', False):
+            return func
+
+        # functools.wraps also copies the attributes set by jinja's pass_context / pass_environment decorators
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def profiled_filter(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._record_filter(name, start)
+        else:
+            @wraps(func)
+            def profiled_filter(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._record_filter(name, start)
+        profiled_filter.yasha_profiled = True  # type: ignore
+        return profiled_filter
+
+    def _record_filter(self, name: str, start: float):
+        end = perf_counter()
+        self._record(self.filters, name, end - start)
+        if self.tracing:
+            self.add_span(name, 'filter', start, end)
+
+    def wrap_filters(self, filters: Dict[str, Callable]) -> Dict[str, Callable]:
+        "Returns a copy of the `filters` dict in which every filter records its calls"
+        return {name: self.wrap_filter(name, func) for name, func in filters.items()}
+
+    def as_dict(self) -> dict:
+        def table(entries):
+            return {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in entries.items()}
+        with self._lock:
+            memos = {name: {'hits': hits, 'misses': misses} for name, (hits, misses) in self.memos.items()}
+            return {'phases': table(self.phases), 'filters': table(self.filters), 'memo': memos}
+
+    def trace_events(self) -> dict:
+        """The trace in the Chrome trace event format, which Perfetto (https://ui.perfetto.dev) and chrome://tracing load.
+        Timestamps are in microseconds, and the events of several processes can be merged into one `traceEvents` list."""
+        with self._lock:
+            events = list(self.events)
+        metadata = [dict(name='process_name', ph='M', pid=os.getpid(), args=dict(name='yasha'))]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, path: Union[str, os.PathLike]):
+        with open(path, 'w') as f:
+            json.dump(self.trace_events(), f)
+
+    def report(self, format: Union[Literal['text'], Literal['json']] = 'text') -> str:
+        "Returns the collected timings, either as a human-readable table or as a JSON document"
+        data = self.as_dict()
+        if format == 'json':
+            return json.dumps(data, indent=2)
+        lines = []
+        for title, entries in (('Phase', data['phases']), ('Filter', data['filters'])):
+            if not entries:
+                continue
+            width = max(len(title), *(len(name) for name in entries))
+            lines.append(f"{title:<{width}}  {'Calls':>8}  {'Total (ms)':>12}")
+            for name, entry in entries.items():
+                lines.append(f"{name:<{width}}  {entry['calls']:>8}  {entry['seconds'] * 1000:>12.3f}")
+            lines.append('')
+        if data['memo']:
+            width = max(len('Memo'), *(len(name) for name in data['memo']))
+            lines.append(f"{'Memo':<{width}}  {'Hits':>8}  {'Misses':>8}  {'Hit rate':>8}")
+            for name, entry in data['memo'].items():
+                rate = entry['hits'] / (entry['hits'] + entry['misses'])
+                lines.append(f"{name:<{width}}  {entry['hits']:>8}  {entry['misses']:>8}  {rate:>8.1%}")
+            lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,236 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2020 Alex Tremblay
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import inspect
+from typing import Any, Dict, List, Mapping, Set, Tuple
+
+import jinja2.filters
+import jinja2.tests
+from jinja2 import nodes
+from jinja2.compiler import has_safe_repr
+from jinja2.defaults import DEFAULT_NAMESPACE
+from jinja2.environment import Environment
+from jinja2.visitor import NodeTransformer
+
+# Names which jinja defines in some scopes, and which are never replaced by a static variable
+RESERVED_NAMES = {'loop', 'caller', 'varargs', 'kwargs', 'self', 'super'}
+
+
+def stored_names(template: nodes.Template) -> Dict[str, int]:
+    "The number of times each name is assigned, in any scope, by a template: by set, for, with, macro, import..."
+    counts: Dict[str, int] = dict()
+
+    def store(name):
+        counts[name] = counts.get(name, 0) + 1
+
+    for node in template.find_all((nodes.Name, nodes.Macro, nodes.Import, nodes.FromImport)):
+        if isinstance(node, nodes.Name) and node.ctx in ('store', 'param'):
+            store(node.name)
+        elif isinstance(node, nodes.Macro):
+            store(node.name)
+        elif isinstance(node, nodes.Import):
+            store(node.target)
+        elif isinstance(node, nodes.FromImport):
+            for name in node.names:
+                store(name[1] if isinstance(name, tuple) else name)
+    return counts
+
+
+def folding_environment(environment: Environment) -> Environment:
+    """An overlay of `environment` whose filters and tests are the ones which can run ahead of time:
+    jinja's own, and the filters marked with `yasha.filters.pure`"""
+    env = environment.overlay()
+    env.filters = {name: func for name, func in environment.filters.items() if func is jinja2.filters.FILTERS.get(name)}
+    for name, func in environment.filters.items():
+        if getattr(func, 'yasha_pure', None):
+            env.filters[name] = inspect.unwrap(func)  # not the memoized version, which needs a render context
+    env.tests = {name: func for name, func in environment.tests.items() if func is jinja2.tests.TESTS.get(name)}
+    return env
+
+
+def static_names(names: Set[str], variables: Mapping[str, Any]) -> Set[str]:
+    "The `names` which are static `variables`. Only these are looked up, and jinja's global functions aren't variables"
+    return {name for name in names if name in variables and variables[name] is not DEFAULT_NAMESPACE.get(name)}
+
+
+def _truth(node: nodes.Node):
+    "True or False if `node` is a constant, else None"
+    if isinstance(node, nodes.Const):
+        return bool(node.value)
+    return None
+
+
+def _as_condition(node: nodes.Expr) -> nodes.Expr:
+    """Simplifies an expression whose value only matters as a condition: `x or false` and `x and true` become `x`.
+    The constant on the left is taken care of by `Specializer.visit_And` and `visit_Or`."""
+    if isinstance(node, nodes.Or) and _truth(node.right) is False:
+        return _as_condition(node.left)
+    if isinstance(node, nodes.And) and _truth(node.right) is True:
+        return _as_condition(node.left)
+    return node
+
+
+class Specializer(NodeTransformer):
+    """Specializes the abstract syntax tree of a template for the values of some of its variables.
+
+    The static variables are replaced by their values, expressions whose operands are all constant are
+    evaluated, and the branches of `if` statements and expressions whose condition became constant are
+    pruned. Jinja's own filters and tests, and pure filters, run ahead of time, but no other function is
+    called. Expressions whose value can't be written into a template, like objects, are kept as they are.
+
+    Variables the template assigns anywhere are never replaced, except top level `{% set %}` statements
+    which assign a constant once, in templates without blocks: their value is used after them.
+    """
+
+    def __init__(self, environment: Environment, variables: Mapping[str, Any], template_name: str = None):
+        self.eval_ctx = nodes.EvalContext(folding_environment(environment), template_name)
+        self.variables = variables
+        self.constants: Dict[str, Any] = dict()
+        # Constants which can't be written into a template -> the expression they were evaluated from
+        self._originals: Dict[int, Tuple[nodes.Const, nodes.Expr]] = dict()
+        self._set_once: Set[str] = set()
+
+    def specialize(self, template: nodes.Template) -> nodes.Template:
+        stored = stored_names(template)
+        names = static_names({n.name for n in template.find_all(nodes.Name)} - stored.keys() - RESERVED_NAMES, self.variables)
+        self.constants = {name: self.variables[name] for name in names}
+        if not any(template.find_all((nodes.Block, nodes.Extends))):
+            self._set_once = {name for name, count in stored.items() if count == 1}
+        if any(template.find_all(nodes.EvalContextModifier)):
+            # The result of filters like escape depends on the {% autoescape %} block they're in
+            self.eval_ctx.volatile = True
+        template = self.visit(template)
+        return _Restorer(self._originals).visit(template)
+
+    def _const(self, value: Any, original: nodes.Expr) -> nodes.Const:
+        const = nodes.Const(value, lineno=original.lineno)
+        if not has_safe_repr(value):
+            self._originals[id(const)] = (const, original)
+        return const
+
+    def visit(self, node, *args, **kwargs):
+        node = super().visit(node, *args, **kwargs)
+        if isinstance(node, nodes.Expr) and not isinstance(node, (nodes.Literal, nodes.Name)):
+            try:
+                return self._const(node.as_const(self.eval_ctx), node)
+            except Exception:
+                # Impossible, or an error which is left for the render to raise
+                pass
+        return node
+
+    def visit_Template(self, node: nodes.Template) -> nodes.Template:
+        body: List[nodes.Node] = []
+        for child in node.body:
+            body.extend(self._visit_body([child]))
+            if isinstance(child, nodes.Assign) and isinstance(child.target, nodes.Name) and child.target.name in self._set_once \
+                    and isinstance(child.node, nodes.Const) and has_safe_repr(child.node.value):
+                self.constants[child.target.name] = child.node.value
+        node.body = body
+        return node
+
+    def visit_Name(self, node: nodes.Name) -> nodes.Expr:
+        if node.ctx == 'load' and node.name in self.constants:
+            return self._const(self.constants[node.name], node)
+        return node
+
+    def visit_And(self, node: nodes.And) -> nodes.Expr:
+        self.generic_visit(node)
+        truth = _truth(node.left)
+        if truth is None:
+            return node
+        return node.right if truth else node.left
+
+    def visit_Or(self, node: nodes.Or) -> nodes.Expr:
+        self.generic_visit(node)
+        truth = _truth(node.left)
+        if truth is None:
+            return node
+        return node.left if truth else node.right
+
+    def visit_Not(self, node: nodes.Not) -> nodes.Expr:
+        self.generic_visit(node)
+        node.node = _as_condition(node.node)
+        return node
+
+    def visit_CondExpr(self, node: nodes.CondExpr) -> nodes.Expr:
+        self.generic_visit(node)
+        node.test = _as_condition(node.test)
+        truth = _truth(node.test)
+        if truth is True:
+            return node.expr1
+        if truth is False and node.expr2 is not None:
+            return node.expr2
+        return node
+
+    def _visit_body(self, body: List[nodes.Node]) -> List[nodes.Node]:
+        result: List[nodes.Node] = []
+        for child in body:
+            visited = self.visit(child)
+            result.extend(visited if isinstance(visited, list) else [visited])
+        return result
+
+    def visit_If(self, node: nodes.If):
+        # The elif branches are visited here, as visit_If could turn them into something else than an If
+        for branch in [node] + node.elif_:
+            branch.test = self.visit(branch.test)
+            branch.body = self._visit_body(branch.body)
+        node.else_ = self._visit_body(node.else_)
+        kept: List[Tuple[nodes.Expr, List[nodes.Node]]] = []
+        else_ = node.else_
+        for branch in [node] + node.elif_:
+            test = _as_condition(branch.test)
+            truth = _truth(test)
+            if truth is False:
+                continue
+            if truth is True:
+                # The branches after this one can't be reached
+                else_ = branch.body
+                break
+            kept.append((test, branch.body))
+        if not kept:
+            return else_
+        (test, body), elif_ = kept[0], kept[1:]
+        return nodes.If(test, body, [nodes.If(t, b, [], [], lineno=t.lineno) for t, b in elif_], else_, lineno=node.lineno)
+
+
+class _Restorer(NodeTransformer):
+    "Puts back the expressions of the constants which can't be written into a template"
+
+    def __init__(self, originals: Dict[int, Tuple[nodes.Const, nodes.Expr]]):
+        self.originals = originals
+
+    def visit_Const(self, node: nodes.Const) -> nodes.Expr:
+        if id(node) in self.originals:
+            return self.visit(self.originals[id(node)][1])
+        return node
+
+
+def specialize(environment: Environment, template: nodes.Template, variables: Mapping[str, Any],
+               template_name: str = None) -> Tuple[nodes.Template, Set[str]]:
+    """Returns the abstract syntax tree of `template` specialized for the static `variables` (see `Specializer`),
+    and the names of the static variables it still refers to, which must still be given to render it"""
+    template = Specializer(environment, variables, template_name).specialize(template)
+    loaded = {node.name for node in template.find_all(nodes.Name) if node.ctx == 'load'}
+    remaining = static_names(loaded - stored_names(template).keys(), variables)
+    return template, remaining
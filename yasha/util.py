@@ -22,20 +22,104 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import io
 import os
+import stat
+import threading
+from collections import ChainMap, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO, Deque, Iterable, List, Mapping, Optional
 
 import jinja2 as jinja
 from .tests import TESTS
-from .filters import FILTERS
+from .filters import FILTERS, memoize_pure_filters, sync_filter
 from .classes import CLASSES
 from .parsers import PARSERS
+from .jobserver import Jobserver
+from .profiling import activated, active_profiler, span
 from click import ClickException
 
-def find_template_companion(template, extension='', check=True):
+
+class DirectoryCache:
+    """Caches directory listings for the companion file lookups.
+
+    Looking up the variable and extension files of a template lists every
+    directory from the template's folder up to the root folder. Sibling
+    templates share most of those directories, so the listings are scanned
+    once and kept grouped by basename prefix (the part of a file name before
+    its first dot), which is what the lookups match against. A listing is
+    scanned again once the modification time of its directory changes, as it
+    does when files are added, removed or renamed.
+    """
+
+    def __init__(self):
+        self._listings = dict()
+        self._lock = threading.Lock()
+
+    def _scan(self, path):
+        prefixes = dict()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if '.' not in entry.name:
+                        continue
+                    prefix = entry.name.split('.')[0]
+                    try:
+                        is_file = entry.is_file()
+                    except OSError:
+                        is_file = False
+                    prefixes.setdefault(prefix, dict())[entry.name] = is_file
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        for prefix, names in prefixes.items():
+            prefixes[prefix] = dict(sorted(names.items()))
+        return prefixes
+
+    def prefixes(self, path):
+        """
+        Returns a dict mapping each basename prefix found in `path` to
+        a sorted dict of {file name: is regular file}
+        """
+        path = os.fspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            entry = self._listings.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, self._scan(path))
+            with self._lock:
+                self._listings[path] = entry
+        return entry[1]
+
+    def candidates(self, path, prefix):
+        """
+        Returns the sorted names of the entries in `path` whose name
+        starts with `prefix` followed by a dot
+        """
+        return list(self.prefixes(path).get(prefix, ()))
+
+    def files(self, path, prefix):
+        """
+        Returns the set of regular file names in `path` whose name
+        starts with `prefix` followed by a dot
+        """
+        names = self.prefixes(path).get(prefix, dict())
+        return set(name for name, is_file in names.items() if is_file)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+def find_template_companion(template, extension='', check=True, cache=None):
     """
-    Returns the first found template companion file
+    Returns the first found template companion file. The directories are
+    listed through `cache`, a DirectoryCache, or a new one by default.
     """
+    cache = cache or DirectoryCache()
 
     if check and not os.path.isfile(template):
         yield ''
@@ -49,13 +133,9 @@ def find_template_companion(template, extension='', check=True):
     stop_path = os.path.commonprefix((os.getcwd(), current_path))
     stop_path = os.path.dirname(stop_path)
 
-    token = template_basename[0] + '.'
-
     while True:
 
-        for file in sorted(os.listdir(current_path)):
-            if not file.startswith(token):
-                continue
+        for file in cache.candidates(current_path, template_basename[0]):
             if not file.endswith(extension):
                 continue
 
@@ -76,13 +156,25 @@ def find_template_companion(template, extension='', check=True):
         current_path = os.path.split(current_path)[0]
 
 
-def find_referenced_templates(template, search_path):
+def find_referenced_templates(template, search_path, dynamic=False):
     """
     Returns a list of files which can be either {% imported %},
-    {% extended %} or {% included %} within a template.
+    {% extended %} or {% included %} within a template. With `dynamic`,
+    templates referenced by a variable name are listed as None.
     """
     from jinja2 import Environment, meta
-    env = Environment()
+    import jinja2.defaults as d
+    # Use the template syntax of jinja2.defaults at the time of the call, which extension files may have redefined
+    env = Environment(
+        block_start_string=d.BLOCK_START_STRING,
+        block_end_string=d.BLOCK_END_STRING,
+        variable_start_string=d.VARIABLE_START_STRING,
+        variable_end_string=d.VARIABLE_END_STRING,
+        comment_start_string=d.COMMENT_START_STRING,
+        comment_end_string=d.COMMENT_END_STRING,
+        line_statement_prefix=d.LINE_STATEMENT_PREFIX,
+        line_comment_prefix=d.LINE_COMMENT_PREFIX,
+    )
     ast = env.parse(template.read())
     referenced_templates = list(meta.find_referenced_templates(ast))
 
@@ -93,12 +185,35 @@ def find_referenced_templates(template, search_path):
                 return t
         return None
 
+    if dynamic:
+        return [None if t is None else realpath(t) for t in referenced_templates]
     return [realpath(t) for t in referenced_templates if t is not None]
 
 
+def find_all_referenced_templates(template: Path, search_path) -> Optional[List[str]]:
+    """
+    Returns every template which `template` {% imports %}, {% extends %} or
+    {% includes %}, directly or through other templates. Returns None if any of
+    them can't be found, like templates referenced by a variable name.
+    """
+    found = []
+    pending = [template]
+    while pending:
+        with open(pending.pop(), 'rb') as f:
+            referenced = find_referenced_templates(f, search_path, dynamic=True)
+        for path in referenced:
+            if path is None:
+                return None
+            if path not in found:
+                found.append(path)
+                pending.append(path)
+    return found
+
+
 def load_jinja(
         path, tests, filters, classes, mode,
-        trim_blocks, lstrip_blocks, keep_trailing_newline):
+        trim_blocks, lstrip_blocks, keep_trailing_newline,
+        enable_async=False):
     from jinja2.defaults import BLOCK_START_STRING, BLOCK_END_STRING, \
         VARIABLE_START_STRING, VARIABLE_END_STRING, \
         COMMENT_START_STRING, COMMENT_END_STRING, \
@@ -126,17 +241,155 @@ def load_jinja(
         keep_trailing_newline=keep_trailing_newline,
         extensions=classes,
         undefined=undefined[mode],
-        loader=jinja.FileSystemLoader(path)
+        loader=jinja.FileSystemLoader(path),
+        enable_async=enable_async
     )
     env.tests.update(tests)
-    env.filters.update(filters)
+    if enable_async:
+        env.filters.update(memoize_pure_filters(filters))
+    else:
+        env.filters.update(memoize_pure_filters({name: sync_filter(f) for name, f in filters.items()}))
     return env
 
 
-def parse_variable_file(file: Path):
+def output_kind(output: BinaryIO) -> str:
+    """Returns 'memory' for outputs without a file descriptor, like io.BytesIO,
+    'file' for regular files, and 'stream' for pipes, terminals and sockets."""
+    try:
+        mode = os.fstat(output.fileno()).st_mode
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return 'memory'
+    return 'file' if stat.S_ISREG(mode) else 'stream'
+
+
+def default_buffer_size(output: BinaryIO) -> int:
+    """Picks the number of rendered chunks to write at once into `output`.
+
+    In-memory outputs get the whole render in a single write. Regular files get
+    large batches, as nobody reads them before the render is complete. Pipes and
+    terminals get every chunk as soon as it is rendered, so that the next stage
+    of a pipeline can start early.
+    """
+    return {'memory': 0, 'file': 64, 'stream': 1}[output_kind(output)]
+
+
+def dump_template(template: jinja.Template, variables: Mapping, output: BinaryIO,
+                  encoding: str = 'utf-8', buffer_size: Optional[int] = None, flush: Optional[bool] = None):
+    """Renders `template` into the binary file `output`.
+
+    `buffer_size` is the number of rendered chunks encoded and written at once.
+    0 renders the whole template before writing it with a single `writelines`
+    call, and None picks a size suited to `output` (see `default_buffer_size`).
+    With `flush`, `output` is flushed after each write. It defaults to True for
+    pipes and terminals.
+    """
+    if buffer_size is None:
+        buffer_size = default_buffer_size(output)
+    if flush is None:
+        flush = output_kind(output) == 'stream'
+    if buffer_size == 0:
+        chunks = [chunk.encode(encoding) for chunk in template.generate(variables)]
+        with span('write output'):
+            output.writelines(chunks)
+            if flush:
+                output.flush()
+        return
+    stream = template.stream(variables)
+    if buffer_size > 1:
+        stream.enable_buffering(buffer_size)
+    tracing = getattr(active_profiler(), 'tracing', False)
+    if not flush and not tracing:
+        stream.dump(output, encoding=encoding)
+        return
+    # Rendering and writing alternate, and a trace shows each write
+    for chunk in stream:
+        with span('write output'):
+            output.write(chunk.encode(encoding))
+            if flush:
+                output.flush()
+
+
+def format_output_path(pattern: str, index: int, variables: Mapping) -> Path:
+    """Returns the output file name for one render of `render_each`.
+
+    `pattern` is a `str.format` pattern, which can refer to the `index` of the
+    render and to any of its variables, e.g. 'out/{item[name]}.h'.
+    """
+    try:
+        return Path(pattern.format_map(ChainMap({'index': index}, variables)))
+    except (KeyError, IndexError, AttributeError) as e:
+        msg = "Unable to format the output file name '{}': unknown field {}"
+        raise ClickException(msg.format(pattern, e))
+
+
+def write_if_changed(path: Path, data: bytes) -> bool:
+    """Writes `data` into the file `path`, unless the file already has exactly
+    this content. Leaving unchanged files untouched keeps their modification
+    time, so that build tools don't rebuild what depends on them.
+    Returns True if the file was written.
+    """
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    with span('write output') as args:
+        args['path'] = str(path)
+        if path.parent != Path():
+            path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return True
+
+
+def render_each(template: jinja.Template, contexts: Iterable[Mapping], output_pattern: str,
+                encoding: str = 'utf-8', workers: int = 1, jobserver: Optional[Jobserver] = None) -> List[Path]:
+    """Renders an already compiled template once for each set of variables in
+    `contexts`, into the file named by `output_pattern` (see `format_output_path`).
+
+    Contexts are consumed as they are rendered, and with more than one worker
+    the renders run in a thread pool, to which at most two contexts per worker
+    are handed at once, so that a generator of contexts is never consumed far
+    ahead of the renders. With a `jobserver`, every render is a job
+    of the GNU Make jobserver, so that no more renders run at once than make
+    allows. Files which already have the rendered content are not rewritten (see
+    `write_if_changed`). Returns the paths of the rendered files, in the order of
+    `contexts`.
+    """
+    profiler = active_profiler()
+
+    def render(index, variables):
+        path = format_output_path(output_pattern, index, variables)
+        if jobserver:
+            with jobserver.job():
+                data = template.render(variables).encode(encoding)
+        else:
+            data = template.render(variables).encode(encoding)
+        write_if_changed(path, data)
+        return path
+
+    def render_in_thread(index, variables):
+        # The active profiler of the caller also records the spans of the pool threads
+        with activated(profiler):
+            return render(index, variables)
+
+    if workers == 1:
+        return [render(index, variables) for index, variables in enumerate(contexts)]
+    window = 2 * (workers or os.cpu_count() or 1)
+    paths: List[Path] = []
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index, variables in enumerate(contexts):
+            if len(pending) >= window:
+                paths.append(pending.popleft().result())
+            pending.append(pool.submit(render_in_thread, index, variables))
+        paths.extend(future.result() for future in pending)
+    return paths
+
+
+def parse_variable_file(file: Path, parsers=PARSERS):
     try:
         file_extension = file.suffix
-        return PARSERS[file_extension](file.open('rb'))
+        return parsers[file_extension](file.open('rb'))
     except AttributeError:
         return dict()
     except KeyError:
@@ -144,6 +397,9 @@ def parse_variable_file(file: Path):
         raise ClickException(error.format(file_extension))
 
 def load_python_module(file):
+    import sys
+    # Don't let attributes of a previously loaded extension file leak into this one
+    sys.modules.pop('yasha_extensions', None)
     try:
         from importlib.machinery import SourceFileLoader
         loader = SourceFileLoader('yasha_extensions', file.name)
@@ -156,7 +412,11 @@ def load_python_module(file):
         pass
     return module
 
-def load_extensions(file):
+def load_extensions(file, all_tests=TESTS, all_filters=FILTERS, all_parsers=PARSERS, all_classes=CLASSES):
+    """Loads the tests, filters, parsers and jinja extension classes of the
+    extension file `file` into the registries `all_tests`, `all_filters`,
+    `all_parsers` and `all_classes`, by default the ones of yasha. The template
+    syntax the file defines is set in jinja2.defaults."""
     from jinja2.ext import Extension
     import inspect
 
@@ -197,21 +457,21 @@ def load_extensions(file):
             setattr(jinja2.defaults, name, obj)
 
     try:
-        TESTS.update(module.TESTS)
+        all_tests.update(module.TESTS)
     except AttributeError:
-        TESTS.update(tests)
+        all_tests.update(tests)
 
     try:
-        FILTERS.update(module.FILTERS)
+        all_filters.update(module.FILTERS)
     except AttributeError:
-        FILTERS.update(filters)
+        all_filters.update(filters)
 
     try:
-        PARSERS.update(module.PARSERS)
+        all_parsers.update(module.PARSERS)
     except AttributeError:
-        PARSERS.update(parsers)
+        all_parsers.update(parsers)
 
     try:
-        CLASSES.extend(module.CLASSES)
+        all_classes.extend(module.CLASSES)
     except AttributeError:
-        CLASSES.extend(classes)
+        all_classes.extend(classes)